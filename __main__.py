@@ -1,5 +1,8 @@
-from typing import List
+from typing import Optional
 import pulumi
+import ami
+import environment
+from golden_image import GoldenImage
 import vpc
 from tls import TransportLayerSecurity
 from key import Key
@@ -16,55 +19,111 @@ domain = config.require("domain")
 rqlite_id_offset = config.get_int("rqlite_id_offset")
 if rqlite_id_offset is None:
     rqlite_id_offset = 0
+batch_remote_executions = config.get_bool("batch_remote_executions") or False
+golden_images = config.get_bool("golden_images") or False
+autoscaled_webapps = config.get_object("autoscaled_webapps") or []
+jobs_queue_keys = config.get_object("jobs_queue_keys") or ["jobs:hot"]
+jobs_max_workers = config.get_int("jobs_max_workers") or 6
+jobs_spot_instance_types = config.get_object("jobs_spot_instance_types")
 deployment_secret = config.require_secret("deployment_secret")
 slack_web_errors_url = config.require_secret("slack_web_errors_url")
 slack_ops_url = config.require_secret("slack_ops_url")
 google_oidc_client_id = config.require("google_oidc_client_id")
 google_oidc_client_secret = config.require_secret("google_oidc_client_secret")
 
+ami_cache_ttl = config.get_float("ami_cache_ttl")
+ami.AMI_RESOLVER.configure(
+    cache_path=ami.DEFAULT_CACHE_PATH if ami_cache_ttl else None,
+    cache_ttl=ami_cache_ttl,
+    pins=config.get_object("ami_pins"),
+)
+
 key = Key("key", "key.pub", "key.openssh")
 
 main_vpc = vpc.VirtualPrivateCloud("main_vpc", key)
-main_rqlite = rqlite.RqliteCluster("main_rqlite", main_vpc, id_offset=rqlite_id_offset)
-main_redis = redis.RedisCluster("main_redis", main_vpc)
-
-
-def make_standard_webapp_configuration(args) -> str:
-    rqlite_ips: List[str] = args[: len(main_rqlite.instances)]
-    redis_ips: List[str] = args[
-        len(rqlite_ips) : len(rqlite_ips) + len(main_redis.instances)
-    ]
-    remaining = args[len(rqlite_ips) + len(redis_ips) :]
-    deploy_secret: str = remaining[0]
-    web_errors_url: str = remaining[1]
-    ops_url: str = remaining[2]
-    login_url: str = remaining[3]
-    auth_domain: str = remaining[4]
-    auth_client_id: str = remaining[5]
-    public_kid_url: str = remaining[6]
-    expected_issuer: str = remaining[7]
-    domain: str = remaining[8]
-
-    joined_rqlite_ips = ",".join(rqlite_ips)
-    joined_redis_ips = ",".join(redis_ips)
-
-    return "\n".join(
-        [
-            f'export RQLITE_IPS="{joined_rqlite_ips}"',
-            f'export REDIS_IPS="{joined_redis_ips}"',
-            f'export DEPLOYMENT_SECRET="{deploy_secret}"',
-            f'export SLACK_WEB_ERRORS_URL="{web_errors_url}"',
-            f'export SLACK_OPS_URL="{ops_url}"',
-            f'export LOGIN_URL="{login_url}"',
-            f'export AUTH_DOMAIN="{auth_domain}"',
-            f'export AUTH_CLIENT_ID="{auth_client_id}"',
-            f'export PUBLIC_KID_URL="{public_kid_url}"',
-            f'export EXPECTED_ISSUER="{expected_issuer}"',
-            f'export ROOT_FRONTEND_URL="https://{domain}"',
-            f'export ROOT_BACKEND_URL="https://{domain}"',
-            f'export ROOT_WEBSOCKET_URL="wss://{domain}"',
-        ]
+
+webapp_image: Optional[GoldenImage] = None
+rqlite_image: Optional[GoldenImage] = None
+redis_image: Optional[GoldenImage] = None
+reverse_proxy_image: Optional[GoldenImage] = None
+if golden_images:
+    webapp_image = GoldenImage("webapp_image", main_vpc, "webapp")
+    rqlite_image = GoldenImage(
+        "rqlite_image",
+        main_vpc,
+        "rqlite",
+        base_ami=main_vpc.amazon_linux_bleeding_arm64,
+        volume_size=8,
     )
+    redis_image = GoldenImage(
+        "redis_image",
+        main_vpc,
+        "redis",
+        architecture="x86_64",
+        base_ami=main_vpc.amazon_linux_amd64,
+        volume_size=4,
+    )
+    reverse_proxy_image = GoldenImage(
+        "reverse_proxy_image",
+        main_vpc,
+        "reverse-proxy",
+        base_ami=main_vpc.amazon_linux_arm64,
+    )
+
+main_rqlite = rqlite.RqliteCluster(
+    "main_rqlite",
+    main_vpc,
+    id_offset=rqlite_id_offset,
+    batch_remote_executions=batch_remote_executions,
+    image=rqlite_image,
+)
+main_redis = redis.RedisCluster(
+    "main_redis",
+    main_vpc,
+    batch_remote_executions=batch_remote_executions,
+    image=redis_image,
+)
+
+
+def get_autoscaling(name: str, **kwargs) -> Optional[webapp.WebappAutoscaling]:
+    """Returns how to scale the webapp with the given name, if it is one of
+    the autoscaled_webapps, otherwise None
+    """
+    if name not in autoscaled_webapps:
+        return None
+    return webapp.WebappAutoscaling(**kwargs)
+
+
+BACKEND_ENVIRONMENT = [
+    "RQLITE_IPS",
+    "REDIS_IPS",
+    "DEPLOYMENT_SECRET",
+    "SLACK_WEB_ERRORS_URL",
+    "SLACK_OPS_URL",
+    "LOGIN_URL",
+    "AUTH_DOMAIN",
+    "AUTH_CLIENT_ID",
+    "PUBLIC_KID_URL",
+    "EXPECTED_ISSUER",
+    "ROOT_FRONTEND_URL",
+    "ROOT_BACKEND_URL",
+    "ROOT_WEBSOCKET_URL",
+]
+"""The environment variables consumed by the rest backend and the integration
+tests, ie., every variable"""
+
+WEBSOCKET_ENVIRONMENT = BACKEND_ENVIRONMENT
+"""The environment variables consumed by the websocket backend. Every variable
+until the ones it reads are confirmed against its repository, since a
+variable it still reads would otherwise be empty after the next deploy"""
+
+FRONTEND_ENVIRONMENT = BACKEND_ENVIRONMENT
+"""The environment variables consumed by the frontend. Every variable until
+the ones it reads are confirmed against its repository"""
+
+JOBS_ENVIRONMENT = BACKEND_ENVIRONMENT
+"""The environment variables consumed by the jobs runners. Every variable
+until the ones they read are confirmed against their repository"""
 
 
 backend_rest = webapp.Webapp(
@@ -75,6 +134,10 @@ backend_rest = webapp.Webapp(
     github_pat,
     main_vpc.bastion.public_ip,
     key,
+    image=webapp_image,
+    environment=BACKEND_ENVIRONMENT,
+    health_check_path="/",
+    autoscaling=get_autoscaling("backend_rest"),
 )
 backend_ws = webapp.Webapp(
     "backend_ws",
@@ -84,6 +147,10 @@ backend_ws = webapp.Webapp(
     github_pat,
     main_vpc.bastion.public_ip,
     key,
+    image=webapp_image,
+    environment=WEBSOCKET_ENVIRONMENT,
+    health_check_path="/",
+    autoscaling=get_autoscaling("backend_ws"),
 )
 frontend = webapp.Webapp(
     "frontend",
@@ -93,6 +160,10 @@ frontend = webapp.Webapp(
     github_pat,
     main_vpc.bastion.public_ip,
     key,
+    image=webapp_image,
+    environment=FRONTEND_ENVIRONMENT,
+    health_check_path="/",
+    autoscaling=get_autoscaling("frontend"),
 )
 jobs = webapp.Webapp(
     "jobs",
@@ -102,6 +173,18 @@ jobs = webapp.Webapp(
     github_pat,
     main_vpc.bastion.public_ip,
     key,
+    image=webapp_image,
+    environment=JOBS_ENVIRONMENT,
+    autoscaling=get_autoscaling(
+        "jobs",
+        min_size=1,
+        max_size=jobs_max_workers,
+        target_cpu_utilization=None,
+        load_balanced=False,
+        queue_keys=jobs_queue_keys,
+        spot_instance_types=jobs_spot_instance_types,
+        drain_timeout=300,
+    ),
 )
 itg_tests = webapp.Webapp(
     "itg_tests",
@@ -111,9 +194,17 @@ itg_tests = webapp.Webapp(
     github_pat,
     main_vpc.bastion.public_ip,
     key,
+    image=webapp_image,
+    environment=BACKEND_ENVIRONMENT,
 )
 main_reverse_proxy = reverse_proxy.ReverseProxy(
-    "main_reverse_proxy", main_vpc, key, backend_rest, backend_ws, frontend
+    "main_reverse_proxy",
+    main_vpc,
+    key,
+    backend_rest,
+    backend_ws,
+    frontend,
+    image=reverse_proxy_image,
 )
 tls = TransportLayerSecurity(
     "tls",
@@ -128,22 +219,27 @@ cognito = Cognito(
     google_oidc_client_id=google_oidc_client_id,
     google_oidc_client_secret=google_oidc_client_secret,
 )
-standard_configuration = pulumi.Output.all(
-    *[instance.private_ip for instance in main_rqlite.instances],
-    *[instance.private_ip for instance in main_redis.instances],
-    deployment_secret,
-    slack_web_errors_url,
-    slack_ops_url,
-    cognito.token_login_url,
-    cognito.auth_domain,
-    cognito.user_pool_client.name,
-    cognito.public_kid_url,
-    cognito.expected_issuer,
-    domain,
-).apply(make_standard_webapp_configuration)
+standard_environment = environment.WebappEnvironment()
+standard_environment.set_joined(
+    "RQLITE_IPS", [instance.private_ip for instance in main_rqlite.instances]
+)
+standard_environment.set_joined(
+    "REDIS_IPS", [instance.private_ip for instance in main_redis.instances]
+)
+standard_environment.set("DEPLOYMENT_SECRET", deployment_secret)
+standard_environment.set("SLACK_WEB_ERRORS_URL", slack_web_errors_url)
+standard_environment.set("SLACK_OPS_URL", slack_ops_url)
+standard_environment.set("LOGIN_URL", cognito.token_login_url)
+standard_environment.set("AUTH_DOMAIN", cognito.auth_domain)
+standard_environment.set("AUTH_CLIENT_ID", cognito.user_pool_client.name)
+standard_environment.set("PUBLIC_KID_URL", cognito.public_kid_url)
+standard_environment.set("EXPECTED_ISSUER", cognito.expected_issuer)
+standard_environment.set("ROOT_FRONTEND_URL", f"https://{domain}")
+standard_environment.set("ROOT_BACKEND_URL", f"https://{domain}")
+standard_environment.set("ROOT_WEBSOCKET_URL", f"wss://{domain}")
 
-backend_rest.perform_remote_executions(standard_configuration)
-backend_ws.perform_remote_executions(standard_configuration)
-frontend.perform_remote_executions(standard_configuration)
-jobs.perform_remote_executions(standard_configuration)
-itg_tests.perform_remote_executions(standard_configuration)
+backend_rest.perform_remote_executions(standard_environment)
+backend_ws.perform_remote_executions(standard_environment)
+frontend.perform_remote_executions(standard_environment)
+jobs.perform_remote_executions(standard_environment)
+itg_tests.perform_remote_executions(standard_environment)
@@ -0,0 +1,295 @@
+"""Provides a client for the provisioning agent in setup-scripts/shared/agent.py,
+which is installed on every machine by wait_boot_finished.sh. Talking to the
+agent over an ssh exec channel replaces the generated bash script, the sftp
+session and the login shell of each execution with a few frames: a bundle is
+only sent if the agent does not already have it, and the output and exit
+status come back as structured frames.
+
+The framing is loaded from the agent itself, so the two can never disagree,
+and the agent can be run locally in a subprocess via spawn_local_agent.
+"""
+import gzip
+import hashlib
+import os
+import subprocess
+import sys
+import types
+import zlib
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Tuple
+import paramiko
+
+AGENT_SOURCE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "setup-scripts", "shared", "agent.py"
+)
+"""The local path to the agents source"""
+
+AGENT_REMOTE_PATH = "/usr/local/lib/ezpbars/agent.py"
+"""Where wait_boot_finished.sh installs the agent on remote machines"""
+
+
+def _load_agent_module():
+    # executed from source, as importing it would write a __pycache__ into
+    # the shared scripts, which would then be bundled and change their hash
+    module = types.ModuleType("ezpbars_agent")
+    module.__file__ = AGENT_SOURCE_PATH
+    with open(AGENT_SOURCE_PATH) as f:
+        exec(compile(f.read(), AGENT_SOURCE_PATH, "exec"), module.__dict__)
+    return module
+
+
+agent_protocol = _load_agent_module()
+"""The agent module, for its framing functions and constants"""
+
+AGENT_COMMAND = (
+    f"sudo python3 {AGENT_REMOTE_PATH} --stdio"
+    f" --bundles-dir {agent_protocol.DEFAULT_BUNDLES_DIR}"
+    f" --work-dir {agent_protocol.DEFAULT_WORK_DIR}"
+)
+"""The command which starts a session with the agent over ssh"""
+
+
+SIGNATURE_BYTES_PER_BLOCK = 32
+"""Roughly how many bytes each block of a delta signature takes as json"""
+
+
+class AgentUnavailableError(Exception):
+    """Raised when the agent could not be started or did not say hello, eg.,
+    because it is not installed yet
+    """
+
+
+class AgentError(Exception):
+    """Raised when the agent answers a request with an error"""
+
+
+class AgentRunResult:
+    """The structured result of running a script via the agent"""
+
+    def __init__(
+        self, exit_status: Optional[int], duration: float, timed_out: Optional[str]
+    ) -> None:
+        self.exit_status: Optional[int] = exit_status
+        """The exit status of the script, None if it timed out"""
+
+        self.duration: float = duration
+        """How many seconds the script ran for, as measured by the agent"""
+
+        self.timed_out: Optional[str] = timed_out
+        """Why the script was killed ("inactivity" or "deadline"), if it was"""
+
+
+class AgentClient:
+    """A session with the agent over a pair of binary streams. Requests are
+    answered in order, so a session must only be used by one thread at a time.
+    """
+
+    def __init__(self, reader: BinaryIO, writer: BinaryIO) -> None:
+        self.reader: BinaryIO = reader
+        """The stream the agents frames are read from"""
+
+        self.writer: BinaryIO = writer
+        """The stream requests are written to"""
+
+        self.version: Optional[int] = None
+        """The protocol version the agent reported, once hello has been called"""
+
+    def request(
+        self, header: Dict[str, Any], payload: Optional[bytes] = None
+    ) -> Tuple[Dict[str, Any], Optional[bytes]]:
+        """Sends the given request and returns the response, raising an
+        AgentError if the agent answered with an error
+        """
+        agent_protocol.write_frame(self.writer, header, payload)
+        return self.read_response()
+
+    def read_response(self) -> Tuple[Dict[str, Any], Optional[bytes]]:
+        """Reads the next frame from the agent, raising an AgentError if it
+        is an error
+        """
+        response, payload = agent_protocol.read_frame(self.reader)
+        if response["type"] == "error":
+            raise AgentError(response.get("message"))
+        return response, payload
+
+    def hello(self) -> List[str]:
+        """Starts the session, returning the hashes of the bundles the agent
+        has. Raises an AgentUnavailableError if the agent does not answer or
+        speaks a different protocol version.
+        """
+        try:
+            response, _ = self.request({"type": "hello"})
+        except (EOFError, OSError, agent_protocol.ProtocolError) as e:
+            raise AgentUnavailableError(f"agent did not say hello: {e!r}") from e
+        if response.get("version") != agent_protocol.PROTOCOL_VERSION:
+            raise AgentUnavailableError(
+                f"agent speaks protocol {response.get('version')}, "
+                f"expected {agent_protocol.PROTOCOL_VERSION}"
+            )
+        self.version = response["version"]
+        return response.get("bundles") or []
+
+    def ensure_bundle(
+        self, bundle_hash: str, archive: bytes, name: Optional[str] = None
+    ) -> int:
+        """Makes sure the agent has the bundle with the given hash, sending
+        the given tar.gz archive only if it does not. If a name is specified
+        (eg., the script folder), the bundle is sent as a delta against the
+        latest bundle with the same name on the machine whenever that is
+        smaller. Returns the number of payload bytes sent.
+        """
+        if name is not None and not agent_protocol.BUNDLE_NAME_REGEX.match(name):
+            name = None
+        response, _ = self.request(
+            {"type": "has_bundle", "hash": bundle_hash, "name": name}
+        )
+        if response["present"]:
+            return 0
+
+        if name is not None:
+            sent = self.put_delta(bundle_hash, archive, name)
+            if sent is not None:
+                return sent
+
+        self.request({"type": "put_bundle", "hash": bundle_hash, "name": name}, archive)
+        return len(archive)
+
+    def put_delta(self, bundle_hash: str, archive: bytes, name: str) -> Optional[int]:
+        """Sends the bundle as a delta against the latest bundle with the same
+        name on the machine, returning the number of payload bytes sent, or
+        None, having sent nothing, if there is no base or the delta would not
+        be smaller than the archive
+        """
+        # the signature should cost far less than sending the archive, as
+        # each block takes about SIGNATURE_BYTES_PER_BLOCK
+        max_blocks = max(len(archive) // (8 * SIGNATURE_BYTES_PER_BLOCK), 1)
+        signature, _ = self.request(
+            {"type": "signature", "name": name, "max_blocks": max_blocks}
+        )
+        if signature["base"] is None:
+            return None
+
+        tar_bytes = gzip.decompress(archive)
+        ops, literals = agent_protocol.compute_delta(
+            tar_bytes, signature["block_size"], signature["blocks"]
+        )
+        payload = zlib.compress(literals, 9)
+        if len(payload) + 16 * len(ops) >= len(archive):
+            return None
+
+        try:
+            self.request(
+                {
+                    "type": "put_delta",
+                    "hash": bundle_hash,
+                    "name": name,
+                    "base": signature["base"],
+                    "tar_hash": hashlib.sha256(tar_bytes).hexdigest(),
+                    "block_size": signature["block_size"],
+                    "ops": ops,
+                },
+                payload,
+            )
+        except AgentError:
+            # eg., the base was pruned concurrently or a strong checksum
+            # collided; the full archive always works
+            return None
+        return len(payload)
+
+    def run(
+        self,
+        bundle_hash: str,
+        script: str,
+        on_output: Callable[[str, bytes], None],
+        inactivity_timeout: Optional[float] = None,
+        deadline: Optional[float] = None,
+        bundle_cache_size: Optional[int] = None,
+    ) -> AgentRunResult:
+        """Runs the given bash script within a fresh copy of the bundle with
+        the given hash, calling on_output with the stream name ("stdout" or
+        "stderr") and data as output arrives. The agent kills the script if it
+        goes inactivity_timeout seconds without output or runs for longer than
+        deadline seconds. Afterwards the agent prunes all but the
+        bundle_cache_size most recently used bundles, if specified.
+        """
+        agent_protocol.write_frame(
+            self.writer,
+            {
+                "type": "run",
+                "bundle": bundle_hash,
+                "script": script,
+                "inactivity_timeout": inactivity_timeout,
+                "deadline": deadline,
+                "bundle_cache_size": bundle_cache_size,
+            },
+        )
+        while True:
+            response, payload = self.read_response()
+            if response["type"] == "output":
+                on_output(response["stream"], payload or b"")
+            elif response["type"] == "exit":
+                return AgentRunResult(
+                    response.get("status"),
+                    float(response.get("duration") or 0),
+                    response.get("timed_out"),
+                )
+            else:
+                raise agent_protocol.ProtocolError(
+                    f"unexpected {response['type']} while running"
+                )
+
+    def close(self) -> None:
+        """Ends the session"""
+        try:
+            agent_protocol.write_frame(self.writer, {"type": "bye"})
+        except OSError:
+            pass
+
+
+def connect_over_ssh(
+    client: paramiko.SSHClient, command: str = AGENT_COMMAND, timeout: float = 15
+) -> Tuple[AgentClient, paramiko.Channel]:
+    """Starts the agent on the connected machine with the given command and
+    says hello, returning the session and the channel it runs over, which
+    the caller must close. Raises an AgentUnavailableError if the agent does
+    not start.
+    """
+    chan = client.get_transport().open_session(timeout=timeout)
+    try:
+        chan.exec_command(command)
+        session = AgentClient(chan.makefile("rb"), chan.makefile_stdin("wb"))
+        session.hello()
+    except BaseException:
+        chan.close()
+        raise
+    return session, chan
+
+
+def spawn_local_agent(
+    bundles_dir: str, work_dir: str
+) -> Tuple[AgentClient, subprocess.Popen]:
+    """Runs the agent in a local subprocess serving a single session over its
+    stdio, storing bundles in bundles_dir and running scripts in work_dir,
+    and says hello. Returns the session and the process, which exits once
+    the session is closed.
+    """
+    proc = subprocess.Popen(
+        [
+            sys.executable,
+            AGENT_SOURCE_PATH,
+            "--stdio",
+            "--bundles-dir",
+            bundles_dir,
+            "--work-dir",
+            work_dir,
+        ],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+    session = AgentClient(proc.stdout, proc.stdin)
+    try:
+        session.hello()
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    return session, proc
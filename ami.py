@@ -0,0 +1,230 @@
+"""Resolves amazon machine images by name pattern, architecture and owner,
+as aws.ec2.get_ami would for the most recent hvm image, but memoized for the
+lifetime of the process. Every component asking for the same image shares
+one lookup, including lookups which are still in flight.
+
+Resolved images may optionally be cached on disk for a time to live, so that
+previews skip the lookups and the chosen images stay the same between runs,
+and individual images may be pinned to a specific id. Either way, an image
+only changes when the cache entry expires, the cache file is deleted or the
+pin is changed.
+"""
+import concurrent.futures
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+import pulumi_aws as aws
+
+AMAZON_OWNER = "137112412989"
+"""The account which owns the amazon linux images"""
+
+DEFAULT_CACHE_PATH = ".ami_cache.json"
+"""The default path to the file which caches resolved images across runs"""
+
+DEFAULT_CACHE_TTL: float = 7 * 24 * 60 * 60
+"""The default number of seconds a resolved image is cached on disk for"""
+
+_AmiKey = Tuple[str, str, str]
+"""(name pattern, architecture, owner) for an image"""
+
+
+class ResolvedAmi:
+    """An amazon machine image chosen by an AmiResolver"""
+
+    def __init__(
+        self,
+        id: str,
+        name: Optional[str] = None,
+        architecture: Optional[str] = None,
+        creation_date: Optional[str] = None,
+        resolved_at: Optional[float] = None,
+    ) -> None:
+        self.id: str = id
+        """The id of the image, e.g., ami-0123456789abcdef0"""
+
+        self.name: Optional[str] = name
+        """The name of the image, if known; None for pinned images"""
+
+        self.architecture: Optional[str] = architecture
+        """The architecture of the image, if known"""
+
+        self.creation_date: Optional[str] = creation_date
+        """When the image was created, as reported by aws, if known"""
+
+        self.resolved_at: Optional[float] = resolved_at
+        """When the image was looked up, in seconds since the epoch, if it was"""
+
+
+def make_pin_key(name_pattern: str, architecture: str, owner: str) -> str:
+    """Returns the key of an image within pins and the cache file, e.g.,
+    137112412989/arm64/amzn2-ami-*
+    """
+    return f"{owner}/{architecture}/{name_pattern}"
+
+
+class AmiResolver:
+    """Resolves and memoizes amazon machine images"""
+
+    def __init__(
+        self,
+        cache_path: Optional[str] = None,
+        cache_ttl: float = DEFAULT_CACHE_TTL,
+        pins: Optional[Dict[str, str]] = None,
+    ) -> None:
+        """Creates a new resolver.
+
+        Args:
+            cache_path (str, None): the file used to cache resolved images across
+                runs, or None to only memoize them in memory
+            cache_ttl (float): how many seconds an image in the cache file is
+                used for before it is looked up again
+            pins (dict, None): image ids which are used without looking them up,
+                keyed by make_pin_key
+        """
+        self.cache_path: Optional[str] = cache_path
+        """The file used to cache resolved images across runs, if any"""
+
+        self.cache_ttl: float = cache_ttl
+        """How many seconds an image in the cache file is used for"""
+
+        self.pins: Dict[str, str] = dict(pins or dict())
+        """Image ids which are used without looking them up, keyed by
+        make_pin_key"""
+
+        self._lock = threading.Lock()
+        self._resolved: Dict[_AmiKey, ResolvedAmi] = dict()
+        self._in_flight: Dict[_AmiKey, concurrent.futures.Future] = dict()
+
+    def configure(
+        self,
+        cache_path: Optional[str] = None,
+        cache_ttl: Optional[float] = None,
+        pins: Optional[Dict[str, str]] = None,
+    ) -> None:
+        """Changes where images are cached, for how long, and which are pinned,
+        leaving anything which is not specified as it is. Images which were
+        already resolved are kept.
+        """
+        with self._lock:
+            if cache_path is not None:
+                self.cache_path = cache_path
+            if cache_ttl is not None:
+                self.cache_ttl = cache_ttl
+            if pins is not None:
+                self.pins = dict(pins)
+
+    def resolve(
+        self, name_pattern: str, architecture: str, owner: str = AMAZON_OWNER
+    ) -> ResolvedAmi:
+        """Returns the most recent hvm image whose name matches the given
+        pattern, for the given architecture and owned by the given account,
+        looking it up at most once per process and only if it is neither
+        pinned nor cached on disk
+        """
+        key: _AmiKey = (name_pattern, architecture, owner)
+        with self._lock:
+            pinned = self.pins.get(make_pin_key(*key))
+            if pinned is not None:
+                return ResolvedAmi(pinned, architecture=architecture)
+
+            resolved = self._resolved.get(key)
+            if resolved is not None:
+                return resolved
+
+            future = self._in_flight.get(key)
+            if future is not None:
+                leader = False
+            else:
+                future = concurrent.futures.Future()
+                self._in_flight[key] = future
+                leader = True
+
+        if not leader:
+            return future.result()
+
+        try:
+            resolved = self._load_cached(key)
+            if resolved is None:
+                resolved = self._lookup(key)
+                self._save_cached(key, resolved)
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            self._resolved[key] = resolved
+            del self._in_flight[key]
+        future.set_result(resolved)
+        return resolved
+
+    def _lookup(self, key: _AmiKey) -> ResolvedAmi:
+        name_pattern, architecture, owner = key
+        result = aws.ec2.get_ami(
+            most_recent=True,
+            filters=[
+                aws.ec2.GetAmiFilterArgs(name="name", values=[name_pattern]),
+                aws.ec2.GetAmiFilterArgs(name="virtualization-type", values=["hvm"]),
+                aws.ec2.GetAmiFilterArgs(name="architecture", values=[architecture]),
+            ],
+            owners=[owner],
+        )
+        return ResolvedAmi(
+            result.id,
+            name=result.name,
+            architecture=result.architecture,
+            creation_date=result.creation_date,
+            resolved_at=time.time(),
+        )
+
+    def _read_cache_file(self) -> Dict[str, Dict[str, str]]:
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return dict()
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def _load_cached(self, key: _AmiKey) -> Optional[ResolvedAmi]:
+        entry = self._read_cache_file().get(make_pin_key(*key))
+        if entry is None:
+            return None
+        resolved = ResolvedAmi(**entry)
+        if resolved.resolved_at is None or (
+            time.time() - resolved.resolved_at > self.cache_ttl
+        ):
+            return None
+        return resolved
+
+    def _save_cached(self, key: _AmiKey, resolved: ResolvedAmi) -> None:
+        if self.cache_path is None:
+            return
+
+        with self._lock:
+            entries = self._read_cache_file()
+            entries[make_pin_key(*key)] = vars(resolved)
+            tmp_path = f"{self.cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp_path, "w") as f:
+                    json.dump(entries, f, indent=2, sort_keys=True)
+                os.replace(tmp_path, self.cache_path)
+            except OSError:
+                # the cache is only an optimization
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+
+AMI_RESOLVER = AmiResolver()
+"""The resolver shared by every component within this process, which only
+memoizes in memory until configured otherwise"""
+
+
+def resolve_ami(
+    name_pattern: str, architecture: str, owner: str = AMAZON_OWNER
+) -> ResolvedAmi:
+    """Resolves an image via the shared resolver; see AmiResolver.resolve"""
+    return AMI_RESOLVER.resolve(name_pattern, architecture, owner)
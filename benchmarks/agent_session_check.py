@@ -0,0 +1,126 @@
+"""Checks the provisioning agent end to end by driving a session with it in a
+local subprocess via spawn_local_agent, so that changes to the agent or its
+protocol can be verified without an ssh server or a deploy.
+
+The session says hello, sends a bundle in full, finds it already present,
+runs a script within it, sends a changed bundle as a delta, runs a script
+which fails, and then closes, after which the agent must exit cleanly.
+
+Run from the repository root, eg.,
+
+    python -m benchmarks.agent_session_check
+
+which exits with a non-zero status, describing the failure, if any step does
+not behave as expected.
+"""
+import argparse
+import hashlib
+import os
+import secrets
+import shutil
+import sys
+import tempfile
+from typing import Dict, List, Optional
+from agent_client import spawn_local_agent
+from remote_executor import build_archive
+
+
+class CheckFailed(Exception):
+    """Raised when the agent does not behave as expected"""
+
+
+def expect(condition: bool, message: str) -> None:
+    """Raises a CheckFailed with the given message unless condition holds"""
+    if not condition:
+        raise CheckFailed(message)
+
+
+def write_script_folder(folder: str, data: str) -> None:
+    """Writes a script folder with a main.sh which prints its data file to
+    stdout and a line to stderr, and a data file large enough that a delta
+    against it is worthwhile
+    """
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, "main.sh"), "w") as f:
+        f.write('#!/usr/bin/env bash\ncat data.txt\necho "to stderr" >&2\n')
+    with open(os.path.join(folder, "data.txt"), "w") as f:
+        f.write(data)
+
+
+def run_session(work_dir: str) -> None:
+    """Drives one session with a local agent storing its state in work_dir,
+    raising a CheckFailed if any step does not behave as expected
+    """
+    folder = os.path.join(work_dir, "scripts")
+    data = "".join(secrets.token_hex(32) + "\n" for _ in range(512))
+    write_script_folder(folder, data)
+    archive = build_archive(folder)
+    bundle_hash = hashlib.sha256(archive).hexdigest()
+
+    session, proc = spawn_local_agent(
+        os.path.join(work_dir, "bundles"), os.path.join(work_dir, "work")
+    )
+    try:
+        expect(session.version is not None, "hello did not record a version")
+
+        sent = session.ensure_bundle(bundle_hash, archive, name="scripts")
+        expect(sent == len(archive), f"first bundle sent {sent} bytes, not in full")
+        sent = session.ensure_bundle(bundle_hash, archive, name="scripts")
+        expect(sent == 0, f"present bundle was sent again ({sent} bytes)")
+
+        output: Dict[str, List[bytes]] = {"stdout": [], "stderr": []}
+        result = session.run(
+            bundle_hash,
+            "bash main.sh",
+            lambda stream, chunk: output[stream].append(chunk),
+            inactivity_timeout=30,
+            deadline=60,
+        )
+        expect(result.exit_status == 0, f"script exited with {result.exit_status}")
+        expect(b"".join(output["stdout"]) == data.encode(), "stdout was not the data")
+        expect(b"".join(output["stderr"]) == b"to stderr\n", "stderr was lost")
+
+        write_script_folder(folder, data + "changed\n")
+        changed_archive = build_archive(folder)
+        changed_hash = hashlib.sha256(changed_archive).hexdigest()
+        sent = session.ensure_bundle(changed_hash, changed_archive, name="scripts")
+        expect(
+            0 < sent < len(changed_archive),
+            f"changed bundle sent {sent} of {len(changed_archive)} bytes, not a delta",
+        )
+        expect(changed_hash in session.hello(), "changed bundle is not present")
+
+        result = session.run(
+            changed_hash, "tail -n 1 data.txt; exit 3", lambda *_: None
+        )
+        expect(result.exit_status == 3, f"failing script exited {result.exit_status}")
+    finally:
+        session.close()
+        status: Optional[int] = None
+        try:
+            status = proc.wait(timeout=10)
+        finally:
+            if status is None:
+                proc.kill()
+                proc.wait()
+    expect(status == 0, f"agent exited with {status} after the session closed")
+
+
+def main(args: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.parse_args(args)
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        run_session(work_dir)
+    except CheckFailed as e:
+        print(f"FAILED {e}")
+        return 1
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
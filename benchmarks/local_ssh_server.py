@@ -0,0 +1,400 @@
+"""Provides an in-process paramiko ssh server which behaves enough like an
+ec2 instance for the remote executor to run against it locally: it accepts
+any public key for ec2-user, supports exec and sftp sessions, and forwards
+direct-tcpip channels so that it can act as the bastion.
+
+Absolute paths under /home/ec2-user, /usr/local/src and /var/lib/ezpbars
+are mapped into a temporary root directory, and sudo is ignored, so that
+no privileges are needed. Latency and bandwidth limits may be injected on
+every connection to approximate a real network.
+"""
+import contextlib
+import os
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+import paramiko
+from paramiko.sftp_server import SFTPServer
+from paramiko.sftp_si import SFTPServerInterface
+from paramiko.sftp_attr import SFTPAttributes
+from paramiko.sftp_handle import SFTPHandle
+
+MAPPED_PREFIXES = (
+    "/home/ec2-user",
+    "/usr/local/src",
+    "/usr/local/lib/ezpbars",
+    "/var/lib/ezpbars",
+)
+"""The absolute remote paths which are mapped into the servers root"""
+
+
+class ThrottledSocket:
+    """Wraps a socket to delay every send by the given latency plus the time
+    it would take to send the data at the given bandwidth, and every receive
+    by the time it would take to receive the data at the given bandwidth,
+    while counting the bytes sent and received
+    """
+
+    def __init__(
+        self,
+        sock: socket.socket,
+        latency: float = 0,
+        bandwidth: Optional[float] = None,
+    ) -> None:
+        self.sock: socket.socket = sock
+        """The wrapped socket"""
+
+        self.latency: float = latency
+        """The delay in seconds added to every send"""
+
+        self.bandwidth: Optional[float] = bandwidth
+        """The bandwidth in bytes per second, or None for unlimited"""
+
+        self.bytes_sent: int = 0
+        """The number of bytes sent by the server over this socket"""
+
+        self.bytes_received: int = 0
+        """The number of bytes received by the server over this socket"""
+
+    def send(self, data: bytes) -> int:
+        delay = self.latency
+        if self.bandwidth:
+            delay += len(data) / self.bandwidth
+        if delay > 0:
+            time.sleep(delay)
+        sent = self.sock.send(data)
+        self.bytes_sent += sent
+        return sent
+
+    def recv(self, size: int) -> bytes:
+        data = self.sock.recv(size)
+        self.bytes_received += len(data)
+        if self.bandwidth and data:
+            time.sleep(len(data) / self.bandwidth)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class LocalSSHServer:
+    """A local ssh server listening on 127.0.0.1 on an ephemeral port"""
+
+    def __init__(
+        self,
+        root: Optional[str] = None,
+        latency: float = 0,
+        bandwidth: Optional[float] = None,
+        host_aliases: Optional[Dict[str, Tuple[str, int]]] = None,
+    ) -> None:
+        """Creates, but does not start, a new local ssh server.
+
+        Args:
+            root (str, None): the directory which remote absolute paths are
+                mapped into, or None for a new temporary directory
+            latency (float): the delay in seconds added to every send
+            bandwidth (float, None): the bandwidth in bytes per second, or
+                None for unlimited
+            host_aliases (dict[str, (str, int)], None): where to forward
+                direct-tcpip channels for the given (host, 22) destinations.
+                This allows a bastion server to forward to another local server
+                using the hosts name as the remote executor would see it.
+        """
+        self.root: str = root if root is not None else tempfile.mkdtemp()
+        """The directory which remote absolute paths are mapped into"""
+
+        self.latency: float = latency
+        """The delay in seconds added to every send"""
+
+        self.bandwidth: Optional[float] = bandwidth
+        """The bandwidth in bytes per second, or None for unlimited"""
+
+        self.host_aliases: Dict[str, Tuple[str, int]] = host_aliases or dict()
+        """Where to forward direct-tcpip channels destined for (host, 22)"""
+
+        self.host_key: paramiko.PKey = paramiko.RSAKey.generate(2048)
+        """The servers host key"""
+
+        self.sockets: List[ThrottledSocket] = []
+        """Every accepted connection, for counting bytes on the wire"""
+
+        self.connections: int = 0
+        """How many connections have been accepted"""
+
+        for prefix in MAPPED_PREFIXES:
+            os.makedirs(self.map_path(prefix), exist_ok=True)
+
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(("127.0.0.1", 0))
+        self._listener.listen(100)
+        self.port: int = self._listener.getsockname()[1]
+        """The port the server is listening on"""
+
+        self._transports: List[paramiko.Transport] = []
+        self._stopped = False
+
+    @property
+    def bytes_on_wire(self) -> int:
+        """The total number of bytes sent and received by the server"""
+        return sum(s.bytes_sent + s.bytes_received for s in self.sockets)
+
+    def map_path(self, path: str) -> str:
+        """Maps the given remote path to the local path within the root"""
+        for prefix in MAPPED_PREFIXES:
+            if path == prefix or path.startswith(prefix + "/"):
+                return self.root + path
+        if path.startswith("/"):
+            return path
+        return os.path.join(self.root + "/home/ec2-user", path)
+
+    def map_command(self, command: str) -> str:
+        """Maps the absolute paths within the given shell command into the
+        root and strips sudo, so that it can be run unprivileged
+        """
+        for prefix in MAPPED_PREFIXES:
+            command = command.replace(prefix, self.root + prefix)
+        return command.replace("sudo ", "")
+
+    def start(self) -> "LocalSSHServer":
+        """Starts accepting connections on a background thread"""
+        threading.Thread(target=self._accept_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        """Stops accepting connections and closes every open transport"""
+        self._stopped = True
+        self._listener.close()
+        for transport in self._transports:
+            transport.close()
+
+    def _accept_forever(self) -> None:
+        while not self._stopped:
+            try:
+                sock, _ = self._listener.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self._serve, args=(sock,), daemon=True).start()
+
+    def _serve(self, sock: socket.socket) -> None:
+        throttled = ThrottledSocket(sock, self.latency, self.bandwidth)
+        self.sockets.append(throttled)
+        transport = paramiko.Transport(throttled)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler("sftp", SFTPServer, _LocalSFTPServerInterface)
+        self._transports.append(transport)
+        try:
+            transport.start_server(server=_LocalServerInterface(self, transport))
+        except (paramiko.SSHException, EOFError, OSError):
+            # eg., tcp probes, which connect and immediately disconnect
+            transport.close()
+
+
+class _LocalServerInterface(paramiko.ServerInterface):
+    def __init__(self, server: LocalSSHServer, transport: paramiko.Transport):
+        self.server = server
+        self.transport = transport
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        if username == "ec2-user":
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        command = self.server.map_command(command.decode("utf-8"))
+        threading.Thread(target=self._run, args=(channel, command), daemon=True).start()
+        return True
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        target = self.server.host_aliases.get(destination[0], destination)
+        try:
+            sock = socket.create_connection(target, timeout=5)
+        except OSError:
+            return paramiko.OPEN_FAILED_CONNECT_FAILED
+        threading.Thread(target=self._forward, args=(chanid, sock), daemon=True).start()
+        return paramiko.OPEN_SUCCEEDED
+
+    def _run(self, channel: paramiko.Channel, command: str) -> None:
+        proc = subprocess.Popen(
+            ["bash", "-c", command],
+            cwd=self.server.map_path("/home/ec2-user"),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
+
+        def pump_stdin():
+            with contextlib.suppress(OSError):
+                while data := channel.recv(32768):
+                    proc.stdin.write(data)
+                    proc.stdin.flush()
+            with contextlib.suppress(OSError):
+                proc.stdin.close()
+
+        threading.Thread(target=pump_stdin, daemon=True).start()
+
+        def pump_stderr():
+            with contextlib.suppress(OSError):
+                while data := proc.stderr.read1(32768):
+                    channel.sendall_stderr(data)
+
+        stderr_thread = threading.Thread(target=pump_stderr, daemon=True)
+        stderr_thread.start()
+        # the client may close the channel early, eg., when it times out
+        with contextlib.suppress(OSError):
+            while data := proc.stdout.read1(32768):
+                channel.sendall(data)
+        stderr_thread.join()
+        with contextlib.suppress(OSError):
+            channel.send_exit_status(proc.wait())
+        channel.close()
+
+    def _forward(self, chanid: int, sock: socket.socket) -> None:
+        # the channel is only usable once the transport has confirmed it to
+        # the client, which is right before it is queued for accept
+        deadline = time.monotonic() + 5
+        channel = None
+        while channel is None and time.monotonic() < deadline:
+            with self.transport.lock:
+                for queued in self.transport.server_accepts:
+                    if queued.get_id() == chanid:
+                        channel = queued
+                        self.transport.server_accepts.remove(queued)
+                        break
+            if channel is None:
+                time.sleep(0.001)
+        if channel is None:
+            sock.close()
+            return
+
+        def pump(source_recv, dest_sendall, on_done):
+            try:
+                while data := source_recv(32768):
+                    dest_sendall(data)
+            except OSError:
+                pass
+            on_done()
+
+        threading.Thread(
+            target=pump, args=(sock.recv, channel.sendall, channel.close), daemon=True
+        ).start()
+        pump(channel.recv, sock.sendall, sock.close)
+
+
+class _LocalSFTPHandle(SFTPHandle):
+    def __init__(self, flags: int, server: LocalSSHServer) -> None:
+        super().__init__(flags)
+        self.open_flags = flags
+        self.server = server
+
+    def close(self):
+        super().close()
+        # uploaded shell scripts reference absolute remote paths, which we
+        # map the same way as commands
+        if self.filename.endswith(".sh") and self.open_flags & (
+            os.O_WRONLY | os.O_RDWR
+        ):
+            with open(self.filename) as f:
+                contents = f.read()
+            with open(self.filename, "w") as f:
+                f.write(self.server.map_command(contents))
+
+    def stat(self):
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        return paramiko.SFTP_OK
+
+
+class _LocalSFTPServerInterface(SFTPServerInterface):
+    def __init__(self, server_interface: _LocalServerInterface, *args, **kwargs):
+        super().__init__(server_interface, *args, **kwargs)
+        self.server = server_interface.server
+
+    def _path(self, path: str) -> str:
+        return self.server.map_path(path)
+
+    def list_folder(self, path):
+        path = self._path(path)
+        result = []
+        for name in os.listdir(path):
+            attr = SFTPAttributes.from_stat(os.stat(os.path.join(path, name)))
+            attr.filename = name
+            result.append(attr)
+        return result
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        path = self._path(path)
+        try:
+            fd = os.open(path, flags, 0o666)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        f = os.fdopen(fd, mode)
+        handle = _LocalSFTPHandle(flags, self.server)
+        handle.filename = path
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self._path(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self._path(oldpath), self._path(newpath))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._path(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(self._path(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            if attr.st_mode is not None:
+                os.chmod(self._path(path), attr.st_mode)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
@@ -0,0 +1,484 @@
+"""Benchmarks how long the pulumi program in __main__.py takes to evaluate,
+which bounds the latency of every preview and up, by building the whole
+stack offline with pulumi.runtime.set_mocks.
+
+Each class defined by the programs modules (VirtualPrivateCloud, Webapp,
+etc.) is instrumented, so that the report includes, per component method,
+the time spent constructing it (inclusive of nested components), the
+resources it registered and the apply callbacks it registered. Every apply
+callback is also timed by name, e.g., WebappEnvironment.render.<locals>.<lambda> or
+get_upstreams.<locals>.make_upstream, along with the time to import the
+programs modules and the total number of resources by type.
+
+Run from the repository root, eg.,
+
+    python -m benchmarks.program_evaluation_benchmark --iterations 5 \\
+        --output program.json
+
+and compare against a previous run to catch regressions:
+
+    python -m benchmarks.program_evaluation_benchmark --baseline program.json
+
+which exits with a non-zero status if any time or count grew by more than
+--max-regression. Key files which are missing are replaced by throwaway
+ones, so this can run in CI.
+"""
+import argparse
+import asyncio
+import collections
+import functools
+import importlib
+import inspect
+import json
+import os
+import runpy
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import pulumi
+import pulumi.dynamic
+import pulumi.runtime.stack
+
+PROGRAM_MODULES = [
+    "key",
+    "vpc",
+    "ami",
+    "environment",
+    "golden_image",
+    "user_data",
+    "rqlite",
+    "redis",
+    "webapp",
+    "reverse_proxy",
+    "tls",
+    "cognito",
+    "remote_executor",
+    "multi_remote_executor",
+]
+"""The modules the program imports, whose classes are instrumented"""
+
+PROGRAM_RUN_NAME = "__pulumi_program__"
+"""The module name __main__.py is evaluated as"""
+
+DEFAULT_PROJECT = "infrastructure"
+"""The project the program is evaluated as, which namespaces its config"""
+
+DEFAULT_CONFIG: Dict[str, str] = {
+    "github_username": "octocat",
+    "github_pat": "ghp_mock",
+    "domain": "example.com",
+    "deployment_secret": "mock",
+    "slack_web_errors_url": "https://hooks.slack.com/mock",
+    "slack_ops_url": "https://hooks.slack.com/mock",
+    "google_oidc_client_id": "mock.apps.googleusercontent.com",
+    "google_oidc_client_secret": "mock",
+}
+"""The config the program is evaluated with, unqualified by the project"""
+
+KEY_FILES = ("key.pub", "key.openssh")
+"""The key files the program reads, relative to the repository root"""
+
+MIN_SECONDS = 0.01
+"""Times below this are too noisy to be considered regressions"""
+
+
+class ProgramMocks(pulumi.runtime.Mocks):
+    """Answers resource registrations and invokes with plausible outputs, so
+    that every apply chain in the program resolves
+    """
+
+    def __init__(self) -> None:
+        self.resources: Dict[str, int] = collections.Counter()
+        """How many resources of each type were registered"""
+
+        self.invokes: Dict[str, int] = collections.Counter()
+        """How many times each function was invoked"""
+
+    def new_resource(self, args: pulumi.runtime.MockResourceArgs) -> Tuple[str, dict]:
+        self.resources[args.typ] += 1
+        idx = sum(self.resources.values())
+        outputs = dict(args.inputs)
+        outputs.setdefault("arn", f"arn:aws:mock:us-west-2:0:{args.name}")
+        if args.typ == "aws:ec2/instance:Instance":
+            outputs["privateIp"] = f"10.0.{idx // 256}.{idx % 256}"
+            outputs["publicIp"] = f"198.51.100.{idx % 256}"
+        elif args.typ == "aws:acm/certificate:Certificate":
+            domain = args.inputs.get("domainName", "example.com")
+            outputs["domainValidationOptions"] = [
+                {
+                    "domainName": name,
+                    "resourceRecordName": f"_mock.{name}.",
+                    "resourceRecordType": "CNAME",
+                    "resourceRecordValue": f"_mock.{name}.acm-validations.aws.",
+                }
+                for name in [domain]
+                + list(args.inputs.get("subjectAlternativeNames", []))
+            ]
+        elif args.typ == "aws:lb/loadBalancer:LoadBalancer":
+            outputs["dnsName"] = f"{args.name}.us-west-2.elb.amazonaws.com"
+            outputs["zoneId"] = "ZMOCKELB"
+            outputs["arnSuffix"] = f"app/{args.name}/0"
+        elif args.typ == "aws:lb/targetGroup:TargetGroup":
+            outputs["arnSuffix"] = f"targetgroup/{args.name}/0"
+        elif args.typ == "aws:ec2/launchTemplate:LaunchTemplate":
+            outputs["latestVersion"] = 1
+        elif args.typ == "aws:ssm/parameter:Parameter":
+            outputs.setdefault("name", args.name)
+            outputs["version"] = 1
+        return f"{args.name}-id", outputs
+
+    def call(self, args: pulumi.runtime.MockCallArgs) -> dict:
+        self.invokes[args.token] += 1
+        if args.token == "aws:ec2/getAmi:getAmi":
+            filters = dict(
+                (f["name"], f["values"][0]) for f in args.args.get("filters", [])
+            )
+            return {
+                "id": f"ami-mock{self.invokes[args.token]}",
+                "name": filters.get("name"),
+                "architecture": filters.get("architecture"),
+                "creationDate": "2022-01-01T00:00:00.000Z",
+            }
+        if args.token == "aws:route53/getZone:getZone":
+            return {
+                "id": "ZMOCK",
+                "zoneId": "ZMOCK",
+                "name": args.args.get("name"),
+            }
+        return {"id": f"{args.token}-mock"}
+
+
+class Profile:
+    """Accumulates the measurements of one evaluation of the program"""
+
+    def __init__(self) -> None:
+        self.active: List[str] = []
+        """The labels of the instrumented methods currently running, innermost
+        last"""
+
+        self.components: Dict[str, Dict[str, float]] = collections.defaultdict(
+            lambda: {"calls": 0, "seconds": 0.0, "resources": 0, "applies": 0}
+        )
+        """The measurements of each instrumented method, by label"""
+
+        self.apply_callbacks: Dict[str, Dict[str, float]] = collections.defaultdict(
+            lambda: {"calls": 0, "seconds": 0.0}
+        )
+        """How often each apply callback ran and for how long, by name"""
+
+    def current(self) -> str:
+        """The label resources and applies are currently attributed to"""
+        return self.active[-1] if self.active else "__main__"
+
+    def instrument_method(self, label: str, method: Callable) -> Callable:
+        """Wraps the given method so its calls are measured under label"""
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            self.active.append(label)
+            started_at = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.components[label]["seconds"] += time.perf_counter() - started_at
+                self.components[label]["calls"] += 1
+                self.active.pop()
+
+        return wrapper
+
+    def instrument_module(self, module: Any) -> None:
+        """Instruments every public method (and __init__) of every class
+        defined by the given module
+        """
+        for class_name, cls in inspect.getmembers(module, inspect.isclass):
+            if cls.__module__ != module.__name__:
+                continue
+            # resources and providers are serialized by pulumi, so are left as is
+            if issubclass(
+                cls,
+                (pulumi.Resource, pulumi.dynamic.ResourceProvider, BaseException),
+            ):
+                continue
+            for name, method in list(vars(cls).items()):
+                if not inspect.isfunction(method):
+                    continue
+                if name.startswith("_") and name != "__init__":
+                    continue
+                setattr(
+                    cls,
+                    name,
+                    self.instrument_method(f"{class_name}.{name}", method),
+                )
+
+    def instrument_pulumi(self) -> None:
+        """Attributes every resource, and every apply registered by the
+        program, to the innermost running instrumented method, and times
+        those apply callbacks
+        """
+        profile = self
+        program_modules = set(PROGRAM_MODULES) | {PROGRAM_RUN_NAME}
+        original_init = pulumi.Resource.__init__
+        original_apply = pulumi.Output.apply
+
+        def resource_init(resource, *args, **kwargs):
+            profile.components[profile.current()]["resources"] += 1
+            return original_init(resource, *args, **kwargs)
+
+        def apply(output, func, run_with_unknowns=False):
+            # applies made by pulumi itself are not the programs concern
+            if getattr(func, "__module__", None) not in program_modules:
+                return original_apply(output, func, run_with_unknowns)
+
+            profile.components[profile.current()]["applies"] += 1
+            name = getattr(func, "__qualname__", repr(func))
+
+            def timed(*args, **kwargs):
+                started_at = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    callback = profile.apply_callbacks[name]
+                    callback["seconds"] += time.perf_counter() - started_at
+                    callback["calls"] += 1
+
+            return original_apply(output, timed, run_with_unknowns)
+
+        pulumi.Resource.__init__ = resource_init
+        pulumi.Output.apply = apply
+
+
+def prepare_work_dir(repo_root: str) -> str:
+    """Returns a temporary directory which mirrors the repository root via
+    symlinks, with throwaway key files for any which are missing
+    """
+    work_dir = tempfile.mkdtemp()
+    for name in os.listdir(repo_root):
+        os.symlink(os.path.join(repo_root, name), os.path.join(work_dir, name))
+    for name in KEY_FILES:
+        if not os.path.exists(os.path.join(work_dir, name)):
+            with open(os.path.join(work_dir, name), "w") as f:
+                f.write("ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIMock mock@localhost\n")
+    return work_dir
+
+
+def evaluate_program(
+    repo_root: str, project: str, stack: str, config: Dict[str, str]
+) -> Dict[str, Any]:
+    """Evaluates the program once, in this process, against mocks and
+    returns the measurements
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    mocks = ProgramMocks()
+    pulumi.runtime.set_mocks(mocks, project=project, stack=stack, preview=True)
+    pulumi.runtime.set_all_config(
+        dict((f"{project}:{key}", value) for key, value in config.items())
+    )
+
+    profile = Profile()
+    profile.instrument_pulumi()
+
+    work_dir = prepare_work_dir(repo_root)
+    os.chdir(work_dir)
+    sys.path.insert(0, work_dir)
+    try:
+        started_at = time.perf_counter()
+        import_seconds: Dict[str, float] = dict()
+        for module_name in PROGRAM_MODULES:
+            module_started_at = time.perf_counter()
+            module = importlib.import_module(module_name)
+            import_seconds[module_name] = time.perf_counter() - module_started_at
+            profile.instrument_module(module)
+        # keep the repos digest cache out of the temporary copy
+        importlib.import_module("script_hash").DIRECTORY_HASHER.configure(
+            cache_path=None
+        )
+        imported_at = time.perf_counter()
+
+        runpy.run_path(os.path.join(work_dir, "__main__.py"), run_name=PROGRAM_RUN_NAME)
+        constructed_at = time.perf_counter()
+        loop.run_until_complete(pulumi.runtime.stack.wait_for_rpcs())
+        finished_at = time.perf_counter()
+    finally:
+        os.chdir(repo_root)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "imports_seconds": imported_at - started_at,
+        "imports": import_seconds,
+        "construct_seconds": constructed_at - imported_at,
+        "resolve_seconds": finished_at - constructed_at,
+        "total_seconds": finished_at - started_at,
+        "resources": sum(mocks.resources.values()),
+        "resources_by_type": dict(sorted(mocks.resources.items())),
+        "invokes": dict(sorted(mocks.invokes.items())),
+        "components": dict(sorted(profile.components.items())),
+        "apply_callbacks": dict(sorted(profile.apply_callbacks.items())),
+    }
+
+
+def summarize(runs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Combines several evaluations, taking the median of every time and
+    the counts of the first run (which are deterministic)
+    """
+
+    def median_of(get: Callable[[Dict[str, Any]], float]) -> float:
+        values = []
+        for run in runs:
+            try:
+                values.append(get(run))
+            except KeyError:
+                pass
+        return statistics.median(values) if values else 0.0
+
+    result = json.loads(json.dumps(runs[0]))
+    for key in ("imports_seconds", "construct_seconds", "resolve_seconds"):
+        result[key] = median_of(lambda run: run[key])
+    result["total_seconds"] = median_of(lambda run: run["total_seconds"])
+    for name in result["imports"]:
+        result["imports"][name] = median_of(lambda run: run["imports"][name])
+    for section in ("components", "apply_callbacks"):
+        for name, values in result[section].items():
+            values["seconds"] = median_of(lambda run: run[section][name]["seconds"])
+    result["iterations"] = len(runs)
+    return result
+
+
+def flatten_metrics(result: Dict[str, Any]) -> Dict[str, float]:
+    """Returns every time and count which is compared against a baseline,
+    keyed by a descriptive name
+    """
+    metrics: Dict[str, float] = {
+        "total_seconds": result["total_seconds"],
+        "imports_seconds": result["imports_seconds"],
+        "construct_seconds": result["construct_seconds"],
+        "resolve_seconds": result["resolve_seconds"],
+        "resources": result["resources"],
+    }
+    for name, values in result["components"].items():
+        for metric in ("seconds", "resources", "applies"):
+            metrics[f"{name} {metric}"] = values[metric]
+    for name, values in result["apply_callbacks"].items():
+        metrics[f"apply {name} seconds"] = values["seconds"]
+        metrics[f"apply {name} calls"] = values["calls"]
+    return metrics
+
+
+def find_regressions(
+    result: Dict[str, Any], baseline: Dict[str, Any], max_regression: float
+) -> List[str]:
+    """Returns a description of every time or count which grew by more than
+    max_regression (a fraction) relative to the baseline. Times below
+    MIN_SECONDS in both are ignored as noise, as are metrics which are new.
+    """
+    current = flatten_metrics(result)
+    previous = flatten_metrics(baseline)
+    regressions = []
+    for name, value in current.items():
+        if name not in previous:
+            continue
+        if name.endswith("seconds") and max(value, previous[name]) < MIN_SECONDS:
+            continue
+        if value > previous[name] * (1 + max_regression):
+            regressions.append(f"{name}: {previous[name]:.4g} -> {value:.4g}")
+    return regressions
+
+
+def print_report(result: Dict[str, Any]) -> None:
+    """Prints a human readable summary of the given result"""
+    print(
+        "total {:.3f}s (imports {:.3f}s, construct {:.3f}s, resolve {:.3f}s),"
+        " {} resources".format(
+            result["total_seconds"],
+            result["imports_seconds"],
+            result["construct_seconds"],
+            result["resolve_seconds"],
+            result["resources"],
+        )
+    )
+    print(
+        f"{'component':<48} {'calls':>5} {'seconds':>8} {'resources':>9} {'applies':>7}"
+    )
+    for name, values in sorted(
+        result["components"].items(), key=lambda item: -item[1]["seconds"]
+    ):
+        print(
+            f"{name:<48} {int(values['calls']):>5} {values['seconds']:>8.3f}"
+            f" {int(values['resources']):>9} {int(values['applies']):>7}"
+        )
+    print(f"{'apply callback':<48} {'calls':>5} {'seconds':>8}")
+    for name, values in sorted(
+        result["apply_callbacks"].items(), key=lambda item: -item[1]["seconds"]
+    )[:20]:
+        print(f"{name:<48} {int(values['calls']):>5} {values['seconds']:>8.3f}")
+
+
+def main(args: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--iterations", type=int, default=3)
+    parser.add_argument("--project", default=DEFAULT_PROJECT)
+    parser.add_argument("--stack", default="benchmark")
+    parser.add_argument(
+        "--config",
+        nargs="*",
+        default=[],
+        help="additional config as key=value, e.g., rqlite_id_offset=3",
+    )
+    parser.add_argument("--output", help="write the results as json to this path")
+    parser.add_argument("--baseline", help="compare against results from this path")
+    parser.add_argument("--max-regression", type=float, default=0.25)
+    parser.add_argument("--single-run", help=argparse.SUPPRESS)
+    parsed = parser.parse_args(args)
+
+    repo_root = os.getcwd()
+    config = dict(DEFAULT_CONFIG)
+    for item in parsed.config:
+        key, _, value = item.partition("=")
+        config[key] = value
+
+    if parsed.single_run is not None:
+        # every evaluation needs a fresh process, as the program registers
+        # resources as a side effect of importing it
+        result = evaluate_program(repo_root, parsed.project, parsed.stack, config)
+        with open(parsed.single_run, "w") as f:
+            json.dump(result, f)
+        return 0
+
+    runs = []
+    with tempfile.TemporaryDirectory() as results_dir:
+        for iteration in range(max(parsed.iterations, 1)):
+            result_path = os.path.join(results_dir, f"{iteration}.json")
+            subprocess.run(
+                [sys.executable, "-m", "benchmarks.program_evaluation_benchmark"]
+                + ["--single-run", result_path]
+                + ["--project", parsed.project, "--stack", parsed.stack]
+                + (["--config", *parsed.config] if parsed.config else []),
+                check=True,
+            )
+            with open(result_path) as f:
+                runs.append(json.load(f))
+    result = summarize(runs)
+    print_report(result)
+
+    if parsed.output is not None:
+        with open(parsed.output, "w") as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+    if parsed.baseline is not None:
+        with open(parsed.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(result, baseline, parsed.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,291 @@
+"""Benchmarks the RemoteExecutionProvider against local in-process ssh servers
+acting as the bastion and the target, so that changes to how scripts are
+rendered, transferred and executed can be measured without deploying.
+
+For each synthetic script folder (of varying file count and size), transfer
+mode and jump mode, this repeatedly creates and then deletes an execution,
+reporting the p50/p95 wall time of each, the bytes on the wire per create and
+the peak RSS of the process (which includes the local servers).
+
+Run from the repository root, eg.,
+
+    python -m benchmarks.remote_executor_benchmark --iterations 20 \\
+        --latency 0.02 --bandwidth 1000000 --output bench.json
+
+and compare against a previous run to catch regressions before deploying:
+
+    python -m benchmarks.remote_executor_benchmark --baseline bench.json
+
+which exits with a non-zero status if any p95 or the bytes on the wire grew by
+more than --max-regression.
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import secrets
+import shutil
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+import paramiko
+from agent_client import AGENT_REMOTE_PATH, AGENT_SOURCE_PATH
+from benchmarks.local_ssh_server import LocalSSHServer
+from remote_executor import RemoteExecutionProvider
+from script_hash import DIRECTORY_HASHER
+from ssh_pool import SSH_POOL
+
+FOLDER_SIZES: Dict[str, Tuple[int, int]] = {
+    "small": (5, 1024),
+    "medium": (50, 10 * 1024),
+    "large": (200, 50 * 1024),
+}
+"""The synthetic script folders, by name, as (number of files, bytes per file)"""
+
+ECHO_MAX_BYTES = 1024 * 1024
+"""The echo transfer mode sends every line as its own command, which takes
+tens of seconds per create for the large folder, so by default it is only
+benchmarked for folders up to this many bytes (see --echo-max-bytes)"""
+
+
+def make_script_folder(root: str, num_files: int, file_size: int) -> str:
+    """Writes a synthetic script folder within root with a main.sh which
+    uses a substitution, a delete.sh, and num_files text files of file_size
+    bytes each, returning the path to the folder
+    """
+    folder = os.path.join(root, f"scripts-{num_files}-{file_size}")
+    os.makedirs(os.path.join(folder, "data"))
+    with open(os.path.join(folder, "main.sh"), "w") as f:
+        f.write('#!/usr/bin/env bash\necho "created {{NAME}}"\nls data | wc -l\n')
+    with open(os.path.join(folder, "delete.sh"), "w") as f:
+        f.write('#!/usr/bin/env bash\necho "deleted"\n')
+    for idx in range(num_files):
+        # hex is a reasonable stand in for config files, as it compresses
+        # roughly as well
+        line = secrets.token_hex(32) + "\n"
+        contents = (line * (file_size // len(line) + 1))[:file_size]
+        with open(os.path.join(folder, "data", f"file-{idx}.txt"), "w") as f:
+            f.write(contents)
+    return folder
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Returns the nearest-rank percentile p (0-100) of the given values"""
+    ordered = sorted(values)
+    rank = max(int(round(p / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def get_peak_rss_kb() -> int:
+    """Returns the peak resident set size of this process in kilobytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macos reports bytes, linux reports kilobytes
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def run_scenario(
+    provider: RemoteExecutionProvider,
+    servers: List[LocalSSHServer],
+    script_name: str,
+    host: str,
+    private_key: str,
+    bastion: Optional[str],
+    transfer_mode: str,
+    iterations: int,
+    warm: bool,
+    fresh_connections: bool,
+) -> Dict[str, float]:
+    """Creates and deletes an execution iterations times, returning the
+    summarized measurements. Unless warm, every create has a unique
+    substitution so the bundle cache is never hit.
+    """
+    create_times: List[float] = []
+    delete_times: List[float] = []
+    bytes_per_create: List[int] = []
+    for _ in range(iterations):
+        if fresh_connections:
+            SSH_POOL.close_all()
+
+        inputs = {
+            "script_name": script_name,
+            "file_substitutions": {
+                "main.sh": {"NAME": "warm" if warm else f"cold-{secrets.token_hex(8)}"}
+            },
+            "host": host,
+            "private_key": private_key,
+            "bastion": bastion,
+            "transfer_mode": transfer_mode,
+            "trace_directory": "",
+        }
+
+        bytes_before = sum(server.bytes_on_wire for server in servers)
+        started_at = time.perf_counter()
+        result = provider.create(inputs)
+        create_times.append(time.perf_counter() - started_at)
+        bytes_per_create.append(
+            sum(server.bytes_on_wire for server in servers) - bytes_before
+        )
+
+        started_at = time.perf_counter()
+        provider.delete(result.id, result.outs)
+        delete_times.append(time.perf_counter() - started_at)
+
+    return {
+        "create_p50": percentile(create_times, 50),
+        "create_p95": percentile(create_times, 95),
+        "delete_p50": percentile(delete_times, 50),
+        "delete_p95": percentile(delete_times, 95),
+        "bytes_per_create": percentile(bytes_per_create, 50),
+        "peak_rss_kb": get_peak_rss_kb(),
+    }
+
+
+def find_regressions(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    max_regression: float,
+) -> List[str]:
+    """Returns a description of every p95 or bytes on the wire which grew by
+    more than max_regression (a fraction) relative to the baseline, for the
+    scenarios in both
+    """
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        for metric in ("create_p95", "delete_p95", "bytes_per_create"):
+            if metric not in previous or previous[metric] <= 0:
+                continue
+            if result[metric] > previous[metric] * (1 + max_regression):
+                regressions.append(
+                    f"{name} {metric}: {previous[metric]:.4g} -> {result[metric]:.4g}"
+                )
+    return regressions
+
+
+def main(args: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument(
+        "--latency", type=float, default=0, help="seconds added to every send"
+    )
+    parser.add_argument(
+        "--bandwidth", type=float, default=None, help="bytes per second"
+    )
+    parser.add_argument(
+        "--sizes", nargs="+", default=list(FOLDER_SIZES), choices=list(FOLDER_SIZES)
+    )
+    parser.add_argument(
+        "--transfer-modes", nargs="+", default=["archive", "echo", "agent"]
+    )
+    parser.add_argument(
+        "--echo-max-bytes",
+        type=int,
+        default=ECHO_MAX_BYTES,
+        help="skip the echo transfer mode for larger folders",
+    )
+    parser.add_argument(
+        "--jump-modes",
+        nargs="+",
+        default=["direct", "tunnel"],
+        choices=["direct", "tunnel"],
+    )
+    parser.add_argument(
+        "--fresh-connections",
+        action="store_true",
+        help="close pooled connections before every create",
+    )
+    parser.add_argument("--output", help="write the results as json to this path")
+    parser.add_argument("--baseline", help="compare against results from this path")
+    parser.add_argument("--max-regression", type=float, default=0.25)
+    parsed = parser.parse_args(args)
+
+    # the tcp probes disconnect before the ssh banner, which paramiko logs
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+    # the script folders are temporary, so their digests are not worth keeping
+    DIRECTORY_HASHER.configure(cache_path=None)
+
+    work_dir = tempfile.mkdtemp()
+    private_key = os.path.join(work_dir, "key")
+    paramiko.RSAKey.generate(2048).write_private_key_file(private_key)
+
+    target = LocalSSHServer(latency=parsed.latency, bandwidth=parsed.bandwidth)
+    bastion = LocalSSHServer(latency=parsed.latency, bandwidth=parsed.bandwidth)
+    servers = [target.start(), bastion.start()]
+    # as if wait_boot_finished.sh had already installed the agent
+    agent_path = target.map_path(AGENT_REMOTE_PATH)
+    os.makedirs(os.path.dirname(agent_path), exist_ok=True)
+    shutil.copy(AGENT_SOURCE_PATH, agent_path)
+    provider = RemoteExecutionProvider()
+
+    results: Dict[str, Dict[str, float]] = dict()
+    try:
+        for size in parsed.sizes:
+            num_files, file_size = FOLDER_SIZES[size]
+            script_name = make_script_folder(work_dir, num_files, file_size)
+            for transfer_mode in parsed.transfer_modes:
+                if (
+                    transfer_mode == "echo"
+                    and num_files * file_size > parsed.echo_max_bytes
+                ):
+                    continue
+                for jump_mode in parsed.jump_modes:
+                    for warm in (False, True) if transfer_mode != "echo" else (False,):
+                        name = "-".join(
+                            [size, transfer_mode, jump_mode]
+                            + (["warm"] if warm else [])
+                        )
+                        results[name] = run_scenario(
+                            provider,
+                            servers,
+                            script_name,
+                            f"127.0.0.1:{target.port}",
+                            private_key,
+                            None
+                            if jump_mode == "direct"
+                            else f"127.0.0.1:{bastion.port}",
+                            transfer_mode,
+                            parsed.iterations,
+                            warm,
+                            parsed.fresh_connections,
+                        )
+                        print(
+                            "{:<28} create p50 {:7.3f}s p95 {:7.3f}s  delete p50 {:7.3f}s"
+                            " p95 {:7.3f}s  {:>10,} B/create  peak rss {:,} KB".format(
+                                name,
+                                results[name]["create_p50"],
+                                results[name]["create_p95"],
+                                results[name]["delete_p50"],
+                                results[name]["delete_p95"],
+                                int(results[name]["bytes_per_create"]),
+                                results[name]["peak_rss_kb"],
+                            ),
+                            flush=True,
+                        )
+    finally:
+        SSH_POOL.close_all()
+        for server in servers:
+            server.stop()
+            shutil.rmtree(server.root, ignore_errors=True)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if parsed.output is not None:
+        with open(parsed.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if parsed.baseline is not None:
+        with open(parsed.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, parsed.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
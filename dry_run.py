@@ -0,0 +1,297 @@
+"""Renders remote executions offline, writing exactly what
+RemoteExecutionProvider.execute_remotely would send for a script folder and
+its substitutions to a local directory without connecting to anything, and
+reporting its size, file count, substitution coverage and render time.
+
+This is useful for inspecting generated scripts, and for profiling or
+testing the rendering path (eg., write_echo_commands_for_folder and the
+templates) locally or in CI. Run from the repository root, eg.,
+
+    python dry_run.py setup-scripts/webapp --shared-script-name \\
+        setup-scripts/shared --substitutions subs.json --output rendered \\
+        --repeat 20
+
+where subs.json holds the file substitutions as json, eg.,
+{"config.sh": {"VAR": "value"}}. The report is printed and also written to
+report.json within the output directory, alongside script.sh (the script run
+over ssh), agent.sh (the script the agent runs, in the agent transfer mode),
+uploads/ (the files uploaded via sftp) and bundle/ (the extracted archive).
+"""
+import argparse
+import io
+import json
+import os
+import shutil
+import statistics
+import sys
+import tarfile
+import time
+from typing import Dict, List, Optional, TypedDict
+from remote_executor import (
+    DEFAULT_BUNDLE_CACHE_SIZE,
+    JUMP_MODES,
+    TRANSFER_MODES,
+    RenderedExecution,
+    render_execution,
+)
+from script_hash import list_files
+from templates import UndefinedSubstitutionError, get_substitution_coverage
+
+DRY_RUN_HOST = "203.0.113.1"
+"""The host rendered into scripts by default, which is reserved for
+documentation and hence never reachable"""
+
+
+class RenderReport(TypedDict):
+    """Describes a rendered execution"""
+
+    script_name: str
+    """The path to the script folder which was rendered"""
+
+    transfer_mode: str
+    """How the script folder would be sent to the remote machine"""
+
+    jump_mode: str
+    """How the host would be reached through the bastion, if any"""
+
+    entrypoint: str
+    """The file within the script folder which would be executed"""
+
+    render_seconds: float
+    """How long the first render took, ie., with no templates cached"""
+
+    render_seconds_p50: float
+    """The median time to render over every repetition"""
+
+    repeat: int
+    """How many times the execution was rendered"""
+
+    payload_bytes: int
+    """The total bytes of the script and every upload"""
+
+    script_bytes: int
+    """The size of the script run over ssh"""
+
+    agent_script_bytes: int
+    """The size of the script the agent would run, in the agent transfer mode"""
+
+    uploads: Dict[str, int]
+    """The size of every file uploaded via sftp, keyed by name"""
+
+    agent_bundle_hash: Optional[str]
+    """The hash of the bundle the agent would be sent, in the agent transfer
+    mode"""
+
+    file_count: int
+    """How many files are within the script folders"""
+
+    bundle_bytes: Optional[int]
+    """The total size of the rendered files within the archive, if the
+    transfer mode uses one"""
+
+    substitutions: Dict[str, Dict[str, List[str]]]
+    """The substitution coverage of every file; see get_substitution_coverage"""
+
+    substitution_summary: Dict[str, int]
+    """The number of "referenced", "substituted", "undefined" and "unused"
+    keys over every file"""
+
+
+def dry_run(
+    script_name: str,
+    file_substitutions: Optional[Dict[str, Dict[str, str]]],
+    output_directory: Optional[str] = None,
+    shared_script_name: Optional[str] = None,
+    entrypoint: str = "main.sh",
+    transfer_mode: str = "archive",
+    jump_mode: str = "tunnel",
+    host: str = DRY_RUN_HOST,
+    private_key: str = "",
+    bastion: Optional[str] = None,
+    bundle_cache_size: int = DEFAULT_BUNDLE_CACHE_SIZE,
+    force_steps: Optional[List[str]] = None,
+    clear_steps: Optional[List[str]] = None,
+    repeat: int = 1,
+) -> RenderReport:
+    """Renders the given execution repeat times, as execute_remotely would,
+    and returns the report. If output_directory is specified, the rendered
+    payload and the report are written to it, replacing anything this wrote
+    there before. The private key is only read in the shell jump mode.
+
+    Raises the same errors execute_remotely would before connecting, eg.,
+    an UndefinedSubstitutionError.
+    """
+    durations: List[float] = []
+    rendered: Optional[RenderedExecution] = None
+    for _ in range(max(repeat, 1)):
+        started_at = time.perf_counter()
+        rendered = render_execution(
+            script_name,
+            file_substitutions,
+            host,
+            private_key,
+            bastion,
+            shared_script_name,
+            entrypoint,
+            transfer_mode=transfer_mode,
+            jump_mode=jump_mode,
+            bundle_cache_size=bundle_cache_size,
+            force_steps=force_steps,
+            clear_steps=clear_steps,
+        )
+        durations.append(time.perf_counter() - started_at)
+
+    bundle_bytes = None
+    if rendered.archive_file is not None:
+        archive = rendered.uploads[rendered.archive_file]
+        with tarfile.open(fileobj=io.BytesIO(archive), mode="r:gz") as tar:
+            bundle_bytes = sum(member.size for member in tar.getmembers())
+
+    coverage = get_substitution_coverage(
+        [script_name, shared_script_name], file_substitutions
+    )
+    uploads = dict((name, len(data)) for name, data in rendered.uploads.items())
+    script_bytes = len(rendered.script.encode("utf-8"))
+    report = RenderReport(
+        script_name=script_name,
+        transfer_mode=transfer_mode,
+        jump_mode=jump_mode,
+        entrypoint=entrypoint,
+        render_seconds=durations[0],
+        render_seconds_p50=statistics.median(durations),
+        repeat=len(durations),
+        payload_bytes=script_bytes + sum(uploads.values()),
+        script_bytes=script_bytes,
+        agent_script_bytes=len(rendered.agent_script.encode("utf-8")),
+        uploads=uploads,
+        agent_bundle_hash=rendered.agent_bundle_hash,
+        file_count=sum(
+            len(list_files(dirpath))
+            for dirpath in (script_name, shared_script_name)
+            if dirpath is not None
+        ),
+        bundle_bytes=bundle_bytes,
+        substitutions=coverage,
+        substitution_summary=dict(
+            (kind, sum(len(file_coverage[kind]) for file_coverage in coverage.values()))
+            for kind in ("referenced", "substituted", "undefined", "unused")
+        ),
+    )
+
+    if output_directory is not None:
+        write_rendered_execution(rendered, report, output_directory)
+    return report
+
+
+def write_rendered_execution(
+    rendered: RenderedExecution, report: RenderReport, output_directory: str
+) -> None:
+    """Writes the rendered execution and its report to the given directory,
+    replacing anything previously written there by this function
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    for name in ("uploads", "bundle"):
+        shutil.rmtree(os.path.join(output_directory, name), ignore_errors=True)
+    if os.path.exists(os.path.join(output_directory, "agent.sh")):
+        os.remove(os.path.join(output_directory, "agent.sh"))
+
+    with open(os.path.join(output_directory, "script.sh"), "w") as f:
+        f.write(rendered.script)
+
+    if report["transfer_mode"] == "agent":
+        with open(os.path.join(output_directory, "agent.sh"), "w") as f:
+            f.write(rendered.agent_script)
+
+    if rendered.uploads:
+        os.makedirs(os.path.join(output_directory, "uploads"))
+        for name, data in rendered.uploads.items():
+            with open(os.path.join(output_directory, "uploads", name), "wb") as f:
+                f.write(data)
+
+    if rendered.archive_file is not None:
+        archive = rendered.uploads[rendered.archive_file]
+        with tarfile.open(fileobj=io.BytesIO(archive), mode="r:gz") as tar:
+            tar.extractall(os.path.join(output_directory, "bundle"))
+
+    with open(os.path.join(output_directory, "report.json"), "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+def main(args: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("script_name", help="the script folder to render")
+    parser.add_argument("--shared-script-name", default=None)
+    parser.add_argument(
+        "--substitutions",
+        default=None,
+        help="a json file with the file substitutions, or - for stdin",
+    )
+    parser.add_argument("--output", default=None, help="the directory to write to")
+    parser.add_argument("--entrypoint", default="main.sh")
+    parser.add_argument("--transfer-mode", default="archive", choices=TRANSFER_MODES)
+    parser.add_argument("--jump-mode", default="tunnel", choices=JUMP_MODES)
+    parser.add_argument("--host", default=DRY_RUN_HOST)
+    parser.add_argument("--bastion", default=None)
+    parser.add_argument(
+        "--private-key", default="", help="required for the shell jump mode"
+    )
+    parser.add_argument(
+        "--bundle-cache-size", type=int, default=DEFAULT_BUNDLE_CACHE_SIZE
+    )
+    parser.add_argument("--force-steps", nargs="*", default=None)
+    parser.add_argument("--clear-steps", nargs="*", default=None)
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="how many times to render, for timing"
+    )
+    parsed = parser.parse_args(args)
+
+    if parsed.bastion is not None and parsed.jump_mode == "shell":
+        if not parsed.private_key:
+            parser.error("--private-key is required for the shell jump mode")
+
+    file_substitutions = None
+    if parsed.substitutions == "-":
+        file_substitutions = json.load(sys.stdin)
+    elif parsed.substitutions is not None:
+        with open(parsed.substitutions) as f:
+            file_substitutions = json.load(f)
+
+    try:
+        report = dry_run(
+            parsed.script_name,
+            file_substitutions,
+            output_directory=parsed.output,
+            shared_script_name=parsed.shared_script_name,
+            entrypoint=parsed.entrypoint,
+            transfer_mode=parsed.transfer_mode,
+            jump_mode=parsed.jump_mode,
+            host=parsed.host,
+            private_key=parsed.private_key,
+            bastion=parsed.bastion,
+            bundle_cache_size=parsed.bundle_cache_size,
+            force_steps=parsed.force_steps,
+            clear_steps=parsed.clear_steps,
+            repeat=parsed.repeat,
+        )
+    except UndefinedSubstitutionError as e:
+        print(e, file=sys.stderr)
+        json.dump(
+            {
+                "substitutions": get_substitution_coverage(
+                    [parsed.script_name, parsed.shared_script_name],
+                    file_substitutions,
+                )
+            },
+            sys.stdout,
+            indent=2,
+            sort_keys=True,
+        )
+        print()
+        return 1
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
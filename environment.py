@@ -0,0 +1,53 @@
+"""Builds the shell configuration of each webapp from a shared set of named
+environment variables. Each webapp only receives the variables it declares,
+in sorted order, so a change to one variable (eg., the ip of a redis
+instance) only changes the configuration, and hence redeploys, the webapps
+which consume it.
+"""
+from typing import Dict, Iterable, List, Optional, Sequence
+import pulumi
+
+
+class WebappEnvironment:
+    """The environment variables available to webapps, keyed by name"""
+
+    def __init__(self) -> None:
+        self.variables: Dict[str, pulumi.Output[str]] = dict()
+        """The value of each variable, keyed by name"""
+
+    def set(self, name: str, value: pulumi.Input[str]) -> None:
+        """Sets the variable with the given name to the given value"""
+        self.variables[name] = pulumi.Output.from_input(value)
+
+    def set_joined(
+        self, name: str, values: Sequence[pulumi.Input[str]], separator: str = ","
+    ) -> None:
+        """Sets the variable with the given name to the given values joined
+        by the separator, eg., a comma-separated list of ips
+        """
+        self.variables[name] = pulumi.Output.all(*values).apply(
+            lambda resolved: separator.join(resolved)
+        )
+
+    def render(self, names: Optional[Iterable[str]] = None) -> pulumi.Output[str]:
+        """Renders the variables with the given names, or every variable if
+        no names are specified, as a series of export commands sorted by name.
+        Only the given variables are waited on, and the result is only secret
+        if one of them is.
+
+        Raises a KeyError if any of the given variables are not set.
+        """
+        if names is None:
+            names = self.variables.keys()
+        sorted_names: List[str] = sorted(set(names))
+        missing = [name for name in sorted_names if name not in self.variables]
+        if missing:
+            raise KeyError(f"environment variables not set: {', '.join(missing)}")
+
+        return pulumi.Output.all(
+            *[self.variables[name] for name in sorted_names]
+        ).apply(
+            lambda values: "\n".join(
+                f'export {name}="{value}"' for name, value in zip(sorted_names, values)
+            )
+        )
@@ -0,0 +1,208 @@
+"""Bakes the slow, instance-independent provisioning of a role (updating the
+system, installing python and the agent, and the roles own installs such as
+nginx, redis or rqlite) into an amazon machine image, so that instances
+launched from it skip straight to configuring themselves.
+
+The bake runs the same steps (see setup-scripts/shared/steps.sh and
+setup-scripts/shared/roles.sh) as the roles main.sh, so the step markers are
+part of the image and the roles scripts skip whatever was baked without
+needing to know about images at all.
+"""
+from typing import Dict, Optional
+import pulumi
+import pulumi_aws as aws
+from pulumi import ResourceOptions
+from ami import ResolvedAmi, resolve_ami
+from remote_executor import (
+    RemoteExecution,
+    RemoteExecutionInputs,
+    hash_script_folders,
+)
+from vpc import VirtualPrivateCloud
+
+ROLES = ("webapp", "rqlite", "redis", "reverse-proxy")
+"""The roles which can be baked, see setup-scripts/golden-image/main.sh"""
+
+BAKE_SCRIPT_NAME = "setup-scripts/golden-image"
+"""The script folder which bakes a role into the builder instance"""
+
+BAKE_SHARED_SCRIPT_NAME = "setup-scripts/shared"
+"""The shared script folder uploaded alongside the bake, which holds the
+steps of every role"""
+
+DEFAULT_BUILDER_INSTANCE_TYPES: Dict[str, str] = {
+    "arm64": "t4g.small",
+    "x86_64": "t3a.small",
+}
+"""The instance type used to bake an image, by architecture"""
+
+
+class GoldenImage:
+    """An amazon machine image with a role baked in, built from a builder
+    instance which is stopped once it has been imaged. Whenever the bake
+    (the bake script folder or the shared scripts) or the base image
+    changes, the builder is replaced and the image is baked again from
+    scratch.
+    """
+
+    def __init__(
+        self,
+        resource_name: str,
+        vpc: VirtualPrivateCloud,
+        role: str,
+        architecture: str = "arm64",
+        base_ami: Optional[ResolvedAmi] = None,
+        instance_type: Optional[str] = None,
+        volume_size: Optional[int] = None,
+    ) -> None:
+        """Bakes the given role into a new image, using a builder instance
+        in the first private subnet of the given virtual private cloud.
+
+        Args:
+            resource_name (str): the resource name prefix to use for resources
+                created by this instance
+            vpc (VirtualPrivateCloud): the virtual private cloud to build the
+                image within
+            role (str): which role to bake, one of ROLES
+            architecture (str): the architecture of the image
+            base_ami (ResolvedAmi, None): the image to bake the role into, which
+                must match the architecture. None for the latest amazon linux 2
+            instance_type (str, None): the instance type to bake the image on,
+                or None for the default for the architecture
+            volume_size (int, None): the size of the images root volume in GiB,
+                which instances launched from it can not go below, or None for
+                the size of the base image
+        """
+        if role not in ROLES:
+            raise ValueError(f"{role=} must be one of {ROLES}")
+
+        self.resource_name: str = resource_name
+        """the resource name prefix to use for resources created by this instance"""
+
+        self.vpc: VirtualPrivateCloud = vpc
+        """the virtual private cloud the image is built within"""
+
+        self.role: str = role
+        """the role baked into the image"""
+
+        self.architecture: str = architecture
+        """the architecture of the image"""
+
+        self.base_ami: ResolvedAmi = (
+            base_ami
+            if base_ami is not None
+            else resolve_ami("amzn2-ami-*", architecture)
+        )
+        """the image the role is baked into"""
+
+        self.bake_hash: str = hash_script_folders(
+            BAKE_SCRIPT_NAME, BAKE_SHARED_SCRIPT_NAME
+        )
+        """the hash of the scripts which bake the image; the builder, and
+        hence the image, is replaced whenever it changes"""
+
+        self.security_group: aws.ec2.SecurityGroup = aws.ec2.SecurityGroup(
+            f"{resource_name}-security-group",
+            description="allows incoming ssh from bastion",
+            vpc_id=self.vpc.vpc.id,
+            ingress=[
+                aws.ec2.SecurityGroupIngressArgs(
+                    from_port=22,
+                    to_port=22,
+                    protocol="tcp",
+                    cidr_blocks=[
+                        self.vpc.bastion.private_ip.apply(lambda ip: f"{ip}/32")
+                    ],
+                ),
+            ],
+            egress=[
+                aws.ec2.SecurityGroupEgressArgs(
+                    from_port=0, to_port=0, protocol="-1", cidr_blocks=["0.0.0.0/0"]
+                )
+            ],
+            tags={"Name": f"{resource_name} golden image builder"},
+        )
+        """the security group of the builder instance"""
+
+        self.builder: aws.ec2.Instance = aws.ec2.Instance(
+            f"{resource_name}-builder",
+            ami=self.base_ami.id,
+            associate_public_ip_address=False,
+            instance_type=(
+                instance_type or DEFAULT_BUILDER_INSTANCE_TYPES[architecture]
+            ),
+            subnet_id=self.vpc.private_subnets[0].id,
+            key_name=self.vpc.key.key_pair.key_name,
+            vpc_security_group_ids=[self.security_group.id],
+            iam_instance_profile=self.vpc.standard_instance_profile.name,
+            root_block_device=(
+                aws.ec2.InstanceRootBlockDeviceArgs(
+                    volume_size=volume_size, volume_type="gp3"
+                )
+                if volume_size is not None
+                else None
+            ),
+            # only used to replace the builder whenever the bake changes
+            user_data=f"#!/usr/bin/env bash\n# bake {self.bake_hash}\n",
+            user_data_replace_on_change=True,
+            tags={"Name": f"{resource_name} {role} golden image builder"},
+        )
+        """the instance the role is baked into before it is imaged"""
+
+        self.bake: RemoteExecution = RemoteExecution(
+            f"{resource_name}-bake",
+            props=RemoteExecutionInputs(
+                script_name=BAKE_SCRIPT_NAME,
+                file_substitutions={"config.sh": {"ROLE": role}},
+                host=self.builder.private_ip,
+                private_key=self.vpc.key.private_key_path,
+                bastion=self.vpc.bastion.public_ip,
+                shared_script_name=BAKE_SHARED_SCRIPT_NAME,
+            ),
+            opts=ResourceOptions(depends_on=self.vpc.private_rtas),
+        )
+        """the remote execution which bakes the role into the builder"""
+
+        self.image: aws.ec2.AmiFromInstance = aws.ec2.AmiFromInstance(
+            f"{resource_name}-image",
+            name=self.builder.id.apply(
+                lambda builder_id: f"{resource_name}-{role}-{builder_id}"
+            ),
+            source_instance_id=self.builder.id,
+            tags={"Name": f"{resource_name} {role} golden image"},
+            opts=ResourceOptions(depends_on=[self.bake]),
+        )
+        """the baked image"""
+
+        self.builder_state: aws.ec2transitgateway.InstanceState = (
+            aws.ec2transitgateway.InstanceState(
+                f"{resource_name}-builder-state",
+                instance_id=self.builder.id,
+                state="stopped",
+                opts=ResourceOptions(depends_on=[self.image]),
+            )
+        )
+        """stops the builder once it has been imaged"""
+
+        self.ami_id: pulumi.Output[str] = self.image.id
+        """the id of the baked image"""
+
+    def check_compatible(self, role: str, architecture: str) -> None:
+        """Raises a ValueError unless instances of the given role and
+        architecture can be launched from this image
+        """
+        if self.role != role or self.architecture != architecture:
+            raise ValueError(
+                f"{self.resource_name} bakes {self.role} for {self.architecture}, "
+                f"which can not launch {role} for {architecture}"
+            )
+
+
+def get_image_options(image: Optional[GoldenImage]) -> Optional[ResourceOptions]:
+    """Returns the options for an instance launched from the given golden image,
+    if any, which keep the instance on the image it was launched from when the
+    image is rebaked, rather than replacing it
+    """
+    if image is None:
+        return None
+    return ResourceOptions(ignore_changes=["ami"])
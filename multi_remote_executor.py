@@ -0,0 +1,482 @@
+"""Provides the MultiRemoteExecution dynamic resource, which executes the same
+script folder on many hosts at once. Every host is reached through the same
+pooled bastion connection, at most max_in_flight hosts are executed on at a
+time, and hosts may be ordered into waves, where each wave must succeed before
+the next starts (for example, to provision a clusters leader first).
+
+Each host is executed on exactly as a RemoteExecution would, so the per-host
+results are the outputs a RemoteExecution would have.
+
+Dynamic providers can not record partial progress, so when any host fails
+the per-host results of the hosts which succeeded are lost: a failed create
+runs delete.sh on the hosts which succeeded before failing, and a failed
+update keeps the previous results, so hosts which already succeeded execute
+again on the next update. Hence scripts must be idempotent, which the step
+markers of setup-scripts/shared/steps.sh make cheap.
+"""
+import concurrent.futures
+import functools
+import secrets
+import traceback
+import pulumi
+from typing import Any, Callable, Dict, List, Optional, TypedDict, TypeVar
+from remote_executor import (
+    DEFAULT_BUNDLE_CACHE_SIZE,
+    DEFAULT_EXECUTION_DEADLINE,
+    DEFAULT_INACTIVITY_TIMEOUT,
+    DEFAULT_OUTPUT_LIMIT,
+    DEFAULT_OUTPUT_POLICY,
+    RemoteExecutionProvider,
+    _RemoteExecutionInputs,
+    _RemoteExecutionOutputs,
+    get_output_policy,
+)
+from ssh_pool import DEFAULT_CONNECT_DEADLINE, DEFAULT_MAX_CONCURRENT_PER_BASTION
+from phase_timing import DEFAULT_TRACE_DIRECTORY
+
+DEFAULT_MAX_IN_FLIGHT: int = DEFAULT_MAX_CONCURRENT_PER_BASTION
+"""The default maximum number of hosts executed on at the same time"""
+
+T = TypeVar("T")
+
+
+class MultiRemoteExecutionInputs:
+    """The inputs that define a remote execution across many hosts. See
+    RemoteExecutionInputs for the meaning of the shared fields.
+
+    The script folder must be idempotent: if an update fails on any host,
+    the hosts which already succeeded execute it again on the next update.
+    """
+
+    script_name: pulumi.Input[str]
+    """The path to the script folder to execute on every host"""
+
+    hosts: pulumi.Input[List[str]]
+    """The hosts to execute the script folder on"""
+
+    file_substitutions: pulumi.Input[List[Optional[Dict[str, Dict[str, str]]]]]
+    """The file substitutions for each host, with index-correspondance to hosts"""
+
+    private_key: pulumi.Input[str]
+    """The path to the private key used to access the hosts and the bastion"""
+
+    bastion: pulumi.Input[Optional[str]]
+    """The bastion server to proxy every connection through, if any"""
+
+    shared_script_name: pulumi.Input[Optional[str]]
+    """A path to an additional directory whose scripts should be installed
+    under the "shared" directory on every host
+    """
+
+    waves: pulumi.Input[Optional[List[List[int]]]]
+    """If specified, groups of indices into hosts which are executed in order,
+    where each group must succeed before the next starts. Hosts which are not
+    in any group form a final group. For example, [[0]] executes on the first
+    host before all the others.
+    """
+
+    max_in_flight: pulumi.Input[int]
+    """The maximum number of hosts to execute on at the same time. Note that
+    connections through the same bastion are also limited by the ssh pool.
+    """
+
+    transfer_mode: pulumi.Input[str]
+    jump_mode: pulumi.Input[str]
+    output_limit: pulumi.Input[int]
+    log_directory: pulumi.Input[Optional[str]]
+    bundle_cache_size: pulumi.Input[int]
+    connect_deadline: pulumi.Input[float]
+    trace_directory: pulumi.Input[Optional[str]]
+    force_steps: pulumi.Input[Optional[List[str]]]
+    clear_steps: pulumi.Input[Optional[List[str]]]
+    inactivity_timeout: pulumi.Input[float]
+    execution_deadline: pulumi.Input[float]
+    output_policy: pulumi.Input[str]
+    """Unless "full", file_substitutions is also omitted from the outputs,
+    leaving only what the per-host results keep"""
+
+    def __init__(
+        self,
+        script_name: str,
+        hosts: List[str],
+        file_substitutions: List[Optional[Dict[str, Dict[str, str]]]],
+        private_key: str,
+        bastion: Optional[str] = None,
+        shared_script_name: Optional[str] = None,
+        waves: Optional[List[List[int]]] = None,
+        max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+        transfer_mode: str = "archive",
+        jump_mode: str = "tunnel",
+        output_limit: int = DEFAULT_OUTPUT_LIMIT,
+        log_directory: Optional[str] = None,
+        bundle_cache_size: int = DEFAULT_BUNDLE_CACHE_SIZE,
+        connect_deadline: float = DEFAULT_CONNECT_DEADLINE,
+        trace_directory: Optional[str] = DEFAULT_TRACE_DIRECTORY,
+        force_steps: Optional[List[str]] = None,
+        clear_steps: Optional[List[str]] = None,
+        inactivity_timeout: float = DEFAULT_INACTIVITY_TIMEOUT,
+        execution_deadline: float = DEFAULT_EXECUTION_DEADLINE,
+        output_policy: str = DEFAULT_OUTPUT_POLICY,
+    ):
+        self.script_name = script_name
+        self.hosts = hosts
+        self.file_substitutions = file_substitutions
+        self.private_key = private_key
+        self.bastion = bastion
+        self.shared_script_name = shared_script_name
+        self.waves = waves
+        self.max_in_flight = max_in_flight
+        self.transfer_mode = transfer_mode
+        self.jump_mode = jump_mode
+        self.output_limit = output_limit
+        self.log_directory = log_directory
+        self.bundle_cache_size = bundle_cache_size
+        self.connect_deadline = connect_deadline
+        self.trace_directory = trace_directory
+        self.force_steps = force_steps
+        self.clear_steps = clear_steps
+        self.inactivity_timeout = inactivity_timeout
+        self.execution_deadline = execution_deadline
+        self.output_policy = output_policy
+
+
+class _MultiRemoteExecutionInputs(TypedDict):
+    script_name: str
+    hosts: List[str]
+    file_substitutions: List[Optional[Dict[str, Dict[str, str]]]]
+    private_key: str
+    bastion: Optional[str]
+    shared_script_name: Optional[str]
+    waves: Optional[List[List[int]]]
+    max_in_flight: Optional[int]
+    transfer_mode: Optional[str]
+    jump_mode: Optional[str]
+    output_limit: Optional[int]
+    log_directory: Optional[str]
+    bundle_cache_size: Optional[int]
+    connect_deadline: Optional[float]
+    trace_directory: Optional[str]
+    force_steps: Optional[List[str]]
+    clear_steps: Optional[List[str]]
+    inactivity_timeout: Optional[float]
+    execution_deadline: Optional[float]
+    output_policy: Optional[str]
+
+
+class _MultiRemoteExecutionOutputs(_MultiRemoteExecutionInputs):
+    results: List[_RemoteExecutionOutputs]
+    """The outputs of the execution on each host, with index-correspondance
+    to hosts"""
+
+
+class MultiRemoteExecutionError(Exception):
+    """Raised when the execution failed on one or more hosts"""
+
+    def __init__(
+        self,
+        errors: Dict[str, BaseException],
+        results: Optional[Dict[int, Any]] = None,
+    ) -> None:
+        """Creates a new error for the given exceptions, keyed by host, and
+        the results of the hosts which succeeded, keyed by index
+        """
+        super().__init__(
+            f"execution failed on {len(errors)} host(s): "
+            + "; ".join(f"{host}: {e!r}" for host, e in errors.items())
+        )
+        self.errors: Dict[str, BaseException] = errors
+        """The exception raised for each failed host"""
+
+        self.results: Dict[int, Any] = results if results is not None else dict()
+        """The result of each host which succeeded before the failure, keyed
+        by its index"""
+
+
+class MultiRemoteExecutionProvider(pulumi.dynamic.ResourceProvider):
+    """Executes a script folder on many hosts, delegating each host to the
+    RemoteExecutionProvider. Changes are reconciled host by host, so adding
+    or removing a host or changing one hosts substitutions only executes on
+    the affected hosts, and the resource itself is never replaced.
+    """
+
+    def create(
+        self, inputs: _MultiRemoteExecutionInputs
+    ) -> pulumi.dynamic.CreateResult:
+        id_ = secrets.token_hex(16)
+        single = RemoteExecutionProvider()
+        hosts = inputs["hosts"]
+        waves = get_waves(len(hosts), inputs.get("waves"))
+        try:
+            results = run_in_waves(
+                hosts,
+                [
+                    lambda idx=idx: single.create(get_host_inputs(inputs, idx)).outs
+                    for idx in range(len(hosts))
+                ],
+                waves,
+                get_max_in_flight(inputs),
+            )
+        except MultiRemoteExecutionError as e:
+            # nothing is recorded for a failed create, so the hosts which
+            # succeeded would otherwise never be deleted
+            self._delete_succeeded(id_, inputs, waves, e.results)
+            raise
+        return pulumi.dynamic.CreateResult(id_=id_, outs=make_outputs(inputs, results))
+
+    def update(
+        self,
+        id: str,
+        olds: _MultiRemoteExecutionOutputs,
+        news: _MultiRemoteExecutionInputs,
+    ) -> pulumi.dynamic.UpdateResult:
+        old_results = dict((result["host"], result) for result in olds["results"])
+        hosts = news["hosts"]
+        # if any host fails the previous results are kept, so the hosts which
+        # succeeded execute again on the next update; see the module docstring
+        results = run_in_waves(
+            hosts,
+            [
+                functools.partial(
+                    reconcile_host,
+                    id,
+                    old_results.get(host),
+                    get_host_inputs(news, idx),
+                )
+                for idx, host in enumerate(hosts)
+            ],
+            get_waves(len(hosts), news.get("waves")),
+            get_max_in_flight(news),
+        )
+
+        # remove hosts only once their replacements have succeeded
+        single = RemoteExecutionProvider()
+        removed = [result for result in olds["results"] if result["host"] not in hosts]
+        run_in_waves(
+            [result["host"] for result in removed],
+            [functools.partial(single.delete, id, result) for result in removed],
+            [list(range(len(removed)))],
+            get_max_in_flight(news),
+        )
+        return pulumi.dynamic.UpdateResult(outs=make_outputs(news, results))
+
+    def _delete_succeeded(
+        self,
+        id: str,
+        inputs: _MultiRemoteExecutionInputs,
+        waves: List[List[int]],
+        results: Dict[int, _RemoteExecutionOutputs],
+    ) -> None:
+        """Best-effort deletes the executions on the hosts which succeeded
+        during a failed create, in the reverse order of the waves
+        """
+        succeeded = sorted(results)
+        positions = dict((idx, pos) for pos, idx in enumerate(succeeded))
+        single = RemoteExecutionProvider()
+        try:
+            run_in_waves(
+                [inputs["hosts"][idx] for idx in succeeded],
+                [
+                    functools.partial(single.delete, id, results[idx])
+                    for idx in succeeded
+                ],
+                [
+                    [positions[idx] for idx in wave if idx in positions]
+                    for wave in reversed(waves)
+                    if any(idx in positions for idx in wave)
+                ],
+                get_max_in_flight(inputs),
+            )
+        except Exception:
+            traceback.print_exc()
+
+    def delete(self, id: str, olds: _MultiRemoteExecutionOutputs) -> None:
+        single = RemoteExecutionProvider()
+        results = olds["results"]
+        run_in_waves(
+            [result["host"] for result in results],
+            [functools.partial(single.delete, id, result) for result in results],
+            list(reversed(get_waves(len(results), olds.get("waves")))),
+            get_max_in_flight(olds),
+        )
+
+    def diff(
+        self,
+        id: str,
+        olds: _MultiRemoteExecutionOutputs,
+        news: _MultiRemoteExecutionInputs,
+    ) -> pulumi.dynamic.DiffResult:
+        hosts = news.get("hosts")
+        if olds.get("hosts") != hosts or not isinstance(
+            news.get("file_substitutions"), list
+        ):
+            return pulumi.dynamic.DiffResult(changes=True)
+
+        single = RemoteExecutionProvider()
+        for idx, old_result in enumerate(olds["results"]):
+            if single.diff(id, old_result, get_host_inputs(news, idx)).changes:
+                return pulumi.dynamic.DiffResult(changes=True)
+
+        return pulumi.dynamic.DiffResult(changes=False)
+
+
+def reconcile_host(
+    id: str,
+    olds: Optional[_RemoteExecutionOutputs],
+    news: _RemoteExecutionInputs,
+) -> _RemoteExecutionOutputs:
+    """Brings a single host from its old execution (None if it is new) to
+    the new inputs in the same way pulumi would for a RemoteExecution, ie.,
+    nothing, an in place update, or a delete followed by a create
+    """
+    single = RemoteExecutionProvider()
+    if olds is None:
+        return single.create(news).outs
+
+    diff = single.diff(id, olds, news)
+    if not diff.changes:
+        return olds
+
+    if diff.replaces:
+        if olds["host"] == news["host"]:
+            single.delete(id, olds)
+        return single.create(news).outs
+
+    return single.update(id, olds, news).outs
+
+
+def get_host_inputs(
+    inputs: _MultiRemoteExecutionInputs, idx: int
+) -> _RemoteExecutionInputs:
+    """Returns the inputs of the RemoteExecution equivalent to executing on
+    the host at the given index
+    """
+    file_substitutions = inputs.get("file_substitutions") or []
+    return _RemoteExecutionInputs(
+        script_name=inputs["script_name"],
+        file_substitutions=(
+            file_substitutions[idx] if idx < len(file_substitutions) else None
+        ),
+        host=inputs["hosts"][idx],
+        private_key=inputs["private_key"],
+        bastion=inputs.get("bastion"),
+        shared_script_name=inputs.get("shared_script_name"),
+        transfer_mode=inputs.get("transfer_mode"),
+        jump_mode=inputs.get("jump_mode"),
+        output_limit=inputs.get("output_limit"),
+        log_directory=inputs.get("log_directory"),
+        bundle_cache_size=inputs.get("bundle_cache_size"),
+        connect_deadline=inputs.get("connect_deadline"),
+        trace_directory=inputs.get("trace_directory"),
+        force_steps=inputs.get("force_steps"),
+        clear_steps=inputs.get("clear_steps"),
+        inactivity_timeout=inputs.get("inactivity_timeout"),
+        execution_deadline=inputs.get("execution_deadline"),
+        output_policy=inputs.get("output_policy"),
+    )
+
+
+def make_outputs(
+    inputs: _MultiRemoteExecutionInputs, results: List[_RemoteExecutionOutputs]
+) -> _MultiRemoteExecutionOutputs:
+    """Returns the outputs of a multi remote execution with the given inputs
+    and per-host results, omitting the file substitutions unless the output
+    policy is "full", as only the results are needed to diff or delete
+    """
+    outputs = {**inputs, "results": results}
+    if get_output_policy(inputs) != "full":
+        outputs["file_substitutions"] = None
+    return outputs
+
+
+def get_max_in_flight(values: _MultiRemoteExecutionInputs) -> int:
+    """Gets the maximum number of hosts to execute on at once from the given
+    inputs or outputs, defaulting to DEFAULT_MAX_IN_FLIGHT
+    """
+    max_in_flight = values.get("max_in_flight")
+    if max_in_flight is None:
+        return DEFAULT_MAX_IN_FLIGHT
+    return max(int(max_in_flight), 1)
+
+
+def get_waves(num_hosts: int, waves: Optional[List[List[int]]]) -> List[List[int]]:
+    """Returns the indices of the hosts to execute on in each wave, in order,
+    where hosts which are not in any of the given waves form a final wave.
+    Indices out of range, or which are repeated, are ignored.
+    """
+    result: List[List[int]] = []
+    seen = set()
+    for wave in waves or []:
+        indices = []
+        for idx in wave:
+            idx = int(idx)
+            if 0 <= idx < num_hosts and idx not in seen:
+                seen.add(idx)
+                indices.append(idx)
+        if indices:
+            result.append(indices)
+
+    remaining = [idx for idx in range(num_hosts) if idx not in seen]
+    if remaining:
+        result.append(remaining)
+    return result
+
+
+def run_in_waves(
+    hosts: List[str],
+    actions: List[Callable[[], T]],
+    waves: List[List[int]],
+    max_in_flight: int,
+) -> List[T]:
+    """Runs the actions, which have index-correspondance to hosts, wave by
+    wave with at most max_in_flight running at once, returning their results.
+    Every action in a wave is run even if some fail, but if any fail then a
+    MultiRemoteExecutionError is raised instead of starting the next wave.
+    """
+    results: Dict[int, T] = dict()
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(min(max_in_flight, len(actions)), 1)
+    ) as executor:
+        for wave in waves:
+            futures = dict((idx, executor.submit(actions[idx])) for idx in wave)
+            errors: Dict[str, BaseException] = dict()
+            for idx, future in futures.items():
+                try:
+                    results[idx] = future.result()
+                except Exception as e:
+                    errors[hosts[idx]] = e
+            if errors:
+                raise MultiRemoteExecutionError(errors, dict(results))
+    return [results[idx] for idx in range(len(actions))]
+
+
+class MultiRemoteExecution(pulumi.dynamic.Resource):
+    """Executes the given script folder on many hosts, as if by one
+    RemoteExecution per host, but sharing one bastion connection with a
+    bounded number of hosts in flight and optional ordering into waves.
+    """
+
+    results: pulumi.Output[List[Dict[str, str]]]
+    """The outputs of the execution on each host, with index-correspondance
+    to hosts"""
+
+    hosts: pulumi.Output[List[str]]
+    """The hosts the script folder was executed on"""
+
+    script_name: pulumi.Output[str]
+    """The path to the script folder which was executed"""
+
+    bastion: pulumi.Output[Optional[str]]
+    """The bastion server that the script was executed through"""
+
+    def __init__(
+        self,
+        name: str,
+        props: MultiRemoteExecutionInputs,
+        opts: Optional[pulumi.ResourceOptions] = None,
+    ):
+        super().__init__(
+            MultiRemoteExecutionProvider(),
+            name,
+            {"results": None, **vars(props)},
+            opts,
+        )
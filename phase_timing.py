@@ -0,0 +1,162 @@
+"""Provides lightweight timing of the phases of remote executions. Timings are
+stored in the outputs of each execution and appended to a local Chrome trace
+file (one per provider process, ie., per pulumi up) so that the critical path
+of a deploy can be inspected in chrome://tracing or https://ui.perfetto.dev.
+
+Remote scripts may delimit their own steps by printing a line starting with
+PHASE_MARKER followed by the name of the step, eg.,
+
+    echo "sfs phase install_rqlite"
+
+which ends the previous step, if any, and begins the new one.
+"""
+import contextlib
+import itertools
+import json
+import os
+import threading
+import time
+from typing import Any, ContextManager, Dict, Iterator, List, Optional, Tuple
+
+DEFAULT_TRACE_DIRECTORY = "traces"
+"""The default local directory which Chrome trace files are written to"""
+
+PHASE_MARKER = "sfs phase "
+"""The prefix of lines printed by remote scripts which begin a new step"""
+
+Phase = Dict[str, Any]
+"""A timed phase: its "name", its "start" in seconds since the epoch and its
+"duration" in seconds"""
+
+
+class PhaseTimer:
+    """Records the start and duration of named phases. Thread-safe."""
+
+    def __init__(self) -> None:
+        self.phases: List[Phase] = []
+        """The phases recorded so far, in the order they finished"""
+
+        self._lock = threading.Lock()
+        self._marked: Optional[Tuple[str, float, float]] = None
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Times the body of the with statement as the phase with the given
+        name, recording it even if the body raises
+        """
+        start = time.time()
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter() - started_at)
+
+    def record(self, name: str, start: float, duration: float) -> None:
+        """Records a phase which started at the given time since the epoch
+        and lasted the given number of seconds
+        """
+        with self._lock:
+            self.phases.append(
+                {"name": name, "start": round(start, 6), "duration": round(duration, 6)}
+            )
+
+    def mark(self, name: str) -> None:
+        """Ends the current marked step, if any, and begins a new one with the
+        given name, for steps which are only delimited by their starts
+        """
+        start = time.time()
+        started_at = time.perf_counter()
+        with self._lock:
+            previous, self._marked = self._marked, (name, start, started_at)
+        if previous is not None:
+            self.record(previous[0], previous[1], started_at - previous[2])
+
+    def end_mark(self) -> None:
+        """Ends the current marked step, if any"""
+        ended_at = time.perf_counter()
+        with self._lock:
+            previous, self._marked = self._marked, None
+        if previous is not None:
+            self.record(previous[0], previous[1], ended_at - previous[2])
+
+    def to_outputs(self) -> List[Phase]:
+        """Returns the recorded phases in the order they started"""
+        with self._lock:
+            return sorted(self.phases, key=lambda phase: phase["start"])
+
+
+def timed(timer: Optional[PhaseTimer], name: str) -> ContextManager[None]:
+    """Times the body of the with statement as the named phase on the given
+    timer, or does nothing if the timer is None
+    """
+    if timer is None:
+        return contextlib.nullcontext()
+    return timer.phase(name)
+
+
+_TRACE_LOCK = threading.Lock()
+_TRACE_PATHS: Dict[str, str] = dict()
+_TRACE_THREAD_IDS = itertools.count(1)
+_PROCESS_STARTED_AT = time.strftime("%Y%m%d-%H%M%S")
+
+
+def get_trace_path(trace_directory: str) -> str:
+    """Returns the path to the trace file within the given directory which
+    this process appends to
+    """
+    with _TRACE_LOCK:
+        return _get_trace_path_locked(trace_directory)
+
+
+def _get_trace_path_locked(trace_directory: str) -> str:
+    path = _TRACE_PATHS.get(trace_directory)
+    if path is None:
+        path = os.path.join(
+            trace_directory, f"{_PROCESS_STARTED_AT}-{os.getpid()}.trace.json"
+        )
+        _TRACE_PATHS[trace_directory] = path
+    return path
+
+
+def append_chrome_trace(trace_directory: str, label: str, phases: List[Phase]) -> str:
+    """Appends the given phases to this processes trace file within the given
+    directory as complete events on a new track with the given label,
+    returning the path to the trace file.
+
+    The file uses the Chrome JSON array format without the closing bracket,
+    which trace viewers accept, so that it can be appended to incrementally.
+    """
+    pid = os.getpid()
+    tid = next(_TRACE_THREAD_IDS)
+    events = [
+        {
+            "name": "thread_name",
+            "ph": "M",
+            "pid": pid,
+            "tid": tid,
+            "args": {"name": label},
+        }
+    ]
+    for phase in phases:
+        events.append(
+            {
+                "name": phase["name"],
+                "cat": "remote_execution",
+                "ph": "X",
+                "ts": round(phase["start"] * 1e6),
+                "dur": round(phase["duration"] * 1e6),
+                "pid": pid,
+                "tid": tid,
+            }
+        )
+
+    with _TRACE_LOCK:
+        path = _get_trace_path_locked(trace_directory)
+        os.makedirs(trace_directory, exist_ok=True)
+        is_new = not os.path.exists(path)
+        with open(path, "a") as f:
+            if is_new:
+                f.write("[\n")
+            for event in events:
+                f.write(json.dumps(event, separators=(",", ":")) + ",\n")
+    return path
@@ -1,7 +1,9 @@
 """This module allows creating a redis cluster (using redis sentinel)"""
-from typing import List
+from typing import List, Optional
+from multi_remote_executor import MultiRemoteExecution, MultiRemoteExecutionInputs
 from remote_executor import RemoteExecution, RemoteExecutionInputs
 from vpc import VirtualPrivateCloud
+from golden_image import GoldenImage, get_image_options
 import pulumi_aws as aws
 import pulumi
 
@@ -13,6 +15,8 @@ class RedisCluster:
         self,
         resource_name: str,
         vpc: VirtualPrivateCloud,
+        batch_remote_executions: bool = False,
+        image: Optional[GoldenImage] = None,
     ) -> None:
         """Creates a new rqlite cluster running on the private subnets
         of the given virtual private cloud.
@@ -22,6 +26,15 @@ class RedisCluster:
                 created by this instance
             vpc (VirtualPrivateCloud): the virtual private cloud to construct
                 the rqlite cluster within
+            batch_remote_executions (bool): if true, the instances are
+                provisioned by a single MultiRemoteExecution which provisions
+                the main instance before the others, rather than by one
+                RemoteExecution per instance
+            image (GoldenImage, None): if specified, the instances are launched
+                from this image, which must have the redis role baked in, so
+                that provisioning skips the baked steps. Instances keep the
+                image they were launched from when it is rebaked, and only pick
+                up the new one when they are next replaced
         """
         self.resource_name: str = resource_name
         """the resource name prefix to use for resources created by this instance"""
@@ -29,6 +42,15 @@ class RedisCluster:
         self.vpc: VirtualPrivateCloud = vpc
         """the virtual private cloud the cluster is within"""
 
+        self.batch_remote_executions: bool = batch_remote_executions
+        """whether the instances are provisioned by a single MultiRemoteExecution"""
+
+        if image is not None:
+            image.check_compatible("redis", "x86_64")
+
+        self.image: Optional[GoldenImage] = image
+        """the golden image the instances are launched from, if any"""
+
         self.security_group: aws.ec2.SecurityGroup = aws.ec2.SecurityGroup(
             f"{resource_name}-security-group",
             description="allows incoming 6379 tcp (redis) and 26379 (sentinel) + ssh from bastion",
@@ -66,7 +88,9 @@ class RedisCluster:
         self.instances: List[aws.ec2.Instance] = [
             aws.ec2.Instance(
                 f"{resource_name}-instance-{idx}",
-                ami=self.vpc.amazon_linux_amd64.id,
+                ami=image.ami_id
+                if image is not None
+                else self.vpc.amazon_linux_amd64.id,
                 associate_public_ip_address=False,
                 instance_type="t3a.nano",
                 subnet_id=subnet.id,
@@ -77,11 +101,13 @@ class RedisCluster:
                     iops=3000, throughput=125, volume_size=4, volume_type="gp3"
                 ),
                 tags={"Name": f"{resource_name} {vpc.availability_zones[idx]} [{idx}]"},
+                opts=get_image_options(image),
             )
             for idx, subnet in enumerate(self.vpc.private_subnets)
         ]
         """the instances within this cluster"""
 
+        file_substitutions: List[pulumi.Output] = []
         self.remote_executions: List[RemoteExecution] = []
         """the remote executions required to bootstrap and maintain the cluster"""
 
@@ -108,14 +134,19 @@ class RedisCluster:
                     },
                 }
 
+            instance_file_substitutions = pulumi.Output.all(
+                *[i.private_ip for i in self.instances], idx_outer
+            ).apply(generate_file_substitutions)
+            if batch_remote_executions:
+                file_substitutions.append(instance_file_substitutions)
+                continue
+
             self.remote_executions.append(
                 RemoteExecution(
                     f"{resource_name}-remote-execution-{idx_outer}",
                     props=RemoteExecutionInputs(
                         script_name="setup-scripts/redis",
-                        file_substitutions=pulumi.Output.all(
-                            *[i.private_ip for i in self.instances], idx_outer
-                        ).apply(generate_file_substitutions),
+                        file_substitutions=instance_file_substitutions,
                         host=instance.private_ip,
                         private_key=self.vpc.key.private_key_path,
                         bastion=self.vpc.bastion.public_ip,
@@ -123,3 +154,21 @@ class RedisCluster:
                     ),
                 )
             )
+
+        self.batched_remote_execution: Optional[MultiRemoteExecution] = None
+        if batch_remote_executions:
+            self.batched_remote_execution = MultiRemoteExecution(
+                f"{resource_name}-remote-execution",
+                props=MultiRemoteExecutionInputs(
+                    script_name="setup-scripts/redis",
+                    hosts=[i.private_ip for i in self.instances],
+                    file_substitutions=file_substitutions,
+                    private_key=self.vpc.key.private_key_path,
+                    bastion=self.vpc.bastion.public_ip,
+                    shared_script_name="setup-scripts/shared",
+                    waves=[[0]],
+                ),
+            )
+        """if batch_remote_executions, the remote execution which bootstraps and
+        maintains every instance, starting with the main instance; otherwise None
+        """
@@ -6,13 +6,133 @@ a bastion server - a common pattern when using VPCs.
 import traceback
 import pulumi
 import paramiko
-from typing import Optional, TypedDict, Tuple, Dict
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    List,
+    Optional,
+    Set,
+    TextIO,
+    TypedDict,
+    Tuple,
+    Dict,
+)
+import base64
+import collections
+import contextlib
+import gzip
+import hmac
 import io
+import json
 import os
+import select
 import secrets
+import re
+import tarfile
 import time
 import hashlib
-import re
+import zlib
+from ssh_pool import SSH_POOL, DEFAULT_CONNECT_DEADLINE, ConnectRetryPolicy
+from script_hash import hash_directory, hash_files, legacy_hash_directory
+from templates import load_template, validate_substitutions
+from agent_client import AgentUnavailableError, connect_over_ssh
+from phase_timing import (
+    DEFAULT_TRACE_DIRECTORY,
+    PHASE_MARKER,
+    PhaseTimer,
+    append_chrome_trace,
+    timed,
+)
+
+TRANSFER_MODES = ("archive", "echo", "agent")
+"""The supported ways of getting the script folder onto the remote machine.
+"archive" renders the folder into an in-memory tar.gz which is uploaded
+over sftp and unpacked with a single tar command, whereas "echo" writes
+every line of every file via an echo command in one large bash script.
+"agent" sends the same tar.gz to the provisioning agent (see
+agent_client.py) only if it does not already have it, preferring an
+rsync-style delta against the last bundle of the same script folder on the
+host, and has the agent run the entrypoint, falling back to "archive" until
+the agent is installed.
+"""
+
+JUMP_MODES = ("tunnel", "shell")
+"""The supported ways of reaching a host through the bastion. "tunnel"
+opens a direct-tcpip channel through the bastions ssh transport and
+connects to the host over it, so the script is uploaded and executed
+on the host directly. "shell" copies the private key onto the bastion
+and uses the ssh and sftp commands from there.
+"""
+
+DEFAULT_OUTPUT_LIMIT: int = 512 * 1024
+"""The default maximum number of bytes of each of stdout and stderr which
+are kept from an execution; beyond this only the head and tail are kept"""
+
+OUTPUT_POLICIES = ("full", "truncate", "compress")
+"""How the outputs of an execution are kept in the pulumi state. "full"
+keeps stdout and stderr (up to output_limit) and the file substitutions as
+they are. "truncate" keeps only the last COMPACT_OUTPUT_TAIL bytes of each
+of stdout and stderr, and "compress" keeps them zlib compressed (see
+decompress_output). Both of the latter keep a digest of the substitutions
+of each file instead of their values, except for those of delete.sh which
+are needed to destroy the execution, and always stream the complete output
+to a local log directory.
+"""
+
+DEFAULT_OUTPUT_POLICY = "truncate"
+"""The default output policy, one of OUTPUT_POLICIES"""
+
+COMPACT_OUTPUT_TAIL: int = 4 * 1024
+"""How many bytes of the end of each of stdout and stderr are kept in the
+state by the "truncate" output policy"""
+
+DEFAULT_LOG_DIRECTORY = "logs"
+"""The local directory which the complete output of every execution is
+streamed to when the output policy is not "full" and no log directory is
+specified"""
+
+COMPRESSED_OUTPUT_PREFIX = "zlib+base64:"
+"""The prefix of stdout and stderr kept by the "compress" output policy"""
+
+READ_SIZE: int = 64 * 1024
+"""How many bytes to read from a channel at once"""
+
+BUNDLES_DIR = "/usr/local/src/.bundles"
+"""Where rendered script bundles are cached on remote machines, by the
+sha256 of their archive"""
+
+DEFAULT_BUNDLE_CACHE_SIZE: int = 8
+"""The default number of bundles kept on each remote machine"""
+
+UPDATE_ENTRYPOINT = "update.sh"
+"""The script within a script folder which applies changes in place"""
+
+UPDATE_FILES_NAME = "update_files.txt"
+"""The file within a script folder which lists, one relative path per line,
+the files whose changes can be applied in place by the update entrypoint"""
+
+DEFAULT_INACTIVITY_TIMEOUT: float = 600
+"""The default number of seconds a remote script may go without printing
+anything before it is killed"""
+
+DEFAULT_EXECUTION_DEADLINE: float = 3600
+"""The default number of seconds a remote script may run before it is killed"""
+
+PROCESS_GROUP_MARKER = "sfs pgid "
+"""The prefix of the line printed by the generated script with its process
+group id, so that it can be killed if it hangs"""
+
+STDERR_TAIL_LINES: int = 20
+"""How many of the last lines of stderr are included in a RemoteCommandError"""
+
+STEPS_DIR = "/var/lib/ezpbars/steps"
+"""Where setup-scripts/shared/steps.sh records the steps which completed on
+remote machines, one file per step containing the hash of its inputs"""
+
+STEP_NAME_REGEX = re.compile(r"^(\*|[A-Za-z0-9_.-]+)$")
+"""Matches valid step names for force_steps and clear_steps, where "*"
+means every step"""
 
 
 class RemoteExecutionInputs:
@@ -32,6 +152,12 @@ class RemoteExecutionInputs:
 
     Furthermore, if the script folder has the `delete.sh` file, it
     will be executed if the resource is destroyed using the same process.
+
+    If the script folder has an `update.sh` file and an `update_files.txt`
+    file listing relative paths within the folder, then changes which only
+    affect those files (either their contents or their substitutions) are
+    applied by executing `update.sh` in the same way, rather than by
+    replacing the execution. Any other change still replaces it.
     """
 
     file_substitutions: pulumi.Input[Dict[str, Dict[str, str]]]
@@ -49,13 +175,18 @@ class RemoteExecutionInputs:
     that indentation is preserved during this process. Note that
     where slashes are used as a path separator, they must be unix-style
     (/)..
+
+    Every variable referenced by a file with substitutions must be given a
+    value; otherwise the execution fails before connecting, listing every
+    missing variable. See templates.py.
     """
 
     host: pulumi.Input[str]
     """If the host machine is directly reachable, this is the public
     ip address of the target machine. Otherwise, this is the private
     ip address of the target machine, which will be accessed via proxying
-    through the bastion server.
+    through the bastion server. May end with ":port" if ssh is not listening
+    on port 22, except in the shell jump mode.
     """
 
     private_key: pulumi.Input[str]
@@ -75,6 +206,87 @@ class RemoteExecutionInputs:
     in the current working directory.
     """
 
+    transfer_mode: pulumi.Input[str]
+    """How the script folder is sent to the remote machine, one of
+    TRANSFER_MODES. Defaults to "archive", which uploads a single
+    compressed archive and supports binary files. "echo" is the
+    original line-by-line transfer and only supports text files.
+    "agent" talks to the provisioning agent installed by the shared
+    scripts instead, and cannot be used with the shell jump mode.
+    """
+
+    jump_mode: pulumi.Input[str]
+    """How the host is reached when a bastion is specified, one of
+    JUMP_MODES. Defaults to "tunnel", which does not require copying
+    the private key to the bastion.
+    """
+
+    output_limit: pulumi.Input[int]
+    """The maximum number of bytes of each of stdout and stderr to keep in
+    the outputs; beyond this only the head and the tail are kept. 0 for
+    unlimited. Defaults to DEFAULT_OUTPUT_LIMIT.
+    """
+
+    log_directory: pulumi.Input[Optional[str]]
+    """If specified, a local directory to which the complete stdout and
+    stderr of every execution is streamed as it arrives, one file per
+    execution. Defaults to DEFAULT_LOG_DIRECTORY unless the output policy is
+    "full".
+    """
+
+    output_policy: pulumi.Input[str]
+    """How the outputs are kept in the pulumi state, one of OUTPUT_POLICIES.
+    Defaults to DEFAULT_OUTPUT_POLICY. Unless "full", delete.sh is rendered
+    only with its own substitutions when the execution is destroyed, and
+    the other files are uploaded without substitutions.
+    """
+
+    bundle_cache_size: pulumi.Input[int]
+    """How many rendered bundles to keep cached under BUNDLES_DIR on the
+    host (and the bastion, when using the shell jump mode), so that a
+    bundle which is already present does not need to be uploaded again.
+    Only used in the archive transfer mode. 0 to disable caching, in which
+    case nothing is left on the remote machine after the execution.
+    Note that cached bundles include the substituted values.
+    """
+
+    connect_deadline: pulumi.Input[float]
+    """How many seconds to keep retrying to connect to the host (and the
+    bastion) before failing the execution. Defaults to
+    DEFAULT_CONNECT_DEADLINE.
+    """
+
+    trace_directory: pulumi.Input[Optional[str]]
+    """The local directory to which the timings of every execution are
+    appended as a Chrome trace, one file per pulumi up. Defaults to
+    DEFAULT_TRACE_DIRECTORY; an empty string disables tracing. The timings
+    are also available in the timings output regardless.
+    """
+
+    force_steps: pulumi.Input[Optional[List[str]]]
+    """The names of steps (see setup-scripts/shared/steps.sh) which are run
+    by every execution even if they already completed on the host with the
+    same inputs, or ["*"] for every step. Changing this replaces the
+    execution, so adding a step reruns it.
+    """
+
+    clear_steps: pulumi.Input[Optional[List[str]]]
+    """The names of steps whose completion markers are removed from the host
+    before every execution, including of delete.sh, or ["*"] for every step.
+    Useful when delete.sh undoes what the steps did.
+    """
+
+    inactivity_timeout: pulumi.Input[float]
+    """How many seconds the script may go without printing anything to
+    stdout or stderr before it is killed and the execution fails. Defaults to
+    DEFAULT_INACTIVITY_TIMEOUT; 0 to disable.
+    """
+
+    execution_deadline: pulumi.Input[float]
+    """How many seconds the script may run in total before it is killed and
+    the execution fails. Defaults to DEFAULT_EXECUTION_DEADLINE; 0 to disable.
+    """
+
     def __init__(
         self,
         script_name: str,
@@ -83,6 +295,18 @@ class RemoteExecutionInputs:
         private_key: str,
         bastion: Optional[str] = None,
         shared_script_name: Optional[str] = None,
+        transfer_mode: str = "archive",
+        jump_mode: str = "tunnel",
+        output_limit: int = DEFAULT_OUTPUT_LIMIT,
+        log_directory: Optional[str] = None,
+        bundle_cache_size: int = DEFAULT_BUNDLE_CACHE_SIZE,
+        connect_deadline: float = DEFAULT_CONNECT_DEADLINE,
+        trace_directory: Optional[str] = DEFAULT_TRACE_DIRECTORY,
+        force_steps: Optional[List[str]] = None,
+        clear_steps: Optional[List[str]] = None,
+        inactivity_timeout: float = DEFAULT_INACTIVITY_TIMEOUT,
+        execution_deadline: float = DEFAULT_EXECUTION_DEADLINE,
+        output_policy: str = DEFAULT_OUTPUT_POLICY,
     ):
         self.script_name = script_name
         self.file_substitutions = file_substitutions
@@ -90,6 +314,18 @@ class RemoteExecutionInputs:
         self.private_key = private_key
         self.bastion = bastion
         self.shared_script_name = shared_script_name
+        self.transfer_mode = transfer_mode
+        self.jump_mode = jump_mode
+        self.output_limit = output_limit
+        self.log_directory = log_directory
+        self.bundle_cache_size = bundle_cache_size
+        self.connect_deadline = connect_deadline
+        self.trace_directory = trace_directory
+        self.force_steps = force_steps
+        self.clear_steps = clear_steps
+        self.inactivity_timeout = inactivity_timeout
+        self.execution_deadline = execution_deadline
+        self.output_policy = output_policy
 
 
 class _RemoteExecutionInputs(TypedDict):
@@ -99,22 +335,44 @@ class _RemoteExecutionInputs(TypedDict):
     private_key: str
     bastion: Optional[str]
     shared_script_name: Optional[str]
+    transfer_mode: Optional[str]
+    jump_mode: Optional[str]
+    output_limit: Optional[int]
+    log_directory: Optional[str]
+    bundle_cache_size: Optional[int]
+    connect_deadline: Optional[float]
+    trace_directory: Optional[str]
+    force_steps: Optional[List[str]]
+    clear_steps: Optional[List[str]]
+    inactivity_timeout: Optional[float]
+    execution_deadline: Optional[float]
+    output_policy: Optional[str]
 
 
 class _RemoteExecutionOutputs(TypedDict):
     """The outputs of a remote execution."""
 
     stdout: str
-    """The resulting stdout from the execution."""
+    """The resulting stdout from the execution, kept according to the
+    output policy."""
 
     stderr: str
-    """The resulting stderr from the execution."""
+    """The resulting stderr from the execution, kept according to the
+    output policy."""
 
     script_name: str
     """The path to the script folder which was executed"""
 
     file_substitutions: Dict[str, Dict[str, str]]
-    """The file substitutions that were made during the execution."""
+    """The file substitutions that were made during the execution. Unless
+    the output policy is "full", only those of delete.sh."""
+
+    substitution_digests: Optional[Dict[str, str]]
+    """Unless the output policy is "full", the digest of the substitutions
+    of each file, keyed by relative path (see digest_substitutions)"""
+
+    substitution_salt: Optional[str]
+    """The key of the substitution digests"""
 
     script_hash: str
     """A stable hash of the contents of the script folder when the execution occurred,
@@ -138,12 +396,62 @@ class _RemoteExecutionOutputs(TypedDict):
     in the current working directory.
     """
 
+    transfer_mode: Optional[str]
+    """How the script folder was sent to the remote machine"""
+
+    jump_mode: Optional[str]
+    """How the host was reached through the bastion"""
+
+    output_limit: Optional[int]
+    """The maximum number of bytes of each of stdout and stderr kept"""
+
+    log_directory: Optional[str]
+    """The local directory the complete output was streamed to, if any"""
+
+    bundle_cache_size: Optional[int]
+    """How many rendered bundles are kept cached on the remote machine"""
+
+    connect_deadline: Optional[float]
+    """How many seconds to keep retrying to connect before failing"""
+
+    file_hashes: Dict[str, str]
+    """The hash of each file in the script folder when the execution occurred,
+    keyed by relative path, used to decide if a change can be applied in place
+    """
+
+    trace_directory: Optional[str]
+    """The local directory the timings were appended to as a Chrome trace"""
+
+    timings: List[Dict[str, Any]]
+    """The phases of the execution in the order they started, each with its
+    "name", "start" (seconds since the epoch) and "duration" (seconds).
+    Includes connecting, uploading, each step of the script and cleaning up.
+    """
+
+    force_steps: Optional[List[str]]
+    """The steps which were run even if they had already completed"""
+
+    clear_steps: Optional[List[str]]
+    """The steps whose completion markers were removed before executing"""
+
+    inactivity_timeout: Optional[float]
+    """How many seconds the script could go without output, 0 for unlimited"""
+
+    execution_deadline: Optional[float]
+    """How many seconds the script could run in total, 0 for unlimited"""
+
+    output_policy: Optional[str]
+    """How the outputs are kept in the state, one of OUTPUT_POLICIES"""
+
 
 class RemoteExecutionProvider(pulumi.dynamic.ResourceProvider):
     """Executes the scripts in setup-scripts/<script_name> on the remote
     host. In particular, this uploads the entire folder and runs main.sh,
     then deletes the folder. The started working directory is a subdirectory
     of "/usr/local/src"
+
+    Changes which only affect the files listed in the folders update_files.txt
+    are applied by running update.sh instead of replacing the execution.
     """
 
     def create(self, inputs: _RemoteExecutionInputs) -> pulumi.dynamic.CreateResult:
@@ -158,6 +466,18 @@ class RemoteExecutionProvider(pulumi.dynamic.ResourceProvider):
                     inputs["private_key"],
                     inputs.get("bastion"),
                     inputs.get("shared_script_name"),
+                    transfer_mode=inputs.get("transfer_mode") or "archive",
+                    jump_mode=inputs.get("jump_mode") or "tunnel",
+                    output_limit=get_output_limit(inputs),
+                    log_directory=inputs.get("log_directory"),
+                    bundle_cache_size=get_bundle_cache_size(inputs),
+                    connect_deadline=get_connect_deadline(inputs),
+                    trace_directory=get_trace_directory(inputs),
+                    force_steps=get_step_names(inputs, "force_steps"),
+                    clear_steps=get_step_names(inputs, "clear_steps"),
+                    inactivity_timeout=get_inactivity_timeout(inputs),
+                    execution_deadline=get_execution_deadline(inputs),
+                    output_policy=get_output_policy(inputs),
                 ),
             )
         except:
@@ -177,24 +497,87 @@ class RemoteExecutionProvider(pulumi.dynamic.ResourceProvider):
             olds.get("bastion"),
             olds.get("shared_script_name"),
             "delete.sh",
+            transfer_mode=olds.get("transfer_mode") or "archive",
+            jump_mode=olds.get("jump_mode") or "tunnel",
+            output_limit=get_output_limit(olds),
+            log_directory=olds.get("log_directory"),
+            bundle_cache_size=get_bundle_cache_size(olds),
+            connect_deadline=get_connect_deadline(olds),
+            trace_directory=get_trace_directory(olds),
+            force_steps=get_step_names(olds, "force_steps"),
+            clear_steps=get_step_names(olds, "clear_steps"),
+            inactivity_timeout=get_inactivity_timeout(olds),
+            execution_deadline=get_execution_deadline(olds),
+            output_policy=get_output_policy(olds),
         )
 
+    def update(
+        self, id: str, olds: _RemoteExecutionOutputs, news: _RemoteExecutionInputs
+    ) -> pulumi.dynamic.UpdateResult:
+        try:
+            return pulumi.dynamic.UpdateResult(
+                outs=self.execute_remotely(
+                    news["script_name"],
+                    news.get("file_substitutions"),
+                    news["host"],
+                    news["private_key"],
+                    news.get("bastion"),
+                    news.get("shared_script_name"),
+                    UPDATE_ENTRYPOINT,
+                    transfer_mode=news.get("transfer_mode") or "archive",
+                    jump_mode=news.get("jump_mode") or "tunnel",
+                    output_limit=get_output_limit(news),
+                    log_directory=news.get("log_directory"),
+                    bundle_cache_size=get_bundle_cache_size(news),
+                    connect_deadline=get_connect_deadline(news),
+                    trace_directory=get_trace_directory(news),
+                    force_steps=get_step_names(news, "force_steps"),
+                    clear_steps=get_step_names(news, "clear_steps"),
+                    inactivity_timeout=get_inactivity_timeout(news),
+                    execution_deadline=get_execution_deadline(news),
+                    output_policy=get_output_policy(news),
+                ),
+            )
+        except:
+            with open(f"remote_execution_error_{id}.txt", "a") as f_out:
+                print(f"{news=}", file=f_out)
+                traceback.print_exc(file=f_out)
+            raise
+
     def diff(
         self, id: str, olds: _RemoteExecutionOutputs, news: _RemoteExecutionInputs
     ) -> pulumi.dynamic.DiffResult:
-        script_hash = hash_directory(news["script_name"])
-        if news.get("shared_script_name") is not None:
-            script_hash += "+" + hash_directory(news["shared_script_name"])
+        script_hash = hash_script_folders(
+            news["script_name"], news.get("shared_script_name")
+        )
+        hot_files = get_update_files(news["script_name"])
 
         replaces = []
+        updates = []
         if olds["script_name"] != news["script_name"]:
             replaces.append("script_name")
 
-        if olds.get("file_substitutions") != news.get("file_substitutions"):
-            replaces.append("file_substitutions")
+        changed_files = get_changed_substitution_files_since(olds, news)
+        if changed_files:
+            if changed_files <= hot_files:
+                updates.append("file_substitutions")
+            else:
+                replaces.append("file_substitutions")
 
         if olds["script_hash"] != script_hash:
-            replaces.append("script_hash")
+            # executions from before hashes included paths and modes should
+            # only be replaced if the contents actually changed
+            legacy_script_hash = hash_script_folders(
+                news["script_name"],
+                news.get("shared_script_name"),
+                hash_fn=legacy_hash_directory,
+            )
+            if olds["script_hash"] != legacy_script_hash:
+                changed_files = get_changed_script_files(olds, news)
+                if changed_files is not None and changed_files <= hot_files:
+                    updates.append("script_hash")
+                else:
+                    replaces.append("script_hash")
 
         if olds["host"] != news["host"]:
             replaces.append("host")
@@ -202,14 +585,20 @@ class RemoteExecutionProvider(pulumi.dynamic.ResourceProvider):
         if olds.get("bastion") != news.get("bastion"):
             replaces.append("bastion")
 
-        if not replaces:
-            return pulumi.dynamic.DiffResult(changes=False)
+        if get_step_names(olds, "force_steps") != get_step_names(news, "force_steps"):
+            replaces.append("force_steps")
 
-        return pulumi.dynamic.DiffResult(
-            changes=True,
-            replaces=replaces,
-            delete_before_replace=olds["host"] == news["host"],
-        )
+        if replaces:
+            return pulumi.dynamic.DiffResult(
+                changes=True,
+                replaces=replaces,
+                delete_before_replace=olds["host"] == news["host"],
+            )
+
+        if updates:
+            return pulumi.dynamic.DiffResult(changes=True)
+
+        return pulumi.dynamic.DiffResult(changes=False)
 
     def execute_remotely(
         self,
@@ -220,117 +609,591 @@ class RemoteExecutionProvider(pulumi.dynamic.ResourceProvider):
         bastion: Optional[str] = None,
         shared_script_name: Optional[str] = None,
         entrypoint: str = "main.sh",
+        transfer_mode: str = "archive",
+        jump_mode: str = "tunnel",
+        output_limit: Optional[int] = DEFAULT_OUTPUT_LIMIT,
+        log_directory: Optional[str] = None,
+        bundle_cache_size: int = DEFAULT_BUNDLE_CACHE_SIZE,
+        connect_deadline: float = DEFAULT_CONNECT_DEADLINE,
+        trace_directory: Optional[str] = DEFAULT_TRACE_DIRECTORY,
+        force_steps: Optional[List[str]] = None,
+        clear_steps: Optional[List[str]] = None,
+        inactivity_timeout: Optional[float] = DEFAULT_INACTIVITY_TIMEOUT,
+        execution_deadline: Optional[float] = DEFAULT_EXECUTION_DEADLINE,
+        output_policy: str = DEFAULT_OUTPUT_POLICY,
     ) -> _RemoteExecutionOutputs:
         """Executes the given script on the remote host. May configure the
-        entrypoint, ie., which file to execute once the script is uploaded.
+        entrypoint, ie., which file to execute once the script is uploaded,
+        the transfer mode, ie., how the script folder is uploaded, and the
+        jump mode, ie., how the host is reached through the bastion.
+
+        At most output_limit bytes of each of stdout and stderr are kept
+        (unlimited if None), and if log_directory is specified the complete
+        output is streamed to a new file within it.
+
+        In the archive transfer mode, up to bundle_cache_size rendered bundles
+        are kept on the host (and, when jumping via the bastions shell, the
+        bastion) so that an identical bundle is never uploaded twice. The
+        agent transfer mode keeps bundles the same way, and falls back to the
+        archive transfer mode if the agent is not installed on the host.
+
+        Connecting is retried with backoff for up to connect_deadline seconds,
+        after which a RemoteConnectError is raised.
+
+        Every phase of the execution is timed and included in the outputs, and
+        also appended as a Chrome trace within trace_directory, if specified.
+
+        The steps in force_steps are run even if they already completed, and
+        the completion markers of the steps in clear_steps are removed before
+        the entrypoint is executed. See setup-scripts/shared/steps.sh.
+
+        If the entrypoint exits with a non-zero status, a RemoteCommandError is
+        raised with that status and the tail of stderr. If the script prints
+        nothing for inactivity_timeout seconds or runs for longer than
+        execution_deadline seconds (either None for unlimited), its process
+        group is killed and a RemoteCommandTimeoutError is raised.
+
+        The outputs are kept according to output_policy, one of
+        OUTPUT_POLICIES; unless it is "full", the complete output is always
+        streamed to log_directory, or DEFAULT_LOG_DIRECTORY.
         """
-        dirhash = hash_directory(script_name)
-
-        if shared_script_name is not None:
-            dirhash += "+" + hash_directory(shared_script_name)
-
-        single_file_script = io.StringIO()
-        single_file_script.write("cd /usr/local/src\n")
-        single_file_script.write('echo "sfs here 0"\n')
-
-        remote_dir = secrets.token_hex(8)
-        key_file = None if bastion is None else secrets.token_hex(8)
-        write_echo_commands_for_folder(
+        if transfer_mode not in TRANSFER_MODES:
+            raise ValueError(f"{transfer_mode=} must be one of {TRANSFER_MODES}")
+        if jump_mode not in JUMP_MODES:
+            raise ValueError(f"{jump_mode=} must be one of {JUMP_MODES}")
+        if output_policy not in OUTPUT_POLICIES:
+            raise ValueError(f"{output_policy=} must be one of {OUTPUT_POLICIES}")
+        if output_policy != "full" and log_directory is None:
+            log_directory = DEFAULT_LOG_DIRECTORY
+        for step_name in (force_steps or []) + (clear_steps or []):
+            if not STEP_NAME_REGEX.match(step_name):
+                raise ValueError(f"{step_name=} must match {STEP_NAME_REGEX.pattern}")
+
+        timer = PhaseTimer()
+        start = time.time()
+        started_at = time.perf_counter()
+
+        retry_policy = ConnectRetryPolicy(deadline=connect_deadline)
+        via_bastion_shell = bastion is not None and jump_mode == "shell"
+        dirhash = hash_script_folders(script_name, shared_script_name)
+        rendered = render_execution(
             script_name,
-            remote_dir,
-            single_file_script,
-            file_substitutions=file_substitutions,
+            file_substitutions,
+            host,
+            private_key,
+            bastion,
+            shared_script_name,
+            entrypoint,
+            transfer_mode=transfer_mode,
+            jump_mode=jump_mode,
+            bundle_cache_size=bundle_cache_size,
+            force_steps=force_steps,
+            clear_steps=clear_steps,
+            retry_policy=retry_policy,
         )
-
-        if shared_script_name is not None:
-            write_echo_commands_for_folder(
-                shared_script_name,
-                os.path.join(remote_dir, "shared"),
-                single_file_script,
-                file_substitutions=file_substitutions,
+        uploads = rendered.uploads
+        archive_file = rendered.archive_file
+        agent_bundle_hash = rendered.agent_bundle_hash
+
+        log_path = None
+        if log_directory is not None:
+            os.makedirs(log_directory, exist_ok=True)
+            log_path = os.path.join(
+                log_directory,
+                "{}-{}-{}-{}-{}.log".format(
+                    time.strftime("%Y%m%d-%H%M%S"),
+                    host,
+                    os.path.basename(os.path.normpath(script_name)),
+                    os.path.splitext(entrypoint)[0],
+                    secrets.token_hex(4),
+                ),
             )
+        timer.record("render", start, time.perf_counter() - started_at)
 
-        if bastion is None:
-            single_file_script.write(f"cd {remote_dir}\n")
-            single_file_script.write(f"bash {entrypoint}\n")
-            single_file_script.write("cd ..\n")
-        else:
-            write_echo_commands_for_file(
-                private_key, key_file, single_file_script, mark_executable=False
-            )
-            single_file_script.write(f"chmod 400 {key_file}\n")
-            single_file_script.write('echo "sfs here 1"\n')
-            single_file_script.write(
-                f"while ! ssh -i {key_file} -oStrictHostKeyChecking=no -oBatchMode=no ec2-user@{host} true\n"
-            )
-            single_file_script.write("do\n")
-            single_file_script.write("  sleep 1\n")
-            single_file_script.write("done\n")
+        try:
+            with timer.phase("connect"):
+                pooled = retry_policy.run(
+                    lambda: SSH_POOL.acquire(
+                        host,
+                        private_key,
+                        bastion=bastion,
+                        tunnel=not via_bastion_shell,
+                        probe_timeout=retry_policy.probe_timeout,
+                        timer=timer,
+                    ),
+                    f"ec2-user@{host}"
+                    if bastion is None
+                    else f"ec2-user@{host} via {bastion}",
+                )
 
-            single_file_script.write(
-                f"sftp -i {key_file} -oStrictHostKeyChecking=no -oBatchMode=no -b - ec2-user@{host} <<EOF\n"
+            try:
+                outputs = None
+                if agent_bundle_hash is not None:
+                    outputs = self._run_via_agent(
+                        pooled.client,
+                        uploads[archive_file],
+                        agent_bundle_hash,
+                        rendered.agent_script,
+                        bundle_name=os.path.basename(os.path.normpath(script_name)),
+                        output_limit=output_limit,
+                        log_path=log_path,
+                        timer=timer,
+                        inactivity_timeout=inactivity_timeout,
+                        execution_deadline=execution_deadline,
+                        bundle_cache_size=bundle_cache_size,
+                    )
+                if outputs is None:
+                    outputs = self._upload_and_run(
+                        pooled.client,
+                        rendered.script,
+                        uploads,
+                        cached_uploads=rendered.cached_uploads,
+                        output_limit=output_limit,
+                        log_path=log_path,
+                        timer=timer,
+                        inactivity_timeout=inactivity_timeout,
+                        execution_deadline=execution_deadline,
+                    )
+                stdout, stderr = outputs
+            except BaseException:
+                SSH_POOL.release(pooled, discard=True)
+                raise
+            SSH_POOL.release(pooled)
+        finally:
+            timer.record("execute", start, time.perf_counter() - started_at)
+            if trace_directory:
+                append_chrome_trace(
+                    trace_directory,
+                    "{} {} {}".format(
+                        host,
+                        os.path.basename(os.path.normpath(script_name)),
+                        entrypoint,
+                    ),
+                    timer.to_outputs(),
+                )
+
+        substitution_salt = None
+        substitution_digests = None
+        kept_substitutions = file_substitutions
+        if output_policy != "full":
+            stdout = compact_output(stdout, output_policy)
+            stderr = compact_output(stderr, output_policy)
+            substitution_salt = secrets.token_hex(16)
+            substitution_digests = digest_substitutions(
+                file_substitutions, substitution_salt
             )
-            single_file_script.write(f"put -r {remote_dir}\n")
-            single_file_script.write("EOF\n")
-            single_file_script.write('echo "sfs here 2"\n')
-            single_file_script.write(
-                f"ssh -i {key_file} -oStrictHostKeyChecking=no -oBatchMode=no ec2-user@{host} <<EOF\n"
+            kept_substitutions = dict(
+                (file, subs)
+                for file, subs in (file_substitutions or dict()).items()
+                if file == "delete.sh"
             )
-            single_file_script.write(f"cd {remote_dir}\n")
-            single_file_script.write(f"sudo bash {entrypoint}\n")
-            single_file_script.write("cd ..\n")
-            single_file_script.write(f"rm -rf {remote_dir}\n")
-            single_file_script.write("EOF\n")
-            single_file_script.write('echo "sfs here 3"\n')
 
-        single_file_script.write(f"rm -rf {remote_dir}\n")
-
-        if bastion is not None:
-            single_file_script.write(f"rm -f {key_file}\n")
-
-        single_file_script_str = single_file_script.getvalue()
+        return _RemoteExecutionOutputs(
+            stdout=stdout,
+            stderr=stderr,
+            script_name=script_name,
+            file_substitutions=kept_substitutions,
+            substitution_digests=substitution_digests,
+            substitution_salt=substitution_salt,
+            script_hash=dirhash,
+            private_key=private_key,
+            host=host,
+            bastion=bastion,
+            shared_script_name=shared_script_name,
+            transfer_mode=transfer_mode,
+            jump_mode=jump_mode,
+            output_limit=output_limit or 0,
+            log_directory=log_directory,
+            bundle_cache_size=bundle_cache_size,
+            connect_deadline=connect_deadline,
+            file_hashes=hash_files(script_name),
+            trace_directory=trace_directory,
+            timings=timer.to_outputs(),
+            force_steps=force_steps,
+            clear_steps=clear_steps,
+            inactivity_timeout=inactivity_timeout or 0,
+            execution_deadline=execution_deadline or 0,
+            output_policy=output_policy,
+        )
 
-        for _ in range(150):
-            client = paramiko.SSHClient()
-            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            try:
-                client.connect(
-                    hostname=host if bastion is None else bastion,
-                    username="ec2-user",
-                    key_filename=private_key,
-                    look_for_keys=False,
-                    auth_timeout=5,
-                    banner_timeout=5,
-                )
-            except Exception:
-                time.sleep(2)
-                continue
+    def _upload_and_run(
+        self,
+        client: paramiko.SSHClient,
+        single_file_script_str: str,
+        uploads: Dict[str, bytes],
+        cached_uploads: Optional[Dict[str, str]] = None,
+        output_limit: Optional[int] = DEFAULT_OUTPUT_LIMIT,
+        log_path: Optional[str] = None,
+        timer: Optional[PhaseTimer] = None,
+        inactivity_timeout: Optional[float] = DEFAULT_INACTIVITY_TIMEOUT,
+        execution_deadline: Optional[float] = DEFAULT_EXECUTION_DEADLINE,
+    ) -> Tuple[str, str]:
+        """Uploads the generated script and any additional files to the home
+        directory of the connected machine, then runs the script as root,
+        returning the stdout and stderr. If log_path is specified, each line
+        of output is appended to that file as it arrives.
+
+        Uploads which have a command in cached_uploads are skipped if that
+        command prints "present".
+
+        If a timer is specified, each phase is recorded on it, including each
+        step the script marks by printing a line starting with PHASE_MARKER.
+
+        The script runs in its own process group, which is killed if the
+        script goes inactivity_timeout seconds without output or runs for
+        longer than execution_deadline seconds. Raises a RemoteCommandError
+        if the script exits with a non-zero status.
+        """
+        skipped = set()
+        with timed(timer, "check_cache"):
+            for upload_path, check_command in (cached_uploads or dict()).items():
+                check_stdout, _ = exec_simple(client, check_command)
+                if check_stdout.strip() == "present":
+                    skipped.add(upload_path)
+
+        single_file_script_iden = secrets.token_hex(8) + ".sh"
+        with timed(timer, "upload"):
             sftp = client.open_sftp()
 
-            single_file_script_iden = secrets.token_hex(8) + ".sh"
             single_file_script_remote_path = f"/home/ec2-user/{single_file_script_iden}"
             with sftp.open(single_file_script_remote_path, "w") as remote_file:
+                remote_file.write(f'echo "{PROCESS_GROUP_MARKER}$$"\n')
                 remote_file.write(single_file_script_str)
 
             sftp.chmod(single_file_script_remote_path, 0o755)
+
+            for upload_path, upload_contents in uploads.items():
+                if upload_path in skipped:
+                    continue
+                sftp.putfo(io.BytesIO(upload_contents), f"/home/ec2-user/{upload_path}")
             sftp.close()
 
-            exec_simple(client, "cd ~")
-            stdout, stderr = exec_simple(client, f"sudo bash {single_file_script_iden}")
-            exec_simple(client, f"rm {single_file_script_iden}")
+        with contextlib.ExitStack() as stack:
+            log_file = None
+            if log_path is not None:
+                log_file = stack.enter_context(open(log_path, "a", buffering=1))
+
+            process_group: List[int] = []
+            on_output_line, on_stderr_line = make_line_handlers(timer, log_file)
+
+            def on_stdout_line(line: str) -> None:
+                if not process_group and line.startswith(PROCESS_GROUP_MARKER):
+                    process_group.append(int(line[len(PROCESS_GROUP_MARKER) :]))
+                on_output_line(line)
+
+            succeeded = False
+            try:
+                with timed(timer, "run"):
+                    stdout, stderr = exec_simple(
+                        client,
+                        f"sudo setsid -w bash {single_file_script_iden}",
+                        cmd_timeout=execution_deadline,
+                        on_stdout_line=on_stdout_line,
+                        on_stderr_line=on_stderr_line,
+                        output_limit=output_limit,
+                        inactivity_timeout=inactivity_timeout,
+                        check=True,
+                    )
+                succeeded = True
+            except RemoteCommandTimeoutError:
+                if process_group:
+                    kill_process_group(client, process_group[0])
+                raise
+            finally:
+                if timer is not None:
+                    timer.end_mark()
+                with timed(timer, "remove_script"):
+                    try:
+                        exec_simple(client, f"rm -f {single_file_script_iden}")
+                    except Exception:
+                        # don't hide why the script failed
+                        if succeeded:
+                            raise
+        return stdout, stderr
+
+    def _run_via_agent(
+        self,
+        client: paramiko.SSHClient,
+        archive: bytes,
+        bundle_hash: str,
+        script: str,
+        bundle_name: Optional[str] = None,
+        output_limit: Optional[int] = DEFAULT_OUTPUT_LIMIT,
+        log_path: Optional[str] = None,
+        timer: Optional[PhaseTimer] = None,
+        inactivity_timeout: Optional[float] = DEFAULT_INACTIVITY_TIMEOUT,
+        execution_deadline: Optional[float] = DEFAULT_EXECUTION_DEADLINE,
+        bundle_cache_size: int = DEFAULT_BUNDLE_CACHE_SIZE,
+    ) -> Optional[Tuple[str, str]]:
+        """Runs the given bash script within the bundle with the given hash
+        via the provisioning agent on the connected machine, sending the
+        archive only if the agent does not have it, and returns the stdout
+        and stderr in the same way as _upload_and_run. Returns None, having
+        done nothing, if the agent is not available on the machine.
+
+        If bundle_name is specified, the bundle is sent as a delta against the
+        latest bundle with that name on the machine when that is smaller.
+
+        The agent kills the script if it goes inactivity_timeout seconds
+        without output or runs for longer than execution_deadline seconds,
+        raising a RemoteCommandTimeoutError, and a non-zero exit status
+        raises a RemoteCommandError.
+        """
+        try:
+            with timed(timer, "agent_hello"):
+                session, chan = connect_over_ssh(client)
+        except AgentUnavailableError:
+            return None
+
+        # the agent reports inactivity itself, so this only catches a hung
+        # connection or agent
+        if inactivity_timeout is not None:
+            chan.settimeout(inactivity_timeout + 60)
+
+        stdout = _OutputCapture(output_limit)
+        stderr = _OutputCapture(output_limit)
+        try:
+            with timed(timer, "upload"):
+                session.ensure_bundle(bundle_hash, archive, name=bundle_name)
+
+            with contextlib.ExitStack() as stack:
+                log_file = None
+                if log_path is not None:
+                    log_file = stack.enter_context(open(log_path, "a", buffering=1))
+                stdout.on_line, stderr.on_line = make_line_handlers(timer, log_file)
+                captures = {"stdout": stdout, "stderr": stderr}
+
+                try:
+                    with timed(timer, "run"):
+                        result = session.run(
+                            bundle_hash,
+                            script,
+                            lambda stream, data: captures[stream].feed(data),
+                            inactivity_timeout=inactivity_timeout,
+                            deadline=execution_deadline,
+                            bundle_cache_size=bundle_cache_size,
+                        )
+                finally:
+                    if timer is not None:
+                        timer.end_mark()
+                stdout_str, stderr_str = stdout.finish(), stderr.finish()
+            session.close()
+        finally:
+            chan.close()
+
+        if result.timed_out is not None:
+            raise RemoteCommandTimeoutError(
+                f"the agent killed {script=} due to {result.timed_out}"
+            )
+        if result.exit_status != 0:
+            raise RemoteCommandError(script, result.exit_status, stderr_str)
+        return stdout_str, stderr_str
+
+
+class RenderedExecution:
+    """Everything which is sent to the remote machine by an execution, as
+    rendered by render_execution, before anything is connected to
+    """
+
+    def __init__(
+        self,
+        script: str,
+        agent_script: str,
+        uploads: Dict[str, bytes],
+        cached_uploads: Dict[str, str],
+        archive_file: Optional[str],
+        agent_bundle_hash: Optional[str],
+    ) -> None:
+        self.script: str = script
+        """The bash script which is uploaded and run over ssh"""
+
+        self.agent_script: str = agent_script
+        """The bash script which the provisioning agent runs within the
+        bundle instead, in the agent transfer mode"""
+
+        self.uploads: Dict[str, bytes] = uploads
+        """Additional files to upload via sftp alongside the script, where
+        the keys are paths relative to the home directory"""
+
+        self.cached_uploads: Dict[str, str] = cached_uploads
+        """Commands which print "present" if the upload with the same key is
+        already available on the remote machine, and hence can be skipped"""
+
+        self.archive_file: Optional[str] = archive_file
+        """The key of the tar.gz of the script folders within uploads, if
+        the transfer mode uses one"""
+
+        self.agent_bundle_hash: Optional[str] = agent_bundle_hash
+        """The hash of the bundle sent to the agent, in the agent transfer
+        mode"""
+
+
+def render_execution(
+    script_name: str,
+    file_substitutions: Optional[Dict[str, Dict[str, str]]],
+    host: str,
+    private_key: str,
+    bastion: Optional[str] = None,
+    shared_script_name: Optional[str] = None,
+    entrypoint: str = "main.sh",
+    transfer_mode: str = "archive",
+    jump_mode: str = "tunnel",
+    bundle_cache_size: int = DEFAULT_BUNDLE_CACHE_SIZE,
+    force_steps: Optional[List[str]] = None,
+    clear_steps: Optional[List[str]] = None,
+    retry_policy: Optional[ConnectRetryPolicy] = None,
+) -> RenderedExecution:
+    """Renders exactly what executing the given script remotely would send,
+    without connecting to anything. See RemoteExecutionProvider.execute_remotely
+    for the arguments; retry_policy is used by the bastion hop in the shell
+    jump mode. Note that the shell jump mode copies the private key onto the
+    bastion, so it is included in the result.
+    """
+    validate_substitutions([script_name, shared_script_name], file_substitutions)
+
+    via_bastion_shell = bastion is not None and jump_mode == "shell"
+    if transfer_mode == "agent" and via_bastion_shell:
+        raise ValueError("the agent transfer mode requires the tunnel jump mode")
+    if retry_policy is None:
+        retry_policy = ConnectRetryPolicy()
+
+    remote_dir = secrets.token_hex(8)
+    key_file = secrets.token_hex(8) if via_bastion_shell else None
+    archive_file = None
+    bundle_hash = None
+    agent_bundle_hash = None
+    uploads: Dict[str, bytes] = dict()
+    cached_uploads: Dict[str, str] = dict()
+
+    if transfer_mode in ("archive", "agent"):
+        archive_file = secrets.token_hex(8) + ".tar.gz"
+        uploads[archive_file] = build_archive(
+            script_name,
+            shared_script_name,
+            file_substitutions=file_substitutions,
+        )
+        if transfer_mode == "agent":
+            agent_bundle_hash = hashlib.sha256(uploads[archive_file]).hexdigest()
+        if bundle_cache_size > 0:
+            bundle_hash = hashlib.sha256(uploads[archive_file]).hexdigest()
+            cached_bundle = f"{BUNDLES_DIR}/{bundle_hash}"
+            if via_bastion_shell:
+                cached_bundle += ".tar.gz"
+            cached_uploads[archive_file] = (
+                f"sudo test -e {cached_bundle} && sudo touch {cached_bundle}"
+                " && echo present"
+            )
+
+    host_script = io.StringIO()
+    host_script.write("cd /usr/local/src\n")
+    host_script.write('echo "sfs here 0"\n')
+    host_script.write(f'echo "{PHASE_MARKER}unpack"\n')
 
-            client.close()
+    if transfer_mode == "echo":
+        write_echo_commands_for_folder(
+            script_name,
+            remote_dir,
+            host_script,
+            file_substitutions=file_substitutions,
+        )
 
-            return _RemoteExecutionOutputs(
-                stdout=stdout,
-                stderr=stderr,
-                script_name=script_name,
+        if shared_script_name is not None:
+            write_echo_commands_for_folder(
+                shared_script_name,
+                os.path.join(remote_dir, "shared"),
+                host_script,
                 file_substitutions=file_substitutions,
-                script_hash=dirhash,
-                private_key=private_key,
-                host=host,
-                bastion=bastion,
             )
+    elif bundle_hash is not None:
+        write_bundle_commands(
+            f"/home/ec2-user/{archive_file}",
+            bundle_hash,
+            remote_dir,
+            host_script,
+            bundle_cache_size,
+        )
+    else:
+        write_unpack_commands(f"/home/ec2-user/{archive_file}", remote_dir, host_script)
+
+    host_script.write(f"cd {remote_dir}\n")
+    write_step_commands(host_script, force_steps, clear_steps)
+    host_script.write(f'echo "{PHASE_MARKER}{entrypoint}"\n')
+    if not via_bastion_shell:
+        host_script.write(f"bash {entrypoint}\n")
+    else:
+        host_script.write(f"bash {entrypoint} < /dev/null\n")
+    host_script.write("sfs_status=$?\n")
+    host_script.write(f'echo "{PHASE_MARKER}cleanup"\n')
+    host_script.write("cd ..\n")
+    host_script.write(f"rm -rf {remote_dir}\n")
+    host_script.write("exit $sfs_status\n")
+
+    agent_script = io.StringIO()
+    write_step_commands(agent_script, force_steps, clear_steps)
+    agent_script.write(f'echo "{PHASE_MARKER}{entrypoint}"\n')
+    agent_script.write(f"bash {entrypoint}\n")
+
+    if not via_bastion_shell:
+        single_file_script_str = host_script.getvalue()
+    elif transfer_mode == "echo":
+        single_file_script = io.StringIO()
+        single_file_script.write("cd /usr/local/src\n")
+        write_echo_commands_for_file(
+            private_key, key_file, single_file_script, mark_executable=False
+        )
+        write_bastion_hop_commands(
+            host,
+            key_file,
+            host_script.getvalue(),
+            single_file_script,
+            retry_policy=retry_policy,
+        )
+        single_file_script.write("exit $sfs_status\n")
+        single_file_script_str = single_file_script.getvalue()
+    else:
+        with open(private_key, "rb") as f:
+            uploads[key_file] = f.read()
+        key_file = f"/home/ec2-user/{key_file}"
+
+        single_file_script = io.StringIO()
+        single_file_script.write("cd /usr/local/src\n")
+        transferred = f"/home/ec2-user/{archive_file}"
+        if bundle_hash is not None:
+            transferred = f"{BUNDLES_DIR}/{bundle_hash}.tar.gz"
+            single_file_script.write(f"mkdir -p -m 700 {BUNDLES_DIR}\n")
+            single_file_script.write(f"if [ -f /home/ec2-user/{archive_file} ]\n")
+            single_file_script.write("then\n")
+            single_file_script.write(
+                f"    mv /home/ec2-user/{archive_file} {transferred}\n"
+            )
+            single_file_script.write("fi\n")
+            single_file_script.write(f"touch {transferred}\n")
+            write_prune_bundles_commands(bundle_cache_size, single_file_script)
+
+        write_bastion_hop_commands(
+            host,
+            key_file,
+            host_script.getvalue(),
+            single_file_script,
+            transferred=transferred,
+            transferred_as=archive_file,
+            cached_bundle=(
+                None if bundle_hash is None else f"{BUNDLES_DIR}/{bundle_hash}"
+            ),
+            retry_policy=retry_policy,
+        )
+        single_file_script.write(f"rm -f /home/ec2-user/{archive_file}\n")
+        single_file_script.write("exit $sfs_status\n")
+        single_file_script_str = single_file_script.getvalue()
+
+    return RenderedExecution(
+        single_file_script_str,
+        agent_script.getvalue(),
+        uploads,
+        cached_uploads,
+        archive_file,
+        agent_bundle_hash,
+    )
 
 
 class RemoteExecution(pulumi.dynamic.Resource):
@@ -384,52 +1247,457 @@ class RemoteExecution(pulumi.dynamic.Resource):
         )
 
 
+def get_output_limit(values: Dict[str, Optional[int]]) -> Optional[int]:
+    """Determines the output limit from the given inputs or outputs of a
+    remote execution, where a missing value means the default and 0 means
+    unlimited
+    """
+    output_limit = values.get("output_limit", DEFAULT_OUTPUT_LIMIT)
+    if output_limit is None:
+        return DEFAULT_OUTPUT_LIMIT
+    return int(output_limit) or None
+
+
+def get_output_policy(values: Dict[str, Optional[str]]) -> str:
+    """Determines the output policy from the given inputs or outputs of a
+    remote execution, where a missing value means "full" for outputs from
+    before output policies existed and DEFAULT_OUTPUT_POLICY for inputs
+    """
+    output_policy = values.get("output_policy")
+    if output_policy is None:
+        return "full" if "script_hash" in values else DEFAULT_OUTPUT_POLICY
+    return output_policy
+
+
+def get_trace_directory(values: Dict[str, Optional[str]]) -> Optional[str]:
+    """Determines the trace directory from the given inputs or outputs of a
+    remote execution, where a missing value means the default and an empty
+    string means tracing is disabled
+    """
+    trace_directory = values.get("trace_directory")
+    if trace_directory is None:
+        return DEFAULT_TRACE_DIRECTORY
+    return trace_directory or None
+
+
+def get_step_names(values: Dict[str, Any], key: str) -> Optional[List[str]]:
+    """Determines the sorted, deduplicated step names under the given key of
+    the inputs or outputs of a remote execution, or None if there are none
+    """
+    step_names = values.get(key)
+    if not step_names:
+        return None
+    return sorted(set(step_names))
+
+
+def get_inactivity_timeout(values: Dict[str, Optional[float]]) -> Optional[float]:
+    """Determines the inactivity timeout from the given inputs or outputs of
+    a remote execution, where a missing value means the default and 0 means
+    unlimited
+    """
+    inactivity_timeout = values.get("inactivity_timeout")
+    if inactivity_timeout is None:
+        return DEFAULT_INACTIVITY_TIMEOUT
+    return float(inactivity_timeout) or None
+
+
+def get_execution_deadline(values: Dict[str, Optional[float]]) -> Optional[float]:
+    """Determines the execution deadline from the given inputs or outputs of
+    a remote execution, where a missing value means the default and 0 means
+    unlimited
+    """
+    execution_deadline = values.get("execution_deadline")
+    if execution_deadline is None:
+        return DEFAULT_EXECUTION_DEADLINE
+    return float(execution_deadline) or None
+
+
+def get_connect_deadline(values: Dict[str, Optional[float]]) -> float:
+    """Determines the connect deadline from the given inputs or outputs of
+    a remote execution, where a missing value means the default
+    """
+    connect_deadline = values.get("connect_deadline")
+    if connect_deadline is None:
+        return DEFAULT_CONNECT_DEADLINE
+    return float(connect_deadline)
+
+
+def get_bundle_cache_size(values: Dict[str, Optional[int]]) -> int:
+    """Determines the bundle cache size from the given inputs or outputs of
+    a remote execution, where a missing value means the default
+    """
+    bundle_cache_size = values.get("bundle_cache_size")
+    if bundle_cache_size is None:
+        return DEFAULT_BUNDLE_CACHE_SIZE
+    return int(bundle_cache_size)
+
+
+def make_line_handlers(
+    timer: Optional[PhaseTimer], log_file: Optional[TextIO]
+) -> Tuple[Callable[[str], None], Optional[Callable[[str], None]]]:
+    """Returns the callbacks for each line of stdout and stderr of a script
+    which mark its steps on the timer, if specified, and append the line to
+    the log file, if specified. The stderr callback is None if there is
+    nothing to do for it.
+    """
+
+    def on_stdout_line(line: str) -> None:
+        if timer is not None and line.startswith(PHASE_MARKER):
+            timer.mark(line[len(PHASE_MARKER) :].strip())
+        if log_file is not None:
+            print(line, file=log_file)
+
+    on_stderr_line = None
+    if log_file is not None:
+        on_stderr_line = lambda line: print(f"[stderr] {line}", file=log_file)
+
+    return on_stdout_line, on_stderr_line
+
+
+class _OutputCapture:
+    """Captures one output stream of a command, keeping at most limit bytes
+    by retaining the first half (the head) and a ring buffer of the most
+    recent half (the tail). Optionally forwards complete lines as they arrive.
+    """
+
+    def __init__(
+        self,
+        limit: Optional[int] = DEFAULT_OUTPUT_LIMIT,
+        on_line: Optional[Callable[[str], None]] = None,
+    ) -> None:
+        self.limit: Optional[int] = limit
+        """The maximum number of bytes to keep, or None for unlimited"""
+
+        self.on_line: Optional[Callable[[str], None]] = on_line
+        """If specified, called with each line (without the newline) as it arrives"""
+
+        self.head = bytearray()
+        self.tail: Deque[bytes] = collections.deque()
+        self.tail_size: int = 0
+        self.omitted: int = 0
+        self.partial_line = bytearray()
+
+    def feed(self, data: bytes) -> None:
+        """Captures the given data from the stream"""
+        if self.on_line is not None:
+            self.partial_line += data
+            *lines, rest = self.partial_line.split(b"\n")
+            self.partial_line = bytearray(rest)
+            for line in lines:
+                self.on_line(line.decode("utf-8", errors="replace"))
+
+        if self.limit is None:
+            self.head += data
+            return
+
+        head_limit = self.limit // 2
+        if len(self.head) < head_limit:
+            to_head = data[: head_limit - len(self.head)]
+            self.head += to_head
+            data = data[len(to_head) :]
+            if not data:
+                return
+
+        self.tail.append(data)
+        self.tail_size += len(data)
+        tail_limit = self.limit - head_limit
+        while self.tail_size > tail_limit:
+            excess = self.tail_size - tail_limit
+            oldest = self.tail[0]
+            if len(oldest) <= excess:
+                self.tail.popleft()
+                self.tail_size -= len(oldest)
+                self.omitted += len(oldest)
+            else:
+                self.tail[0] = oldest[excess:]
+                self.tail_size -= excess
+                self.omitted += excess
+
+    def finish(self) -> str:
+        """Flushes any incomplete final line and returns the captured output"""
+        if self.on_line is not None and self.partial_line:
+            self.on_line(self.partial_line.decode("utf-8", errors="replace"))
+            self.partial_line = bytearray()
+
+        result = bytes(self.head)
+        if self.omitted:
+            result += f"\n... [{self.omitted} bytes omitted] ...\n".encode("utf-8")
+        result += b"".join(self.tail)
+        return result.decode("utf-8", errors="replace")
+
+
+class RemoteCommandError(Exception):
+    """Raised when a remote command exits with a non-zero status"""
+
+    def __init__(self, command: str, exit_status: int, stderr: str) -> None:
+        """Creates a new error for the given command, which exited with the
+        given status (-1 if the connection closed without one) after printing
+        the given stderr, of which only the tail is kept
+        """
+        stderr_tail = "\n".join(stderr.rstrip("\n").split("\n")[-STDERR_TAIL_LINES:])
+        super().__init__(
+            f"{command=} exited with status {exit_status}; stderr tail:\n{stderr_tail}"
+        )
+        self.command: str = command
+        """The command which failed"""
+
+        self.exit_status: int = exit_status
+        """The exit status of the command"""
+
+        self.stderr_tail: str = stderr_tail
+        """The last STDERR_TAIL_LINES lines of stderr"""
+
+
+class RemoteCommandTimeoutError(TimeoutError):
+    """Raised when a remote command is abandoned because it went too long
+    without output or exceeded its deadline
+    """
+
+
 def exec_simple(
-    client: paramiko.SSHClient, command: str, timeout=15, cmd_timeout=3600
+    client: paramiko.SSHClient,
+    command: str,
+    timeout=15,
+    cmd_timeout: Optional[float] = 3600,
+    on_stdout_line: Optional[Callable[[str], None]] = None,
+    on_stderr_line: Optional[Callable[[str], None]] = None,
+    output_limit: Optional[int] = DEFAULT_OUTPUT_LIMIT,
+    inactivity_timeout: Optional[float] = None,
+    check: bool = False,
 ) -> Tuple[str, str]:
     """Executes the given command on the paramiko client, waiting for
-    the command to finish before returning the stdout and stderr
+    the command to finish before returning the stdout and stderr.
+
+    Output is read as soon as it arrives, so the remote side is never
+    stalled on a full channel window. Lines may be streamed to the given
+    callbacks as they arrive, and at most output_limit bytes of each
+    stream are kept (the head and the tail), unless it is None.
+
+    Raises a RemoteCommandTimeoutError if the command does not finish within
+    cmd_timeout seconds or prints nothing for inactivity_timeout seconds
+    (either None for unlimited). Note that the remote process is not killed.
+    If check is True, raises a RemoteCommandError if the command exits with
+    a non-zero status.
     """
     chan = client.get_transport().open_session(timeout=timeout)
-    chan.settimeout(cmd_timeout)
     chan.exec_command(command)
-    stdout = chan.makefile("r", 8192)
-    stderr = chan.makefile_stderr("r", 8192)
 
-    all_stdout = io.BytesIO()
-    all_stderr = io.BytesIO()
+    stdout = _OutputCapture(output_limit, on_stdout_line)
+    stderr = _OutputCapture(output_limit, on_stderr_line)
+    deadline = None if cmd_timeout is None else time.monotonic() + cmd_timeout
+    last_output_at = time.monotonic()
 
-    while not chan.exit_status_ready():
-        time.sleep(0.1)
+    try:
+        while True:
+            if chan.recv_ready():
+                stdout.feed(chan.recv(READ_SIZE))
+                last_output_at = time.monotonic()
+                continue
 
-        from_stdout = stdout.read(4096)
-        from_stderr = stderr.read(4096)
+            if chan.recv_stderr_ready():
+                stderr.feed(chan.recv_stderr(READ_SIZE))
+                last_output_at = time.monotonic()
+                continue
 
-        if from_stdout is not None:
-            all_stdout.write(from_stdout)
+            # output can still arrive after the exit status, so the output is
+            # only complete once the remote side has closed both streams (and
+            # the buffers above are drained)
+            if chan.exit_status_ready() and (chan.eof_received or chan.closed):
+                break
+
+            now = time.monotonic()
+            wait_for = 1.0
+            if deadline is not None:
+                if now >= deadline:
+                    raise RemoteCommandTimeoutError(
+                        f"{command=} did not finish within {cmd_timeout=}"
+                    )
+                wait_for = min(wait_for, deadline - now)
+            if inactivity_timeout is not None:
+                inactive_until = last_output_at + inactivity_timeout
+                if now >= inactive_until:
+                    raise RemoteCommandTimeoutError(
+                        f"{command=} printed nothing for {inactivity_timeout=}"
+                    )
+                wait_for = min(wait_for, inactive_until - now)
+
+            select.select([chan], [], [], wait_for)
+
+        exit_status = chan.recv_exit_status()
+    finally:
+        chan.close()
+
+    stdout_str, stderr_str = stdout.finish(), stderr.finish()
+    if check and exit_status != 0:
+        raise RemoteCommandError(command, exit_status, stderr_str)
+    return stdout_str, stderr_str
+
+
+def kill_process_group(
+    client: paramiko.SSHClient, process_group: int, grace_period: float = 5
+) -> None:
+    """Best-effort kills the given process group on the connected machine,
+    first with SIGTERM and then, after grace_period seconds, with SIGKILL
+    """
+    try:
+        exec_simple(
+            client,
+            f"sudo kill -TERM -- -{process_group}; sleep {grace_period};"
+            f" sudo kill -KILL -- -{process_group}; true",
+            cmd_timeout=grace_period + 15,
+        )
+    except Exception:
+        traceback.print_exc()
 
-        if from_stderr is not None:
-            all_stderr.write(from_stderr)
 
-    while from_stdout := stdout.read(4096):
-        all_stdout.write(from_stdout)
+def hash_script_folders(
+    script_name: str,
+    shared_script_name: Optional[str] = None,
+    hash_fn: Callable[[str], str] = hash_directory,
+) -> str:
+    """Returns the script hash for the given script folder and, if specified,
+    shared script folder, using the given directory hash function
+    """
+    result = hash_fn(script_name)
+    if shared_script_name is not None:
+        result += "+" + hash_fn(shared_script_name)
+    return result
 
-    while from_stderr := stderr.read(4096):
-        all_stderr.write(from_stderr)
 
-    return all_stdout.getvalue().decode(
-        "utf-8", errors="replace"
-    ), all_stderr.getvalue().decode("utf-8", errors="replace")
+def get_update_files(script_name: str) -> Set[str]:
+    """Returns the relative paths of the files within the given script folder
+    whose changes can be applied in place by its update entrypoint, ie., those
+    listed in its UPDATE_FILES_NAME file. Blank lines and lines starting with
+    # are ignored. Empty if the folder has no update entrypoint.
+    """
+    if not os.path.exists(os.path.join(script_name, UPDATE_ENTRYPOINT)):
+        return set()
+
+    path = os.path.join(script_name, UPDATE_FILES_NAME)
+    if not os.path.exists(path):
+        return set()
+
+    result = set()
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                result.add(line)
+    return result
+
+
+def get_changed_substitution_files(
+    old: Optional[Dict[str, Dict[str, str]]],
+    new: Optional[Dict[str, Dict[str, str]]],
+) -> Set[str]:
+    """Returns the relative paths of the files whose substitutions differ
+    between the given file substitutions
+    """
+    old = old or dict()
+    new = new or dict()
+    return set(file for file in set(old) | set(new) if old.get(file) != new.get(file))
 
 
-def hash_directory(dirpath: str) -> str:
-    """Returns a stable hash of the given directory"""
-    hasher = hashlib.sha256()
-    for root, _, files in os.walk(dirpath):
-        for file in files:
-            with open(os.path.join(root, file), "rb") as f:
-                hasher.update(f.read())
-    return hasher.hexdigest()
+def get_changed_substitution_files_since(
+    olds: _RemoteExecutionOutputs, news: _RemoteExecutionInputs
+) -> Set[str]:
+    """Returns the relative paths of the files whose substitutions differ
+    between the old execution and the new inputs, comparing digests if the
+    old execution only kept those
+    """
+    old_digests = olds.get("substitution_digests")
+    if old_digests is None:
+        return get_changed_substitution_files(
+            olds.get("file_substitutions"), news.get("file_substitutions")
+        )
+
+    new_digests = digest_substitutions(
+        news.get("file_substitutions"), olds["substitution_salt"]
+    )
+    return set(
+        file
+        for file in set(old_digests) | set(new_digests)
+        if old_digests.get(file) != new_digests.get(file)
+    )
+
+
+def digest_substitutions(
+    file_substitutions: Optional[Dict[str, Dict[str, str]]], salt: str
+) -> Dict[str, str]:
+    """Returns the hex HMAC-SHA256, keyed by salt, of the substitutions of
+    each file, keyed by relative path. Files without substitutions are
+    omitted, so that None and an empty dict are equivalent.
+    """
+    return dict(
+        (
+            file,
+            hmac.new(
+                salt.encode("utf-8"),
+                json.dumps(subs, sort_keys=True, separators=(",", ":")).encode("utf-8"),
+                hashlib.sha256,
+            ).hexdigest(),
+        )
+        for file, subs in (file_substitutions or dict()).items()
+        if subs
+    )
+
+
+def compact_output(output: str, output_policy: str) -> str:
+    """Returns the stdout or stderr of an execution as it is kept in the
+    state by the given output policy (see OUTPUT_POLICIES)
+    """
+    if output_policy == "compress":
+        return COMPRESSED_OUTPUT_PREFIX + base64.b64encode(
+            zlib.compress(output.encode("utf-8"), 9)
+        ).decode("ascii")
+    if output_policy == "truncate":
+        encoded = output.encode("utf-8")
+        if len(encoded) <= COMPACT_OUTPUT_TAIL:
+            return output
+        tail = encoded[-COMPACT_OUTPUT_TAIL:].decode("utf-8", errors="replace")
+        return (
+            f"... [{len(encoded) - COMPACT_OUTPUT_TAIL} bytes omitted, see the"
+            f" log directory] ...\n{tail}"
+        )
+    return output
+
+
+def decompress_output(output: str) -> str:
+    """Returns the stdout or stderr kept by the "compress" output policy
+    as text; other outputs are returned as they are
+    """
+    if not output or not output.startswith(COMPRESSED_OUTPUT_PREFIX):
+        return output
+    return zlib.decompress(
+        base64.b64decode(output[len(COMPRESSED_OUTPUT_PREFIX) :])
+    ).decode("utf-8")
+
+
+def get_changed_script_files(
+    olds: _RemoteExecutionOutputs, news: _RemoteExecutionInputs
+) -> Optional[Set[str]]:
+    """Returns the relative paths of the files within the script folder which
+    were added, removed or changed since the old execution, or None if that
+    cannot be determined or the shared script folder changed as well
+    """
+    old_file_hashes = olds.get("file_hashes")
+    if old_file_hashes is None:
+        return None
+
+    if olds.get("shared_script_name") != news.get("shared_script_name"):
+        return None
+
+    if news.get("shared_script_name") is not None:
+        old_shared_hash = olds["script_hash"].partition("+")[2]
+        if old_shared_hash != hash_directory(news["shared_script_name"]):
+            return None
+
+    new_file_hashes = hash_files(news["script_name"])
+    return set(
+        file
+        for file in set(old_file_hashes) | set(new_file_hashes)
+        if old_file_hashes.get(file) != new_file_hashes.get(file)
+    )
 
 
 def write_echo_commands_for_folder(
@@ -439,7 +1707,8 @@ def write_echo_commands_for_folder(
     file_substitutions: Optional[Dict[str, Dict[str, str]]] = None,
 ) -> None:
     """Writes the appropriate commands to echo the local folder at infile_path
-    to the remote folder at echo_path. Only supports text files.
+    to the remote folder at echo_path. Only supports text files. Prefer
+    build_archive, which sends far fewer bytes and supports binary files.
     """
     writer.write(f"mkdir -p {echo_path.replace(os.path.sep, '/')}\n")
     for root, _, files in os.walk(infile_path):
@@ -479,11 +1748,15 @@ def write_echo_commands_for_file(
     to the remote file at echo_file_path. Only supports text files.
     """
     echo_file_path = echo_file_path.replace(os.path.sep, "/")
-    with open(infile_path, "r") as infile:
-        for original_line in infile:
-            for line in apply_substitutions(original_line, file_substitutions):
-                cleaned_line = line.rstrip().replace("\\", "\\\\").replace("'", "\\'")
-                writer.write(f"echo $'{cleaned_line}' >> {echo_file_path}\n")
+    if file_substitutions:
+        lines = load_template(infile_path).render(file_substitutions).splitlines()
+    else:
+        with open(infile_path, "r") as infile:
+            lines = infile.readlines()
+
+    for line in lines:
+        cleaned_line = line.rstrip().replace("\\", "\\\\").replace("'", "\\'")
+        writer.write(f"echo $'{cleaned_line}' >> {echo_file_path}\n")
 
     if mark_executable:
         writer.write(f"chmod +x {echo_file_path}\n")
@@ -492,39 +1765,211 @@ def write_echo_commands_for_file(
     writer.write(f"du -sh {echo_file_path}\n")
 
 
-INDENTATION_PRESERVED_REGEX = re.compile(r"^(?P<indent>\s*)\{\{(?P<key>.+?)\}\}")
-SIMPLE_SUBSTITUTION_REGEX = re.compile(r"\{\{(?P<key>.+?)\}\}")
+def build_archive(
+    script_name: str,
+    shared_script_name: Optional[str] = None,
+    file_substitutions: Optional[Dict[str, Dict[str, str]]] = None,
+    shared_files: Optional[List[str]] = None,
+) -> bytes:
+    """Renders the given script folder, and optionally the shared script
+    folder under "shared", into an in-memory tar.gz with the substitutions
+    applied, returning the compressed bytes. If shared_files is specified,
+    only those paths within the shared script folder are included.
+    """
+    result = io.BytesIO()
+    # a fixed gzip timestamp keeps the archive, and hence its hash, stable
+    with gzip.GzipFile(fileobj=result, mode="wb", mtime=0) as compressed, tarfile.open(
+        fileobj=compressed, mode="w"
+    ) as tar:
+        write_archive_for_folder(
+            script_name, "", tar, file_substitutions=file_substitutions
+        )
+        if shared_script_name is not None:
+            write_archive_for_folder(
+                shared_script_name,
+                "shared",
+                tar,
+                file_substitutions=file_substitutions,
+                include=shared_files,
+            )
+    return result.getvalue()
+
+
+def write_archive_for_folder(
+    infile_path: str,
+    archive_path: str,
+    tar: tarfile.TarFile,
+    file_substitutions: Optional[Dict[str, Dict[str, str]]] = None,
+    include: Optional[List[str]] = None,
+) -> None:
+    """Adds the local folder at infile_path to the given archive under the
+    folder archive_path. Files with substitutions must be text files, but
+    all other files are copied verbatim and hence may be binary. If include
+    is specified, only the files at those relative paths are added. Files
+    keep whether they are executable.
+    """
+    for root, dirs, files in os.walk(infile_path):
+        dirs.sort()
+        relative_root = os.path.relpath(root, infile_path)
+        relative_root = "" if relative_root == "." else relative_root
+
+        for file in sorted(files):
+            relative_path = os.path.join(relative_root, file).replace(os.path.sep, "/")
+            if include is not None and relative_path not in include:
+                continue
+            this_file_subs = None
+            if file_substitutions is not None:
+                this_file_subs = file_substitutions.get(relative_path)
+
+            if this_file_subs:
+                template = load_template(os.path.join(root, file))
+                contents = template.render(this_file_subs).encode("utf-8")
+            else:
+                with open(os.path.join(root, file), "rb") as infile:
+                    contents = infile.read()
+
+            # keep the executable bit, which the script hash also covers
+            executable = os.stat(os.path.join(root, file)).st_mode & 0o111 != 0
+            info = tarfile.TarInfo(
+                "/".join(part for part in (archive_path, relative_path) if part)
+            )
+            info.size = len(contents)
+            info.mode = 0o755 if executable else 0o644
+            tar.addfile(info, io.BytesIO(contents))
 
 
-def apply_substitutions(line: str, file_substitutions: Optional[Dict[str, str]] = None):
-    """Applies the given substitutions to the given line. This acts in
-    two formats - when the line consists of just whitespace followed
-    by a single substitution and the substituted value contains newlines,
-    then we will preserve indentation. So '  {{foo}}' where foo is 'a\nb'
-    will be converted to '  a\n  b'.
+def write_unpack_commands(
+    archive_file_path: str, unpack_path: str, writer: io.StringIO
+) -> None:
+    """Writes the appropriate commands to unpack the tar.gz archive at
+    archive_file_path into the folder unpack_path, then delete the archive.
+    """
+    writer.write(f"mkdir -p {unpack_path}\n")
+    writer.write(f"tar -xzf {archive_file_path} -C {unpack_path}\n")
+    writer.write(f"rm -f {archive_file_path}\n")
+    writer.write(f'echo "finished unpacking {unpack_path}"\n')
 
-    In all other cases, the substitution is direct.
 
-    Returns the list of lines that were generated.
+def write_bundle_commands(
+    archive_file_path: str,
+    bundle_hash: str,
+    target_path: str,
+    writer: io.StringIO,
+    bundle_cache_size: int = DEFAULT_BUNDLE_CACHE_SIZE,
+) -> None:
+    """Writes the appropriate commands to copy the cached bundle with the
+    given hash to the folder target_path, first unpacking the tar.gz archive
+    at archive_file_path into the cache if the bundle is not already cached.
+    The archive need not exist if the bundle is cached. Afterwards, prunes
+    the least recently used bundles beyond bundle_cache_size.
+    """
+    bundle_path = f"{BUNDLES_DIR}/{bundle_hash}"
+    writer.write(f"mkdir -p -m 700 {BUNDLES_DIR}\n")
+    writer.write(f"if [ ! -d {bundle_path} ]\n")
+    writer.write("then\n")
+    writer.write(f"    rm -rf {bundle_path}.partial\n")
+    writer.write(f"    mkdir -p {bundle_path}.partial\n")
+    writer.write(f"    tar -xzf {archive_file_path} -C {bundle_path}.partial\n")
+    writer.write(f"    mv {bundle_path}.partial {bundle_path}\n")
+    writer.write(f'    echo "cached bundle {bundle_hash}"\n')
+    writer.write("fi\n")
+    writer.write(f"rm -f {archive_file_path}\n")
+    writer.write(f"touch {bundle_path}\n")
+    writer.write(f"cp -a {bundle_path} {target_path}\n")
+    write_prune_bundles_commands(bundle_cache_size, writer)
+
+
+def write_prune_bundles_commands(bundle_cache_size: int, writer: io.StringIO) -> None:
+    """Writes the appropriate commands to delete all but the bundle_cache_size
+    most recently used bundles in the bundle cache
     """
-    if not file_substitutions:
-        return [line]
+    writer.write(
+        f"ls -1t {BUNDLES_DIR} | grep -v '\\.partial$' | tail -n +{bundle_cache_size + 1} |"
+        " while read -r old_bundle\n"
+    )
+    writer.write("do\n")
+    writer.write(f'    rm -rf "{BUNDLES_DIR}/$old_bundle"\n')
+    writer.write("done\n")
 
-    if match := INDENTATION_PRESERVED_REGEX.match(line):
-        indent = match.group("indent")
-        key = match.group("key")
 
-        assert key in file_substitutions, f"{key=} not in {file_substitutions=}"
+def write_step_commands(
+    writer: io.StringIO,
+    force_steps: Optional[List[str]] = None,
+    clear_steps: Optional[List[str]] = None,
+) -> None:
+    """Writes the commands which remove the completion markers of the steps
+    in clear_steps and export the steps in force_steps for
+    setup-scripts/shared/steps.sh. The step names must already be validated
+    against STEP_NAME_REGEX.
+    """
+    for step_name in clear_steps or []:
+        if step_name == "*":
+            writer.write(f"rm -rf {STEPS_DIR}\n")
+        else:
+            writer.write(f"rm -f {STEPS_DIR}/{step_name}\n")
+    if force_steps:
+        writer.write(f"export EZPBARS_FORCE_STEPS='{' '.join(force_steps)}'\n")
 
-        value = file_substitutions[key]
 
-        result = []
-        for subline in value.split("\n"):
-            result.append(indent + subline)
-        return result
+def write_bastion_hop_commands(
+    host: str,
+    key_file: str,
+    host_script: str,
+    writer: io.StringIO,
+    transferred: Optional[str] = None,
+    transferred_as: Optional[str] = None,
+    cached_bundle: Optional[str] = None,
+    retry_policy: Optional[ConnectRetryPolicy] = None,
+) -> None:
+    """Writes the appropriate commands for the bastion to wait for the host to
+    be reachable using the key at key_file, then upload the local file at
+    transferred (if specified) to the hosts home directory as transferred_as,
+    then run the given script on the host as root. The key file is deleted
+    when the script exits.
 
-    return [
-        SIMPLE_SUBSTITUTION_REGEX.sub(
-            lambda m: file_substitutions.get(m.group("key"), ""), line
-        )
-    ]
+    Waiting for the host follows the given retry policy, failing the script
+    if the host does not become reachable in time. A cheap tcp probe of
+    port 22 is attempted before each ssh handshake.
+
+    If cached_bundle is specified, the upload is skipped if the host already
+    has that path.
+
+    The exit status of the script on the host is stored in $sfs_status.
+    """
+    if retry_policy is None:
+        retry_policy = ConnectRetryPolicy()
+
+    ssh_args = f"-i {key_file} -oStrictHostKeyChecking=no -oBatchMode=no"
+    probe_timeout = max(int(retry_policy.probe_timeout), 1)
+    writer.write(f'trap "rm -f {key_file}" EXIT\n')
+    writer.write(f"chmod 400 {key_file}\n")
+    writer.write('echo "sfs here 1"\n')
+    writer.write(f'echo "{PHASE_MARKER}bastion_wait"\n')
+    retry_policy.write_wait_commands(
+        f"timeout {probe_timeout} bash -c '</dev/tcp/{host}/22'"
+        f" && ssh -oConnectTimeout={probe_timeout} {ssh_args} ec2-user@{host} true",
+        f"ec2-user@{host}",
+        writer,
+    )
+
+    if transferred is not None:
+        writer.write(f'echo "{PHASE_MARKER}bastion_upload"\n')
+        indent = ""
+        if cached_bundle is not None:
+            writer.write(
+                f"if ! ssh {ssh_args} ec2-user@{host} sudo test -d {cached_bundle}\n"
+            )
+            writer.write("then\n")
+            indent = "    "
+        writer.write(f"{indent}sftp {ssh_args} -b - ec2-user@{host} <<EOF\n")
+        writer.write(f"put {transferred} {transferred_as}\n")
+        writer.write("EOF\n")
+        if cached_bundle is not None:
+            writer.write("fi\n")
+    writer.write('echo "sfs here 2"\n')
+
+    writer.write(f"ssh {ssh_args} ec2-user@{host} sudo bash -s <<'HOST_SCRIPT_EOF'\n")
+    writer.write(host_script)
+    writer.write("HOST_SCRIPT_EOF\n")
+    writer.write("sfs_status=$?\n")
+    writer.write('echo "sfs here 3"\n')
@@ -2,10 +2,11 @@
 given subnets.
 """
 import itertools
-from typing import List, Sequence, Tuple
+from typing import List, Optional, Sequence, Tuple
 import pulumi
 import pulumi_aws as aws
 from key import Key
+from golden_image import GoldenImage, get_image_options
 from remote_executor import RemoteExecution, RemoteExecutionInputs
 from vpc import VirtualPrivateCloud
 from webapp import Webapp
@@ -22,6 +23,7 @@ class ReverseProxy:
         rest_backend: Webapp,
         ws_backend: Webapp,
         frontend: Webapp,
+        image: Optional[GoldenImage] = None,
     ) -> None:
         """Creates a reverse proxy in the first 2 public subnets of
         the virtual private cloud
@@ -36,6 +38,11 @@ class ReverseProxy:
             ws_backend (Webapp): The webapp responsible for the websocket
                 backend
             frontend (Webapp): The webapp responsible for the frontend
+            image (GoldenImage, None): if specified, the instances are launched
+                from this image, which must have the reverse-proxy role baked in, so
+                that provisioning skips the baked steps. Instances keep the
+                image they were launched from when it is rebaked, and only pick
+                up the new one when they are next replaced
         """
         self.resource_name: str = resource_name
         """The prefix for the names of resoruces created by this instance"""
@@ -52,6 +59,12 @@ class ReverseProxy:
         self.frontend: Webapp = frontend
         """The application for frontend requests"""
 
+        if image is not None:
+            image.check_compatible("reverse-proxy", "arm64")
+
+        self.image: Optional[GoldenImage] = image
+        """The golden image the reverse proxies are launched from, if any"""
+
         self.reverse_proxy_security_group: aws.ec2.SecurityGroup = (
             aws.ec2.SecurityGroup(
                 f"{resource_name}-reverse-proxy-security-group",
@@ -86,7 +99,9 @@ class ReverseProxy:
         self.reverse_proxies: List[aws.ec2.Instance] = [
             aws.ec2.Instance(
                 f"{resource_name}-reverse-proxy-{idx}",
-                ami=self.vpc.amazon_linux_arm64.id,
+                ami=image.ami_id
+                if image is not None
+                else self.vpc.amazon_linux_arm64.id,
                 instance_type="t4g.nano",
                 associate_public_ip_address=False,
                 subnet_id=subnet.id,
@@ -94,6 +109,7 @@ class ReverseProxy:
                 key_name=self.vpc.key.key_pair.key_name,
                 iam_instance_profile=self.vpc.standard_instance_profile.name,
                 tags={"Name": f"{resource_name} reverse proxy {idx}"},
+                opts=get_image_options(image),
             )
             for idx, subnet in enumerate(self.vpc.private_subnets[:2])
         ]
@@ -109,12 +125,21 @@ class ReverseProxy:
                             "BACKEND_UPSTREAM": get_upstreams(self.rest_backend),
                             "WEBSOCKET_UPSTREAM": get_upstreams(self.ws_backend),
                             "FRONTEND_UPSTREAM": get_upstreams(self.frontend),
+                            "BACKEND_TARGET": get_proxy_target(
+                                self.rest_backend, "backend_py"
+                            ),
+                            "WEBSOCKET_TARGET": get_proxy_target(
+                                self.ws_backend, "websockets_py"
+                            ),
+                            "FRONTEND_TARGET": get_proxy_target(
+                                self.frontend, "frontend"
+                            ),
                         }
                     },
                     host=instance.private_ip,
                     private_key=self.vpc.key.private_key_path,
                     bastion=self.vpc.bastion.public_ip,
-                    shared_script_name="scripts/shared",
+                    shared_script_name="setup-scripts/shared",
                 ),
             )
             for idx, instance in enumerate(self.reverse_proxies)
@@ -129,8 +154,13 @@ def get_upstreams(webapp: Webapp) -> pulumi.Input[str]:
         server 10.0.1.0:80;
         server 10.0.2.0:80;
 
-    where the ip addresses target instances of the webapp in all subnets
+    where the ip addresses target instances of the webapp in all subnets. In
+    the auto scaling mode, the webapps internal load balancer is the only
+    upstream instead, though requests reach it via get_proxy_target.
     """
+    if webapp.load_balancer is not None:
+        return webapp.load_balancer.dns_name.apply(lambda dns: f"server {dns}:80;")
+
     all_instances: List[aws.ec2.Instance] = list(
         itertools.chain(
             *[
@@ -146,3 +176,19 @@ def get_upstreams(webapp: Webapp) -> pulumi.Input[str]:
     return pulumi.Output.all([inst.private_ip for inst in all_instances]).apply(
         make_upstream
     )
+
+
+def get_proxy_target(webapp: Webapp, upstream_name: str) -> pulumi.Input[str]:
+    """Produces the target nginx proxies requests for the given webapp to,
+    via a variable, which is the name of its upstream group (see
+    get_upstreams), or, in the auto scaling mode, the host and port of its
+    internal load balancer.
+
+    The addresses of a load balancer change over time, and nginx resolves
+    the servers of an upstream group only when it starts. A name in a
+    proxy_pass variable which is not an upstream group is instead looked up
+    through the configured resolver, and again once the answer expires.
+    """
+    if webapp.load_balancer is not None:
+        return webapp.load_balancer.dns_name.apply(lambda dns: f"{dns}:80")
+    return upstream_name
@@ -1,7 +1,9 @@
 """This module allows creating a rqlite cluster"""
-from typing import List
+from typing import List, Optional
+from multi_remote_executor import MultiRemoteExecution, MultiRemoteExecutionInputs
 from remote_executor import RemoteExecution, RemoteExecutionInputs
 from vpc import VirtualPrivateCloud
+from golden_image import GoldenImage, get_image_options
 import pulumi_aws as aws
 import pulumi
 
@@ -14,6 +16,8 @@ class RqliteCluster:
         resource_name: str,
         vpc: VirtualPrivateCloud,
         id_offset: int = 0,
+        batch_remote_executions: bool = False,
+        image: Optional[GoldenImage] = None,
     ) -> None:
         """Creates a new rqlite cluster running on the private subnets
         of the given virtual private cloud.
@@ -27,6 +31,15 @@ class RqliteCluster:
                 of this cluster and should no longer be. for example, if you want
                 to cleanly update the cluster seamlessly, simply increment this by
                 one, up, and repeat until all instances are replaced
+            batch_remote_executions (bool): if true, the instances are
+                provisioned by a single MultiRemoteExecution which provisions
+                the leader before the others, rather than by one
+                RemoteExecution per instance
+            image (GoldenImage, None): if specified, the instances are launched
+                from this image, which must have the rqlite role baked in, so
+                that provisioning skips the baked steps. Instances keep the
+                image they were launched from when it is rebaked, and only pick
+                up the new one when they are next replaced
         """
         self.resource_name: str = resource_name
         """the resource name prefix to use for resources created by this instance"""
@@ -37,6 +50,15 @@ class RqliteCluster:
         self.id_offset: int = id_offset
         """the number of rotated out instances"""
 
+        self.batch_remote_executions: bool = batch_remote_executions
+        """whether the instances are provisioned by a single MultiRemoteExecution"""
+
+        if image is not None:
+            image.check_compatible("rqlite", "arm64")
+
+        self.image: Optional[GoldenImage] = image
+        """the golden image the instances are launched from, if any"""
+
         self.security_group: aws.ec2.SecurityGroup = aws.ec2.SecurityGroup(
             f"{resource_name}-security-group",
             description="allows incoming 4001-4002 tcp (rqlite) + ssh from bastion",
@@ -76,7 +98,11 @@ class RqliteCluster:
         self.instances: List[aws.ec2.Instance] = [
             aws.ec2.Instance(
                 f"{resource_name}-instance-{cluster_id}",
-                ami=self.vpc.amazon_linux_bleeding_arm64.id,
+                ami=(
+                    image.ami_id
+                    if image is not None
+                    else self.vpc.amazon_linux_bleeding_arm64.id
+                ),
                 associate_public_ip_address=False,
                 instance_type="t4g.nano",
                 subnet_id=self.vpc.private_subnets[
@@ -91,6 +117,7 @@ class RqliteCluster:
                 tags={
                     "Name": f"{resource_name} {vpc.availability_zones[cluster_id % len(self.vpc.private_subnets)]} [{cluster_id}]"
                 },
+                opts=get_image_options(image),
             )
             for cluster_id in self.instance_cluster_ids
         ]
@@ -101,6 +128,7 @@ class RqliteCluster:
         the desired "increment cluster id offset by 1 to swap 1 instance out" behavior
         """
 
+        file_substitutions: List[pulumi.Output] = []
         self.remote_executions: List[RemoteExecution] = []
         for cluster_id_outer, instance in zip(
             self.instance_cluster_ids, self.instances
@@ -123,14 +151,19 @@ class RqliteCluster:
                     }
                 }
 
+            instance_file_substitutions = pulumi.Output.all(
+                *[i.private_ip for i in self.instances], cluster_id_outer
+            ).apply(generate_file_substitutions)
+            if batch_remote_executions:
+                file_substitutions.append(instance_file_substitutions)
+                continue
+
             self.remote_executions.append(
                 RemoteExecution(
                     f"{resource_name}-remote-execution-{cluster_id_outer}",
                     props=RemoteExecutionInputs(
                         script_name="setup-scripts/rqlite",
-                        file_substitutions=pulumi.Output.all(
-                            *[i.private_ip for i in self.instances], cluster_id_outer
-                        ).apply(generate_file_substitutions),
+                        file_substitutions=instance_file_substitutions,
                         host=instance.private_ip,
                         private_key=self.vpc.key.private_key_path,
                         bastion=self.vpc.bastion.public_ip,
@@ -143,3 +176,21 @@ class RqliteCluster:
         same order as instances (which is not necessarily the same order as the subnets
         the instances are in)
         """
+
+        self.batched_remote_execution: Optional[MultiRemoteExecution] = None
+        if batch_remote_executions:
+            self.batched_remote_execution = MultiRemoteExecution(
+                f"{resource_name}-remote-execution",
+                props=MultiRemoteExecutionInputs(
+                    script_name="setup-scripts/rqlite",
+                    hosts=[i.private_ip for i in self.instances],
+                    file_substitutions=file_substitutions,
+                    private_key=self.vpc.key.private_key_path,
+                    bastion=self.vpc.bastion.public_ip,
+                    shared_script_name="setup-scripts/shared",
+                    waves=[[0]],
+                ),
+            )
+        """if batch_remote_executions, the remote execution which bootstraps and
+        maintains every instance, starting with the default leader; otherwise None
+        """
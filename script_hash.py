@@ -0,0 +1,222 @@
+"""Provides stable hashes of script folders. A folder hash covers the
+relative path, executable bit and contents of every file in a sorted order,
+so it does not depend on the order the filesystem lists files in, and
+renames are detected.
+
+Digests of individual files are memoized in a local cache file keyed by
+(path, size, mtime_ns, inode), and each folder is hashed at most once per
+process, so repeatedly hashing the same handful of script folders for
+dozens of resources is cheap. Entries for files which no longer exist are
+dropped whenever the cache is saved, so it does not grow without bound as
+temporary folders come and go.
+"""
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), ".script_hash_cache.json"
+)
+"""The default path to the file which memoizes file digests across runs,
+next to this module rather than in the working directory, so that tools run
+from elsewhere share it"""
+
+_CacheEntry = Tuple[int, int, int, str]
+"""(size, mtime_ns, inode, sha256 hexdigest) for a file"""
+
+
+class DirectoryHasher:
+    """Hashes directories, memoizing the digest of each file on disk and the
+    hash of each directory for the lifetime of this instance
+    """
+
+    def __init__(self, cache_path: Optional[str] = DEFAULT_CACHE_PATH) -> None:
+        """Creates a new hasher.
+
+        Args:
+            cache_path (str, None): the file used to memoize file digests across
+                processes, or None to only memoize in memory
+        """
+        self.cache_path: Optional[str] = cache_path
+        """The file used to memoize file digests across processes, if any"""
+
+        self._lock = threading.Lock()
+        self._file_digests: Optional[Dict[str, _CacheEntry]] = None
+        self._file_digests_dirty: bool = False
+        self._directory_files: Dict[str, Dict[str, str]] = dict()
+        self._directory_hashes: Dict[str, str] = dict()
+
+    def configure(self, cache_path: Optional[str]) -> None:
+        """Changes the file used to memoize file digests across processes, or
+        None to only memoize in memory, eg., for benchmarks which hash
+        temporary folders. File digests are reloaded from the new file, but
+        directory hashes computed so far are kept.
+        """
+        with self._lock:
+            self.cache_path = cache_path
+            self._file_digests = None
+            self._file_digests_dirty = False
+
+    def hash_directory(self, dirpath: str) -> str:
+        """Returns a stable hash of the given directory"""
+        key = os.path.normpath(dirpath)
+        with self._lock:
+            cached = self._directory_hashes.get(key)
+        if cached is not None:
+            return cached
+
+        hasher = hashlib.sha256()
+        for relative_path, file_hash in self.hash_files(dirpath).items():
+            hasher.update(f"{relative_path}\0{file_hash}\n".encode("utf-8"))
+        result = hasher.hexdigest()
+
+        with self._lock:
+            self._directory_hashes[key] = result
+        return result
+
+    def hash_files(self, dirpath: str) -> Dict[str, str]:
+        """Returns a hash of each file in the given directory, keyed by its
+        unix-style path relative to the directory, in sorted order. Each hash
+        covers the files executable bit and contents.
+        """
+        key = os.path.normpath(dirpath)
+        with self._lock:
+            cached = self._directory_files.get(key)
+        if cached is not None:
+            return dict(cached)
+
+        result: Dict[str, str] = dict()
+        for relative_path in list_files(dirpath):
+            path = os.path.join(dirpath, relative_path)
+            executable = os.stat(path).st_mode & 0o111 != 0
+            mode = "755" if executable else "644"
+            result[relative_path] = f"{mode}:{self.hash_file(path)}"
+
+        self.save()
+        with self._lock:
+            self._directory_files[key] = result
+        return dict(result)
+
+    def hash_file(self, path: str) -> str:
+        """Returns the sha256 hexdigest of the contents of the file at the given
+        path, reusing the cached digest if the file appears unchanged
+        """
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        with self._lock:
+            file_digests = self._load_locked()
+            cached = file_digests.get(key)
+        if cached is not None and tuple(cached[:3]) == (
+            stat.st_size,
+            stat.st_mtime_ns,
+            stat.st_ino,
+        ):
+            return cached[3]
+
+        hasher = hashlib.sha256()
+        with open(path, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                hasher.update(chunk)
+        digest = hasher.hexdigest()
+
+        with self._lock:
+            file_digests[key] = (stat.st_size, stat.st_mtime_ns, stat.st_ino, digest)
+            self._file_digests_dirty = True
+        return digest
+
+    def save(self) -> None:
+        """Writes the memoized file digests to the cache file, if there is one
+        and they have changed since they were loaded, dropping those of files
+        which no longer exist
+        """
+        if self.cache_path is None:
+            return
+
+        with self._lock:
+            self._prune_locked()
+            if not self._file_digests_dirty:
+                return
+            serialized = json.dumps(self._file_digests, separators=(",", ":"))
+            self._file_digests_dirty = False
+
+        tmp_path = f"{self.cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(serialized)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            # the cache is only an optimization
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _prune_locked(self) -> None:
+        if self._file_digests is None:
+            return
+        missing = [path for path in self._file_digests if not os.path.exists(path)]
+        for path in missing:
+            del self._file_digests[path]
+        if missing:
+            self._file_digests_dirty = True
+
+    def _load_locked(self) -> Dict[str, _CacheEntry]:
+        if self._file_digests is not None:
+            return self._file_digests
+
+        self._file_digests = dict()
+        if self.cache_path is not None and os.path.exists(self.cache_path):
+            try:
+                with open(self.cache_path) as f:
+                    self._file_digests = json.load(f)
+            except (OSError, ValueError):
+                pass
+        return self._file_digests
+
+
+def list_files(dirpath: str) -> List[str]:
+    """Lists the unix-style paths relative to the given directory of every
+    file within it, recursively, in sorted order
+    """
+    result = []
+    for root, dirs, files in os.walk(dirpath):
+        dirs.sort()
+        relative_root = os.path.relpath(root, dirpath)
+        for file in files:
+            relative_path = (
+                file if relative_root == "." else os.path.join(relative_root, file)
+            )
+            result.append(relative_path.replace(os.path.sep, "/"))
+    return sorted(result)
+
+
+def legacy_hash_directory(dirpath: str) -> str:
+    """Returns the hash of the given directory as it was computed before
+    paths and modes were included, ie., the contents of every file in the
+    order os.walk produces them. Only used to recognize hashes which are
+    already stored in state.
+    """
+    hasher = hashlib.sha256()
+    for root, _, files in os.walk(dirpath):
+        for file in files:
+            with open(os.path.join(root, file), "rb") as f:
+                hasher.update(f.read())
+    return hasher.hexdigest()
+
+
+DIRECTORY_HASHER = DirectoryHasher()
+"""The hasher shared by everything within this process"""
+
+
+def hash_directory(dirpath: str) -> str:
+    """Returns a stable hash of the given directory, which is computed at
+    most once per process
+    """
+    return DIRECTORY_HASHER.hash_directory(dirpath)
+
+
+def hash_files(dirpath: str) -> Dict[str, str]:
+    """Returns a hash of each file in the given directory, keyed by its
+    unix-style relative path, which is computed at most once per process
+    """
+    return DIRECTORY_HASHER.hash_files(dirpath)
@@ -0,0 +1,32 @@
+#!/usr/bin/env bash
+# Bakes the slow, instance-independent installs of a role into the builder
+# instance of a golden image. The steps are the same ones the roles main.sh
+# runs, so their markers are imaged too and instances launched from the
+# image skip them.
+source config.sh
+bash shared/wait_boot_finished.sh || exit $?
+source shared/steps.sh
+source shared/roles.sh
+echo "Baking golden image for $ROLE"
+
+case "$ROLE" in
+    webapp)
+        ;;
+    rqlite)
+        run_step install_rqlite install_rqlite
+        ;;
+    redis)
+        run_step install_redis install_redis
+        ;;
+    reverse-proxy)
+        run_step install_nginx install_nginx shared/nginx.repo
+        ;;
+    *)
+        echo "unknown role $ROLE" >&2
+        exit 1
+        ;;
+esac
+
+# keep the image small and free of anything specific to the builder
+yum clean all
+rm -f /home/ec2-user/boot_warnings
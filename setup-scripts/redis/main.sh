@@ -1,11 +1,4 @@
 #!/usr/bin/env bash
-install_redis() {
-    yum -y install yum-utils
-    yum -y install http://rpms.remirepo.net/enterprise/remi-release-7.rpm
-    yum-config-manager --enable remi
-    yum -y install redis
-}
-
 configure_redis() {
     source config.sh
     
@@ -46,6 +39,8 @@ configure_redis() {
     rm cron     
 }
 
-bash shared/wait_boot_finished.sh
-install_redis
+bash shared/wait_boot_finished.sh || exit $?
+source shared/steps.sh
+source shared/roles.sh
+run_step install_redis install_redis
 configure_redis
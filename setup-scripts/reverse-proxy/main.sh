@@ -1,16 +1,15 @@
 #!/usr/bin/env bash
-bash shared/wait_boot_finished.sh
+bash shared/wait_boot_finished.sh || exit $?
+source shared/steps.sh
+source shared/roles.sh
 echo "Reverse proxy install started!"
 
 # install nginx
-mv nginx.repo /etc/yum.repos.d/nginx.repo
+run_step install_nginx install_nginx shared/nginx.repo
 chmod +x reboot_nginx.sh
 mv reboot_nginx.sh /home/ec2-user/reboot_nginx.sh
 sudo -u ec2-user mkdir -p /home/ec2-user/logs
 
-yum clean metadata
-yum update -y
-yum install -y nginx
 nginx -t && nginx
 nginx -s quit
 
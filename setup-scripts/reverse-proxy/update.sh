@@ -0,0 +1,15 @@
+#!/usr/bin/env bash
+echo "Reverse proxy update started!"
+chmod +x reboot_nginx.sh
+mv reboot_nginx.sh /home/ec2-user/reboot_nginx.sh
+cp /etc/nginx/nginx.conf /etc/nginx/nginx.conf.bak
+mv nginx.conf /etc/nginx/nginx.conf
+if nginx -t
+then
+    nginx -s reload
+else
+    echo "new nginx config is invalid; restoring previous config" >&2
+    mv /etc/nginx/nginx.conf.bak /etc/nginx/nginx.conf
+    exit 1
+fi
+rm -f /etc/nginx/nginx.conf.bak
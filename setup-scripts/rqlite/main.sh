@@ -1,30 +1,4 @@
 #!/usr/bin/env bash
-install_rqlite() {
-    local latest_release_url=$(curl -L -s --retry 5 --retry-connrefused https://api.github.com/repos/rqlite/rqlite/releases/latest | jq -r ".assets[] | .browser_download_url" | grep -Eo "^.*rqlite-.*-linux-arm64.tar.gz")
-    local fname=$(basename $latest_release_url)
-    local foldername=$(basename $fname .tar.gz)
-    local install_bin="/usr/bin"
-    cd /usr/local/src
-    rm -f $fname
-    rm -rf $foldername
-    wget "$latest_release_url"
-    tar -xvf $fname
-
-    echo "/usr/local/src/$foldername" >> /home/ec2-user/rqlite_uninstall.txt
-    for binpath in $foldername/*
-    do
-        if ! echo $binpath | grep '*' > /dev/null
-        then
-            local binname=$(basename $binpath)
-            chmod +x $binpath
-            rm -f $install_bin/$binname
-            ln -s $PWD/$binpath $install_bin/$binname
-            chmod +x $install_bin/$binname
-            echo "$install_bin/$binname" >> /home/ec2-user/rqlite_uninstall.txt
-        fi
-    done
-}
-
 start_rqlite_cluster() {
     source config.sh
 
@@ -76,8 +50,10 @@ remove_old_nodes() {
 
 main() {
     local script_dir=$(pwd)
-    bash shared/wait_boot_finished.sh
-    install_rqlite
+    bash shared/wait_boot_finished.sh || exit $?
+    source shared/steps.sh
+    source shared/roles.sh
+    run_step install_rqlite install_rqlite
     cd "$script_dir"
     start_rqlite_cluster
     cd "$script_dir"
@@ -0,0 +1,673 @@
+#!/usr/bin/env python3
+"""A small provisioning agent which stores script bundles and runs scripts
+within them, streaming their output back, over a framed protocol on stdio
+(eg., an ssh exec channel) or a unix socket. Only uses the standard library
+of python 3.6+, and is installed to /usr/local/lib/ezpbars/agent.py by
+wait_boot_finished.sh. See agent_client.py for the client.
+
+Every frame is a 4-byte big-endian length followed by that many bytes of
+utf-8 json (the header) and then, if the header has a "size", that many
+bytes of payload. Each request is answered in order:
+
+    hello                               -> hello {version, bundles}
+    has_bundle {hash, name}             -> bundle {hash, present}
+    put_bundle {hash, name, size} + tar.gz
+                                        -> bundle {hash, present}
+    signature {name, max_blocks}        -> signature {base, block_size, blocks}
+    put_delta {hash, name, base, tar_hash, block_size, ops, size} + literals
+                                        -> bundle {hash, present}
+    run {bundle, script, inactivity_timeout, deadline, bundle_cache_size}
+                                        -> output {stream, size} + bytes...
+                                        -> exit {status, duration, timed_out}
+    bye                                 -> (end of session)
+
+A request which fails is answered with error {message} instead.
+
+Bundles may be sent as an rsync-style delta against the last bundle with the
+same name (eg., the script folder) on this machine: the agent keeps the
+uncompressed tar of every bundle it received, signature returns the weak
+rolling and strong checksums of each block of the latest one, and put_delta
+rebuilds the new tar from copied blocks and zlib-compressed literals, which
+must match tar_hash. See compute_delta.
+
+Usage, eg., for a single session over ssh:
+
+    sudo python3 /usr/local/lib/ezpbars/agent.py --stdio
+
+or to serve many concurrent sessions on a unix socket:
+
+    sudo python3 /usr/local/lib/ezpbars/agent.py --socket /run/ezpbars-agent.sock
+"""
+import argparse
+import binascii
+import gzip
+import hashlib
+import io
+import json
+import math
+import os
+import re
+import select
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+import zlib
+
+PROTOCOL_VERSION = 2
+"""Incremented whenever the protocol changes incompatibly"""
+
+DEFAULT_BUNDLES_DIR = "/usr/local/src/.bundles"
+"""Where bundles are unpacked, one directory per sha256 of the archive. The
+same layout the remote executor uses when it caches bundles without the
+agent, so either can reuse the others bundles."""
+
+DEFAULT_WORK_DIR = "/usr/local/src"
+"""Where bundles are copied to before a script is run within them"""
+
+FRAME_LENGTH = struct.Struct(">I")
+"""The length prefix of every frame"""
+
+MAX_HEADER_SIZE = 1024 * 1024
+"""The largest header accepted, to fail fast on a corrupt stream"""
+
+READ_SIZE = 64 * 1024
+"""How many bytes to read from a running script at once"""
+
+KILL_GRACE_PERIOD = 5
+"""How many seconds a timed out script has to exit after SIGTERM"""
+
+TARS_DIR_NAME = ".tars"
+"""The hidden directory within the bundles directory where the uncompressed
+tar of each bundle is kept, as the base for deltas, alongside a latest-<name>
+file per bundle name with the hash of the most recent bundle of that name"""
+
+ADLER_MODULUS = 65521
+"""The modulus of adler32, the weak checksum, needed to roll it"""
+
+MIN_BLOCK_SIZE = 512
+MAX_BLOCK_SIZE = 16 * 1024
+"""The bounds of the delta block size, which is otherwise the square root of
+the size of the base, as in rsync"""
+
+BUNDLE_NAME_REGEX = re.compile(r"^[A-Za-z0-9_.-]+$")
+"""Matches valid bundle names"""
+
+
+class ProtocolError(Exception):
+    """Raised when the other side sends something which is not a valid frame"""
+
+
+def write_frame(stream, header, payload=None):
+    """Writes the given header (a json-serializable dict) and optional payload
+    bytes as a single frame to the given binary stream, then flushes it
+    """
+    if payload is not None:
+        header = dict(header, size=len(payload))
+    encoded = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    stream.write(FRAME_LENGTH.pack(len(encoded)) + encoded)
+    if payload:
+        stream.write(payload)
+    stream.flush()
+
+
+def read_exactly(stream, size):
+    """Reads exactly size bytes from the given binary stream, raising EOFError
+    if it ends first
+    """
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            raise EOFError("stream ended {} bytes early".format(remaining))
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def read_frame(stream):
+    """Reads the next frame from the given binary stream, returning its header
+    and payload (None if it has no payload). Raises EOFError if the stream
+    ends and ProtocolError if the frame is malformed.
+    """
+    (length,) = FRAME_LENGTH.unpack(read_exactly(stream, FRAME_LENGTH.size))
+    if length > MAX_HEADER_SIZE:
+        raise ProtocolError("header of {} bytes is too large".format(length))
+    try:
+        header = json.loads(read_exactly(stream, length).decode("utf-8"))
+    except ValueError as e:
+        raise ProtocolError("header is not valid json: {}".format(e))
+    if not isinstance(header, dict) or not isinstance(header.get("type"), str):
+        raise ProtocolError("header must be an object with a type")
+
+    payload = None
+    if "size" in header:
+        payload = read_exactly(stream, int(header["size"]))
+    return header, payload
+
+
+def weak_checksum(block):
+    """Returns the weak checksum of the given block, adler32, which can be
+    rolled along a buffer one byte at a time (see compute_delta)
+    """
+    return zlib.adler32(block)
+
+
+def strong_checksum(block):
+    """Returns the strong checksum of the given block as hex. Collisions are
+    caught by the hash of the rebuilt tar."""
+    return hashlib.blake2b(block, digest_size=8).hexdigest()
+
+
+def choose_block_size(size, max_blocks=None):
+    """Returns the delta block size for a base of the given size, using
+    larger blocks if needed so that there are at most max_blocks blocks
+    """
+    block_size = max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, int(math.sqrt(size))))
+    if max_blocks:
+        block_size = max(block_size, -(-size // int(max_blocks)))
+    return block_size
+
+
+def compute_signature(base, block_size):
+    """Returns the [weak, strong] checksums of each complete block of base"""
+    return [
+        [
+            weak_checksum(base[i : i + block_size]),
+            strong_checksum(base[i : i + block_size]),
+        ]
+        for i in range(0, len(base) - block_size + 1, block_size)
+    ]
+
+
+def compute_delta(data, block_size, signature):
+    """Computes the delta which turns the base with the given signature into
+    data. Returns the ops, each either ["c", first_block, num_blocks] to copy
+    blocks of the base or ["l", length] to take the next length bytes of the
+    literals, and the literals.
+    """
+    blocks_by_weak = dict()
+    for idx, (weak, strong) in enumerate(signature):
+        blocks_by_weak.setdefault(weak, dict()).setdefault(strong, idx)
+
+    ops = []
+    literals = bytearray()
+    literal_start = 0
+
+    def flush_literals(end):
+        if end > literal_start:
+            literals.extend(data[literal_start:end])
+            ops.append(["l", end - literal_start])
+
+    size = len(data)
+    pos = 0
+    if size >= block_size and blocks_by_weak:
+        weak = weak_checksum(data[:block_size])
+        a, b = weak & 0xFFFF, weak >> 16
+        while True:
+            weak = (b << 16) | a
+            candidates = blocks_by_weak.get(weak)
+            if candidates is not None:
+                strong = strong_checksum(data[pos : pos + block_size])
+                match = candidates.get(strong)
+                # prefer continuing the previous copy, as bases often repeat
+                following = None
+                if pos == literal_start and ops and ops[-1][0] == "c":
+                    following = ops[-1][1] + ops[-1][2]
+                if (
+                    match is not None
+                    and following is not None
+                    and following < len(signature)
+                    and signature[following][0] == weak
+                    and signature[following][1] == strong
+                ):
+                    match = following
+                if match is not None:
+                    flush_literals(pos)
+                    if match == following:
+                        ops[-1][2] += 1
+                    else:
+                        ops.append(["c", match, 1])
+                    pos += block_size
+                    literal_start = pos
+                    if pos + block_size > size:
+                        break
+                    weak = weak_checksum(data[pos : pos + block_size])
+                    a, b = weak & 0xFFFF, weak >> 16
+                    continue
+
+            if pos + block_size >= size:
+                break
+            removed = data[pos]
+            a = (a - removed + data[pos + block_size]) % ADLER_MODULUS
+            b = (b - block_size * removed + a - 1) % ADLER_MODULUS
+            pos += 1
+
+    flush_literals(size)
+    return ops, bytes(literals)
+
+
+def apply_delta(base, block_size, ops, literals):
+    """Rebuilds the data from the base and a delta from compute_delta"""
+    result = bytearray()
+    literal_pos = 0
+    for op in ops:
+        if op[0] == "c":
+            start = int(op[1]) * block_size
+            result.extend(base[start : start + int(op[2]) * block_size])
+        elif op[0] == "l":
+            length = int(op[1])
+            result.extend(literals[literal_pos : literal_pos + length])
+            literal_pos += length
+        else:
+            raise ValueError("unknown delta op {!r}".format(op[0]))
+    return bytes(result)
+
+
+def is_bundle_hash(value):
+    """True if the given value looks like the hex sha256 of a bundle, so that
+    it is safe to use as a file name
+    """
+    if not isinstance(value, str) or len(value) != 64:
+        return False
+    try:
+        binascii.unhexlify(value)
+    except (binascii.Error, ValueError):
+        return False
+    return True
+
+
+class Agent:
+    """Serves sessions of the protocol, storing bundles within bundles_dir and
+    running scripts within copies of them in work_dir. Thread-safe, so that
+    many sessions may be served at once.
+    """
+
+    def __init__(self, bundles_dir=DEFAULT_BUNDLES_DIR, work_dir=DEFAULT_WORK_DIR):
+        self.bundles_dir = bundles_dir
+        self.work_dir = work_dir
+        self._lock = threading.Lock()
+
+    @property
+    def tars_dir(self):
+        """Where the uncompressed tar of each bundle is kept"""
+        return os.path.join(self.bundles_dir, TARS_DIR_NAME)
+
+    def serve(self, reader, writer):
+        """Serves a single session on the given binary streams until the other
+        side says bye or the reader ends
+        """
+        handlers = {
+            "hello": self.handle_hello,
+            "has_bundle": self.handle_has_bundle,
+            "put_bundle": self.handle_put_bundle,
+            "signature": self.handle_signature,
+            "put_delta": self.handle_put_delta,
+            "run": self.handle_run,
+        }
+        while True:
+            try:
+                header, payload = read_frame(reader)
+            except EOFError:
+                return
+
+            if header["type"] == "bye":
+                return
+
+            handler = handlers.get(header["type"])
+            if handler is None:
+                write_frame(
+                    writer,
+                    {"type": "error", "message": "unknown request " + header["type"]},
+                )
+                continue
+
+            try:
+                handler(writer, header, payload)
+            except (OSError, ValueError, KeyError, tarfile.TarError, zlib.error) as e:
+                write_frame(writer, {"type": "error", "message": repr(e)})
+
+    def bundle_path(self, bundle_hash):
+        """Returns the directory the bundle with the given hash is unpacked to"""
+        if not is_bundle_hash(bundle_hash):
+            raise ValueError("invalid bundle hash {!r}".format(bundle_hash))
+        return os.path.join(self.bundles_dir, bundle_hash)
+
+    def tar_path(self, bundle_hash):
+        """Returns the path the uncompressed tar of the bundle is kept at"""
+        return os.path.join(self.tars_dir, bundle_hash + ".tar")
+
+    def latest_path(self, name):
+        """Returns the path to the file with the hash of the latest bundle
+        with the given name
+        """
+        if not isinstance(name, str) or not BUNDLE_NAME_REGEX.match(name):
+            raise ValueError("invalid bundle name {!r}".format(name))
+        return os.path.join(self.tars_dir, "latest-" + name)
+
+    def set_latest(self, name, bundle_hash):
+        """Records the bundle with the given hash as the latest with the given
+        name, if it has a name and its tar was kept
+        """
+        if name is None or not os.path.exists(self.tar_path(bundle_hash)):
+            return
+        path = self.latest_path(name)
+        with open(path + ".partial", "w") as f:
+            f.write(bundle_hash)
+        os.replace(path + ".partial", path)
+
+    def get_latest(self, name):
+        """Returns the hash of the latest bundle with the given name whose tar
+        is still kept, or None
+        """
+        try:
+            with open(self.latest_path(name)) as f:
+                bundle_hash = f.read().strip()
+        except FileNotFoundError:
+            return None
+        if not is_bundle_hash(bundle_hash):
+            return None
+        if not os.path.exists(self.tar_path(bundle_hash)):
+            return None
+        return bundle_hash
+
+    def store_bundle(self, bundle_hash, tar_bytes, name=None):
+        """Unpacks the given uncompressed tar as the bundle with the given
+        hash, keeping the tar as the base for future deltas
+        """
+        path = self.bundle_path(bundle_hash)
+        os.makedirs(self.tars_dir, mode=0o700, exist_ok=True)
+        suffix = binascii.hexlify(os.urandom(4)).decode()
+        partial = "{}.{}.partial".format(path, suffix)
+        tar_path = self.tar_path(bundle_hash)
+        try:
+            with tarfile.open(fileobj=io.BytesIO(tar_bytes), mode="r:") as archive:
+                for member in archive.getmembers():
+                    if member.name.startswith("/") or ".." in member.name.split("/"):
+                        raise ValueError("unsafe path in bundle " + member.name)
+                archive.extractall(partial)
+            with open(tar_path + "." + suffix, "wb") as f:
+                f.write(tar_bytes)
+            os.replace(tar_path + "." + suffix, tar_path)
+            with self._lock:
+                if not os.path.isdir(path):
+                    os.rename(partial, path)
+        finally:
+            shutil.rmtree(partial, ignore_errors=True)
+            if os.path.exists(tar_path + "." + suffix):
+                os.unlink(tar_path + "." + suffix)
+        os.utime(path)
+        self.set_latest(name, bundle_hash)
+
+    def list_bundles(self):
+        """Returns the hashes of the bundles which are present"""
+        if not os.path.isdir(self.bundles_dir):
+            return []
+        return sorted(
+            name
+            for name in os.listdir(self.bundles_dir)
+            if is_bundle_hash(name)
+            and os.path.isdir(os.path.join(self.bundles_dir, name))
+        )
+
+    def handle_hello(self, writer, header, payload):
+        write_frame(
+            writer,
+            {
+                "type": "hello",
+                "version": PROTOCOL_VERSION,
+                "bundles": self.list_bundles(),
+            },
+        )
+
+    def handle_has_bundle(self, writer, header, payload):
+        path = self.bundle_path(header["hash"])
+        present = os.path.isdir(path)
+        if present:
+            os.utime(path)
+            self.set_latest(header.get("name"), header["hash"])
+        write_frame(
+            writer, {"type": "bundle", "hash": header["hash"], "present": present}
+        )
+
+    def handle_put_bundle(self, writer, header, payload):
+        if payload is None or hashlib.sha256(payload).hexdigest() != header["hash"]:
+            raise ValueError("bundle does not match its hash")
+        self.store_bundle(header["hash"], gzip.decompress(payload), header.get("name"))
+        write_frame(writer, {"type": "bundle", "hash": header["hash"], "present": True})
+
+    def handle_signature(self, writer, header, payload):
+        base = self.get_latest(header["name"])
+        if base is None:
+            write_frame(
+                writer,
+                {"type": "signature", "base": None, "block_size": None, "blocks": []},
+            )
+            return
+        with open(self.tar_path(base), "rb") as f:
+            base_tar = f.read()
+        block_size = choose_block_size(len(base_tar), header.get("max_blocks"))
+        write_frame(
+            writer,
+            {
+                "type": "signature",
+                "base": base,
+                "block_size": block_size,
+                "blocks": compute_signature(base_tar, block_size),
+            },
+        )
+
+    def handle_put_delta(self, writer, header, payload):
+        self.bundle_path(header["hash"])
+        base = header["base"]
+        if not is_bundle_hash(base):
+            raise ValueError("invalid base {!r}".format(base))
+        with open(self.tar_path(base), "rb") as f:
+            base_tar = f.read()
+        tar_bytes = apply_delta(
+            base_tar,
+            int(header["block_size"]),
+            header["ops"],
+            zlib.decompress(payload or b""),
+        )
+        if hashlib.sha256(tar_bytes).hexdigest() != header["tar_hash"]:
+            raise ValueError("rebuilt bundle does not match its hash")
+        self.store_bundle(header["hash"], tar_bytes, header.get("name"))
+        write_frame(writer, {"type": "bundle", "hash": header["hash"], "present": True})
+
+    def handle_run(self, writer, header, payload):
+        bundle = self.bundle_path(header["bundle"])
+        if not os.path.isdir(bundle):
+            raise ValueError("bundle {} is not present".format(header["bundle"]))
+        inactivity_timeout = header.get("inactivity_timeout")
+        deadline = header.get("deadline")
+        bundle_cache_size = header.get("bundle_cache_size")
+
+        os.makedirs(self.work_dir, exist_ok=True)
+        work_dir = os.path.join(self.work_dir, binascii.hexlify(os.urandom(8)).decode())
+        shutil.copytree(bundle, work_dir, symlinks=True)
+        os.utime(bundle)
+        try:
+            status, duration, timed_out = self.run_script(
+                writer, header["script"], work_dir, inactivity_timeout, deadline
+            )
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            if bundle_cache_size is not None:
+                self.prune_bundles(int(bundle_cache_size))
+
+        write_frame(
+            writer,
+            {
+                "type": "exit",
+                "status": status,
+                "duration": round(duration, 6),
+                "timed_out": timed_out,
+            },
+        )
+
+    def run_script(self, writer, script, cwd, inactivity_timeout, deadline):
+        """Runs the given bash script within cwd in its own process group,
+        streaming its output as output frames, and killing it if it goes
+        inactivity_timeout seconds without output or runs for longer than
+        deadline seconds (either None for unlimited).
+
+        Returns the exit status (None if it timed out), the duration in
+        seconds and why it timed out ("inactivity" or "deadline", if it did)
+        """
+        started_at = time.monotonic()
+        proc = subprocess.Popen(
+            ["bash", "-c", script],
+            cwd=cwd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
+        streams = {proc.stdout.fileno(): "stdout", proc.stderr.fileno(): "stderr"}
+        last_output_at = started_at
+        timed_out = None
+        try:
+            while streams:
+                now = time.monotonic()
+                wait_for = 1.0
+                if deadline:
+                    if now >= started_at + deadline:
+                        timed_out = "deadline"
+                        break
+                    wait_for = min(wait_for, started_at + deadline - now)
+                if inactivity_timeout:
+                    if now >= last_output_at + inactivity_timeout:
+                        timed_out = "inactivity"
+                        break
+                    wait_for = min(wait_for, last_output_at + inactivity_timeout - now)
+
+                # background processes may keep the pipes open after the
+                # script exits, so only drain what is already available then
+                exited = proc.poll() is not None
+                ready, _, _ = select.select(
+                    list(streams), [], [], 0 if exited else wait_for
+                )
+                if exited and not ready:
+                    break
+                for fd in ready:
+                    data = os.read(fd, READ_SIZE)
+                    if not data:
+                        del streams[fd]
+                        continue
+                    last_output_at = time.monotonic()
+                    write_frame(writer, {"type": "output", "stream": streams[fd]}, data)
+        finally:
+            if timed_out is not None or proc.poll() is None:
+                kill_process_group(proc)
+            proc.stdout.close()
+            proc.stderr.close()
+
+        status = proc.wait()
+        return (
+            None if timed_out is not None else status,
+            time.monotonic() - started_at,
+            timed_out,
+        )
+
+    def prune_bundles(self, bundle_cache_size):
+        """Deletes all but the bundle_cache_size most recently used bundles,
+        and the tars of bundles which no longer exist (which may also have
+        been pruned by the remote executors bash cache)
+        """
+        with self._lock:
+            bundles = [
+                os.path.join(self.bundles_dir, name) for name in self.list_bundles()
+            ]
+            bundles.sort(key=os.path.getmtime, reverse=True)
+            for path in bundles[bundle_cache_size:]:
+                shutil.rmtree(path, ignore_errors=True)
+
+            if not os.path.isdir(self.tars_dir):
+                return
+            kept = set(self.list_bundles())
+            for name in os.listdir(self.tars_dir):
+                if name.endswith(".tar") and name[: -len(".tar")] not in kept:
+                    os.unlink(os.path.join(self.tars_dir, name))
+
+
+def kill_process_group(proc):
+    """Kills the process group led by the given process, first with SIGTERM
+    and then, if it is still running after KILL_GRACE_PERIOD, with SIGKILL
+    """
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    try:
+        proc.wait(KILL_GRACE_PERIOD)
+    except subprocess.TimeoutExpired:
+        pass
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def serve_socket(agent, path):
+    """Serves sessions on a unix socket at the given path forever, one thread
+    per connection. Only root may connect.
+    """
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(old_umask)
+    server.listen(16)
+
+    def serve_connection(conn):
+        with conn, conn.makefile("rb") as reader, conn.makefile("wb") as writer:
+            try:
+                agent.serve(reader, writer)
+            except (OSError, ProtocolError) as e:
+                print("session failed: {!r}".format(e), file=sys.stderr)
+
+    while True:
+        conn, _ = server.accept()
+        threading.Thread(target=serve_connection, args=(conn,), daemon=True).start()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    transport = parser.add_mutually_exclusive_group(required=True)
+    transport.add_argument(
+        "--stdio", action="store_true", help="serve one session on stdin/stdout"
+    )
+    transport.add_argument("--socket", help="serve sessions on this unix socket")
+    parser.add_argument("--bundles-dir", default=DEFAULT_BUNDLES_DIR)
+    parser.add_argument("--work-dir", default=DEFAULT_WORK_DIR)
+    parsed = parser.parse_args(args)
+
+    agent = Agent(parsed.bundles_dir, parsed.work_dir)
+    if parsed.socket is not None:
+        serve_socket(agent, parsed.socket)
+        return 0
+
+    reader = sys.stdin.buffer
+    writer = sys.stdout.buffer
+    # anything printed by accident must not corrupt the frames
+    sys.stdout = sys.stderr
+    try:
+        agent.serve(reader, writer)
+    except ProtocolError as e:
+        print("session failed: {!r}".format(e), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
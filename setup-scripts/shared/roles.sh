@@ -0,0 +1,46 @@
+#!/usr/bin/env bash
+# The slow installs of each role, shared by the roles' main.sh and by the
+# golden image bake (setup-scripts/golden-image), so that both record the
+# same step markers (see steps.sh). Instances launched from a golden image
+# then skip every step which was baked into it. Source this file from the
+# root of a script folder, after steps.sh.
+
+install_redis() {
+    yum -y install yum-utils
+    yum -y install http://rpms.remirepo.net/enterprise/remi-release-7.rpm
+    yum-config-manager --enable remi
+    yum -y install redis
+}
+
+install_rqlite() {
+    local latest_release_url=$(curl -L -s --retry 5 --retry-connrefused https://api.github.com/repos/rqlite/rqlite/releases/latest | jq -r ".assets[] | .browser_download_url" | grep -Eo "^.*rqlite-.*-linux-arm64.tar.gz")
+    local fname=$(basename $latest_release_url)
+    local foldername=$(basename $fname .tar.gz)
+    local install_bin="/usr/bin"
+    cd /usr/local/src
+    rm -f $fname
+    rm -rf $foldername
+    wget "$latest_release_url" || return 1
+    tar -xvf $fname || return 1
+
+    echo "/usr/local/src/$foldername" >> /home/ec2-user/rqlite_uninstall.txt
+    for binpath in $foldername/*
+    do
+        if ! echo $binpath | grep '*' > /dev/null
+        then
+            local binname=$(basename $binpath)
+            chmod +x $binpath
+            rm -f $install_bin/$binname
+            ln -s $PWD/$binpath $install_bin/$binname
+            chmod +x $install_bin/$binname
+            echo "$install_bin/$binname" >> /home/ec2-user/rqlite_uninstall.txt
+        fi
+    done
+}
+
+install_nginx() {
+    cp shared/nginx.repo /etc/yum.repos.d/nginx.repo
+    yum clean metadata
+    yum update -y
+    yum install -y nginx
+}
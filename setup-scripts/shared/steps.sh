@@ -0,0 +1,80 @@
+#!/usr/bin/env bash
+# Checkpointing for slow, idempotent provisioning steps. Source this file,
+# then run a step with
+#
+#   run_step <name> <function> [input...]
+#
+# which calls the function unless a step with the same name previously
+# succeeded on this machine with the same inputs. The inputs are the body of
+# the function plus each additional argument, which is either a file (hashed
+# by its contents) or a plain string (eg., a version). On success the hash of
+# the inputs is recorded in $STEPS_DIR/<name>.
+#
+# A step is always run if its name, or "*", is in the space-separated
+# EZPBARS_FORCE_STEPS, which the remote executor sets from its force_steps.
+#
+# If the function fails, the step is not recorded and the script exits with
+# the functions status, so that the remote execution fails immediately.
+
+STEPS_DIR=/var/lib/ezpbars/steps
+
+step_inputs_hash() {
+    local fn=$1
+    shift
+    {
+        declare -f "$fn"
+        for input in "$@"
+        do
+            if [ -f "$input" ]
+            then
+                echo "file $input"
+                cat "$input"
+            else
+                echo "value $input"
+            fi
+        done
+    } | sha256sum | cut -d ' ' -f 1
+}
+
+step_is_forced() {
+    local name=$1
+    for forced in $EZPBARS_FORCE_STEPS
+    do
+        if [ "$forced" = "$name" ] || [ "$forced" = "*" ]
+        then
+            return 0
+        fi
+    done
+    return 1
+}
+
+run_step() {
+    local name=$1
+    local fn=$2
+    shift 2
+    local marker="$STEPS_DIR/$name"
+    local inputs_hash=$(step_inputs_hash "$fn" "$@")
+
+    echo "sfs phase $name"
+    if ! step_is_forced "$name" && [ -f "$marker" ] && [ "$(cat "$marker")" = "$inputs_hash" ]
+    then
+        echo "step $name is unchanged, skipping"
+        return 0
+    fi
+
+    rm -f "$marker"
+    "$fn"
+    local status=$?
+    if [ $status -ne 0 ]
+    then
+        echo "step $name failed with status $status" >&2
+        exit $status
+    fi
+
+    mkdir -p "$STEPS_DIR"
+    echo "$inputs_hash" > "$marker"
+}
+
+clear_step() {
+    rm -f "$STEPS_DIR/$1"
+}
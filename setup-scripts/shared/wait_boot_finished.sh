@@ -1,3 +1,6 @@
+SHARED_DIR="$(dirname "${BASH_SOURCE[0]}")"
+source "$SHARED_DIR/steps.sh"
+
 wait_internet() {
     while ! curl google.com >> /dev/null
     do
@@ -40,6 +43,12 @@ install_latest_python() {
     python3 -m pip install -U pip
 }
 
+install_agent() {
+    mkdir -p /usr/local/lib/ezpbars
+    cp "$SHARED_DIR/agent.py" /usr/local/lib/ezpbars/agent.py
+    chmod 700 /usr/local/lib/ezpbars/agent.py
+}
+
 verify_iam_profile() {
     curl http://169.254.169.254/latest/meta-data/iam/info | jq -e .InstanceProfileId
     return $?
@@ -62,6 +71,7 @@ wait_iam_profile() {
 }
 
 wait_internet
-install_basic_dependencies
+run_step install_basic_dependencies install_basic_dependencies
 wait_iam_profile
-install_latest_python
+run_step install_latest_python install_latest_python
+run_step install_agent install_agent "$SHARED_DIR/agent.py"
@@ -0,0 +1,28 @@
+#!/usr/bin/env bash
+# Waits until the webapp answers http requests on port 80, so that a rolling
+# deploy only moves on to the next batch of instances once this one is
+# serving again. Any status below 500 counts as healthy. Skipped when no
+# path is configured, eg., for webapps which do not serve http.
+HEALTH_CHECK_PATH="{{HEALTH_CHECK_PATH}}"
+HEALTH_CHECK_TIMEOUT="{{HEALTH_CHECK_TIMEOUT}}"
+if [ -z "$HEALTH_CHECK_PATH" ]
+then
+    exit 0
+fi
+deadline=$((SECONDS + HEALTH_CHECK_TIMEOUT))
+while true
+do
+    status=$(curl -s -o /dev/null -w "%{http_code}" --max-time 5 "http://127.0.0.1:80${HEALTH_CHECK_PATH}")
+    if [ "$status" -ge 200 ] && [ "$status" -lt 500 ]
+    then
+        echo "webapp is healthy (${HEALTH_CHECK_PATH} answered $status)"
+        exit 0
+    fi
+    if [ $SECONDS -ge $deadline ]
+    then
+        echo "webapp is unhealthy after ${HEALTH_CHECK_TIMEOUT}s (${HEALTH_CHECK_PATH} answered $status)" >&2
+        exit 1
+    fi
+    echo "waiting for webapp to become healthy (${HEALTH_CHECK_PATH} answered $status)"
+    sleep 2
+done
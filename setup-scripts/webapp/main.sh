@@ -1,8 +1,11 @@
 #!/usr/bin/env bash
-bash shared/wait_boot_finished.sh
+bash shared/wait_boot_finished.sh || exit $?
 cp config.sh /home/ec2-user/config.sh
 cp repo.sh /home/ec2-user/repo.sh
 cp update_webapp.sh /home/ec2-user/update_webapp.sh
+cp health_check.sh /home/ec2-user/health_check.sh
+cp scaling.sh /home/ec2-user/scaling.sh
+cp worker_scaling.py /home/ec2-user/worker_scaling.py
 cd /usr/local/src
 . /home/ec2-user/repo.sh
 if [ ! -d webapp ]
@@ -20,5 +23,20 @@ cd /home/ec2-user
 crontab -l > cron
 sed -i "/@reboot sudo bash -c 'cd \/usr\/local\/src\/webapp/d" cron
 echo "@reboot sudo bash -c 'cd /usr/local/src/webapp && bash scripts/auto/start.sh'" >> cron
+sed -i "/worker_scaling.py/d" cron
+. /home/ec2-user/scaling.sh
+if [ -n "$SCALING_QUEUE_KEYS" ]
+then
+    echo "* * * * * sudo bash -c 'source /home/ec2-user/config.sh && source /home/ec2-user/scaling.sh && python3 /home/ec2-user/worker_scaling.py publish-metric' > /home/ec2-user/worker_scaling_metric.log 2>&1" >> cron
+fi
+if [ -n "$SCALING_DRAIN_HOOK_NAME" ]
+then
+    echo "@reboot sudo screen -dmS drain bash -c 'source /home/ec2-user/scaling.sh && python3 /home/ec2-user/worker_scaling.py watch-drain >> /home/ec2-user/worker_scaling.log 2>&1'" >> cron
+    if ! screen -list | grep -q "\.drain"
+    then
+        screen -dmS drain bash -c 'source /home/ec2-user/scaling.sh && python3 /home/ec2-user/worker_scaling.py watch-drain >> /home/ec2-user/worker_scaling.log 2>&1'
+    fi
+fi
 crontab cron
 rm cron
+bash /home/ec2-user/health_check.sh || exit $?
@@ -0,0 +1,5 @@
+#!/usr/bin/env bash
+# how worker_scaling.py scales and drains this instance, if at all
+export SCALING_QUEUE_KEYS="{{SCALING_QUEUE_KEYS}}"
+export SCALING_METRIC_NAMESPACE="{{SCALING_METRIC_NAMESPACE}}"
+export SCALING_DRAIN_HOOK_NAME="{{SCALING_DRAIN_HOOK_NAME}}"
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""Lets an auto scaling group of job workers scale on the depth of their redis
+queues and drain before they are terminated. Only uses the standard library
+and the aws cli, which amazon linux comes with.
+
+    python3 worker_scaling.py publish-metric
+
+publishes the total length of the queues in SCALING_QUEUE_KEYS, and that
+length divided by the number of workers in service, to cloudwatch for the
+group this instance is in. The primary redis instance is found via sentinel
+on the hosts in REDIS_IPS. Run every minute from cron.
+
+    python3 worker_scaling.py watch-drain
+
+waits until this instance is about to be terminated, either by the group
+(via the SCALING_DRAIN_HOOK_NAME lifecycle hook) or by a spot interruption,
+then runs the applications scripts/auto/stop.sh, which should finish the
+jobs in progress without taking new ones, and lets the termination proceed.
+Run once per boot.
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from typing import Callable, List, Optional, Tuple, TypeVar
+
+METADATA_URL = "http://169.254.169.254/latest"
+"""The base url of the instance metadata service"""
+
+REDIS_PORT = 6379
+"""The port redis listens on"""
+
+SENTINEL_PORT = 26379
+"""The port redis sentinel listens on"""
+
+SENTINEL_MASTER_NAME = "mymaster"
+"""The name the primary redis instance is monitored under, see sentinel.conf"""
+
+DRAIN_POLL_INTERVAL = 5
+"""How many seconds to wait between checking if the instance is terminating"""
+
+WEBAPP_DIR = "/usr/local/src/webapp"
+"""Where the application is installed"""
+
+CONFIG_PATH = "/home/ec2-user/config.sh"
+"""The applications configuration"""
+
+T = TypeVar("T")
+
+
+def get_metadata(path: str) -> Optional[str]:
+    """Returns the instance metadata at the given path, e.g.,
+    meta-data/instance-id, or None if there is none
+    """
+    headers = dict()
+    try:
+        token_request = urllib.request.Request(
+            f"{METADATA_URL}/api/token",
+            method="PUT",
+            headers={"X-aws-ec2-metadata-token-ttl-seconds": "60"},
+        )
+        with urllib.request.urlopen(token_request, timeout=2) as response:
+            headers["X-aws-ec2-metadata-token"] = response.read().decode("utf-8")
+    except (urllib.error.URLError, OSError):
+        pass  # imdsv1
+
+    try:
+        request = urllib.request.Request(f"{METADATA_URL}/{path}", headers=headers)
+        with urllib.request.urlopen(request, timeout=2) as response:
+            return response.read().decode("utf-8")
+    except urllib.error.HTTPError as e:
+        if e.code == 404:
+            return None
+        raise
+
+
+def read_reply(reader) -> object:
+    """Reads one reply in the redis serialization protocol"""
+    line = reader.readline()
+    if not line:
+        raise EOFError("redis closed the connection")
+    kind, rest = line[:1], line[1:].rstrip(b"\r\n")
+    if kind == b"+":
+        return rest.decode("utf-8")
+    if kind == b"-":
+        raise RuntimeError(rest.decode("utf-8"))
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        return reader.read(length + 2)[:-2].decode("utf-8")
+    if kind == b"*":
+        length = int(rest)
+        if length < 0:
+            return None
+        return [read_reply(reader) for _ in range(length)]
+    raise RuntimeError(f"unexpected redis reply {line!r}")
+
+
+def redis_command(host: str, port: int, *args: str) -> object:
+    """Sends a single command to redis (or sentinel) and returns the reply"""
+    request = f"*{len(args)}\r\n".encode("utf-8")
+    for arg in args:
+        encoded = arg.encode("utf-8")
+        request += b"$%d\r\n%s\r\n" % (len(encoded), encoded)
+    with socket.create_connection((host, port), timeout=5) as sock:
+        sock.sendall(request)
+        with sock.makefile("rb") as reader:
+            return read_reply(reader)
+
+
+def find_primary(ips: List[str]) -> Tuple[str, int]:
+    """Returns the host and port of the primary redis instance, according to
+    the first sentinel which answers, or the first ip if none do
+    """
+    for ip in ips:
+        try:
+            reply = redis_command(
+                ip,
+                SENTINEL_PORT,
+                "SENTINEL",
+                "get-master-addr-by-name",
+                SENTINEL_MASTER_NAME,
+            )
+        except (OSError, EOFError, RuntimeError) as e:
+            print(f"sentinel on {ip} did not answer: {e!r}", file=sys.stderr)
+            continue
+        if reply:
+            return reply[0], int(reply[1])
+    return ips[0], REDIS_PORT
+
+
+def get_queue_length(ips: List[str], keys: List[str]) -> int:
+    """Returns the total length of the given lists on the primary redis
+    instance
+    """
+    host, port = find_primary(ips)
+    return sum(int(redis_command(host, port, "LLEN", key)) for key in keys)
+
+
+def aws(region: str, *args: str) -> object:
+    """Runs the aws cli with the given arguments, returning its json output,
+    if any
+    """
+    result = subprocess.run(
+        ["aws", *args, "--region", region, "--output", "json"],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return json.loads(result.stdout) if result.stdout.strip() else None
+
+
+def get_instance() -> Tuple[str, str]:
+    """Returns the id and region of this instance"""
+    identity = json.loads(get_metadata("dynamic/instance-identity/document"))
+    return identity["instanceId"], identity["region"]
+
+
+def get_group_name(instance_id: str, region: str) -> Optional[str]:
+    """Returns the name of the auto scaling group this instance is in, if any"""
+    instances = aws(
+        region,
+        "autoscaling",
+        "describe-auto-scaling-instances",
+        "--instance-ids",
+        instance_id,
+    )["AutoScalingInstances"]
+    return instances[0]["AutoScalingGroupName"] if instances else None
+
+
+def count_in_service(group_name: str, region: str) -> int:
+    """Returns how many instances of the given group are in service"""
+    groups = aws(
+        region,
+        "autoscaling",
+        "describe-auto-scaling-groups",
+        "--auto-scaling-group-names",
+        group_name,
+    )["AutoScalingGroups"]
+    return sum(
+        1
+        for group in groups
+        for instance in group["Instances"]
+        if instance["LifecycleState"] == "InService"
+    )
+
+
+def publish_metric() -> int:
+    """Publishes the queue length and backlog per instance of this instances
+    auto scaling group
+    """
+    keys = os.environ.get("SCALING_QUEUE_KEYS", "").split()
+    ips = [ip for ip in os.environ.get("REDIS_IPS", "").split(",") if ip]
+    namespace = os.environ["SCALING_METRIC_NAMESPACE"]
+    if not keys or not ips:
+        print("no queues or redis instances configured", file=sys.stderr)
+        return 1
+
+    instance_id, region = get_instance()
+    group_name = get_group_name(instance_id, region)
+    if group_name is None:
+        print(f"{instance_id} is not in an auto scaling group", file=sys.stderr)
+        return 1
+
+    queue_length = get_queue_length(ips, keys)
+    in_service = count_in_service(group_name, region)
+    backlog = queue_length / max(in_service, 1)
+    aws(
+        region,
+        "cloudwatch",
+        "put-metric-data",
+        "--namespace",
+        namespace,
+        "--metric-data",
+        json.dumps(
+            [
+                {
+                    "MetricName": "QueueLength",
+                    "Dimensions": [
+                        {"Name": "AutoScalingGroupName", "Value": group_name}
+                    ],
+                    "Value": queue_length,
+                    "Unit": "Count",
+                },
+                {
+                    "MetricName": "BacklogPerInstance",
+                    "Dimensions": [
+                        {"Name": "AutoScalingGroupName", "Value": group_name}
+                    ],
+                    "Value": backlog,
+                    "Unit": "Count",
+                },
+            ]
+        ),
+    )
+    print(f"{group_name}: queue_length={queue_length} backlog={backlog:.2f}")
+    return 0
+
+
+def wait_for_metadata(fn: Callable[[], T]) -> T:
+    """Calls the given function, which reads instance metadata, until it
+    succeeds
+    """
+    while True:
+        try:
+            return fn()
+        except (urllib.error.URLError, OSError, TypeError, ValueError) as e:
+            print(f"failed to read instance metadata: {e!r}", file=sys.stderr)
+            time.sleep(DRAIN_POLL_INTERVAL)
+
+
+def drain() -> None:
+    """Runs the applications stop script, which should finish the jobs in
+    progress without taking any new ones
+    """
+    subprocess.run(
+        [
+            "bash",
+            "-c",
+            f"cd {WEBAPP_DIR} && source {CONFIG_PATH} && bash scripts/auto/stop.sh",
+        ]
+    )
+
+
+def watch_drain() -> int:
+    """Waits until this instance is terminating, then drains it and lets the
+    termination continue
+    """
+    hook_name = os.environ.get("SCALING_DRAIN_HOOK_NAME", "")
+    instance_id, region = wait_for_metadata(get_instance)
+    while True:
+        try:
+            target_state = get_metadata("meta-data/autoscaling/target-lifecycle-state")
+            interrupted = get_metadata("meta-data/spot/instance-action") is not None
+        except (urllib.error.URLError, OSError) as e:
+            # a single failed request must not stop the watcher, or the
+            # instance is terminated without draining
+            print(f"failed to check the lifecycle state: {e!r}", file=sys.stderr)
+            time.sleep(DRAIN_POLL_INTERVAL)
+            continue
+        if target_state == "Terminated" or interrupted:
+            break
+        time.sleep(DRAIN_POLL_INTERVAL)
+
+    print(f"draining {instance_id} ({target_state=}, {interrupted=})")
+    drain()
+    print(f"drained {instance_id}")
+
+    group_name = get_group_name(instance_id, region)
+    if hook_name and group_name is not None and target_state == "Terminated":
+        aws(
+            region,
+            "autoscaling",
+            "complete-lifecycle-action",
+            "--lifecycle-hook-name",
+            hook_name,
+            "--auto-scaling-group-name",
+            group_name,
+            "--instance-id",
+            instance_id,
+            "--lifecycle-action-result",
+            "CONTINUE",
+        )
+    return 0
+
+
+def main(args: Optional[List[str]] = None) -> int:
+    """Runs the given command, returning the exit code"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("command", choices=["publish-metric", "watch-drain"])
+    parsed = parser.parse_args(args)
+    if parsed.command == "publish-metric":
+        return publish_metric()
+    return watch_drain()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
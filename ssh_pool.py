@@ -0,0 +1,529 @@
+"""Provides a process-wide pool of authenticated ssh connections, so that
+every remote execution performed by the same provider process can reuse
+the same transports (opening new channels on them) rather than paying for
+the tcp connection, key exchange and authentication each time.
+"""
+import atexit
+import io
+import random
+import socket
+import threading
+import time
+from typing import Callable, Dict, Iterator, Optional, Tuple, TypeVar
+import paramiko
+from phase_timing import PhaseTimer, timed
+
+T = TypeVar("T")
+
+DEFAULT_IDLE_TIMEOUT: float = 120
+"""How long, in seconds, a connection which is not in use is kept open"""
+
+DEFAULT_MAX_CONCURRENT_PER_BASTION: int = 8
+"""How many executions may be in flight through the same bastion (or, for
+hosts which are reached directly, against the same host) at once. Keeps
+us comfortably below the default sshd MaxSessions/MaxStartups limits.
+"""
+
+DEFAULT_CONNECT_DEADLINE: float = 300
+"""The default number of seconds to keep trying to connect to a host before
+giving up. Fresh instances typically accept connections within a minute.
+"""
+
+DEFAULT_PROBE_TIMEOUT: float = 3
+"""How long, in seconds, to wait for the tcp probe of port 22 to succeed"""
+
+DEFAULT_MAX_AUTH_FAILURES: int = 12
+"""The default number of times authentication may fail before giving up.
+Fresh instances often accept connections before cloud-init has installed
+the authorized key, so a few failures are expected, but a wrong key fails
+forever.
+"""
+
+PooledClientKey = Tuple[Optional[str], str, str]
+"""The key for a pooled client: (bastion, host, private key path), where
+the bastion is None if the host is connected to directly
+"""
+
+
+class PooledClient:
+    """A connected ssh client which is owned by a SSHClientPool"""
+
+    def __init__(
+        self,
+        key: PooledClientKey,
+        client: paramiko.SSHClient,
+        parent: Optional["PooledClient"] = None,
+    ) -> None:
+        self.key: PooledClientKey = key
+        """The key this client is stored under in the pool"""
+
+        self.client: paramiko.SSHClient = client
+        """The connected client; new channels may be opened on its transport"""
+
+        self.parent: Optional[PooledClient] = parent
+        """If this client is tunneled through a bastion, the pooled client for
+        the bastion. We hold a lease on the parent for as long as we are open.
+        """
+
+        self.leases: int = 0
+        """How many callers are currently using this client"""
+
+        self.last_used: float = time.monotonic()
+        """The monotonic time at which this client was last released"""
+
+        self.semaphore: Optional[threading.BoundedSemaphore] = None
+        """The concurrency semaphore held by the current lease, if any. Only
+        used on the client returned from acquire.
+        """
+
+    def is_active(self) -> bool:
+        """Determines if the underlying transport is still usable"""
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+
+class SSHClientPool:
+    """A thread-safe pool of ssh clients keyed by (bastion, host, key). Clients
+    which have been idle for longer than the idle timeout are closed, and the
+    number of concurrent leases through any one bastion is capped.
+    """
+
+    def __init__(
+        self,
+        idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+        max_concurrent_per_bastion: int = DEFAULT_MAX_CONCURRENT_PER_BASTION,
+    ) -> None:
+        self.idle_timeout: float = idle_timeout
+        """How long, in seconds, a client which is not in use is kept open"""
+
+        self.max_concurrent_per_bastion: int = max_concurrent_per_bastion
+        """How many leases may be held through the same bastion at once"""
+
+        self._lock = threading.Lock()
+        self._clients: Dict[PooledClientKey, PooledClient] = dict()
+        self._semaphores: Dict[str, threading.BoundedSemaphore] = dict()
+        self._private_keys: Dict[str, paramiko.PKey] = dict()
+
+    def get_private_key(self, private_key: str) -> paramiko.PKey:
+        """Loads the private key at the given path, caching the parsed key"""
+        with self._lock:
+            cached = self._private_keys.get(private_key)
+        if cached is not None:
+            return cached
+
+        parsed = load_private_key(private_key)
+        with self._lock:
+            return self._private_keys.setdefault(private_key, parsed)
+
+    def acquire(
+        self,
+        host: str,
+        private_key: str,
+        bastion: Optional[str] = None,
+        tunnel: bool = True,
+        probe_timeout: float = DEFAULT_PROBE_TIMEOUT,
+        timer: Optional[PhaseTimer] = None,
+    ) -> PooledClient:
+        """Leases a connected client for the machine which should execute
+        commands: the host when there is no bastion or when tunneling,
+        otherwise the bastion itself. When tunneling, the host is reached via
+        a direct-tcpip channel on the (also pooled) bastion transport.
+
+        Before a new connection is negotiated, the target port is probed
+        with a plain tcp connection (or, when tunneling, by the bastion
+        opening the channel) for at most probe_timeout seconds, so that an
+        unreachable machine fails fast rather than during the ssh handshake.
+
+        Blocks while the concurrency cap for the bastion is reached. The
+        result must be returned via release.
+
+        If a timer is specified, waiting for the concurrency cap and each
+        step of negotiating new connections are recorded on it.
+        """
+        semaphore = self._get_semaphore(bastion if bastion is not None else host)
+        with timed(timer, "wait_for_slot"):
+            semaphore.acquire()
+        try:
+            if bastion is None:
+                pooled = self._acquire_direct(host, private_key, probe_timeout, timer)
+            elif not tunnel:
+                pooled = self._acquire_direct(
+                    bastion, private_key, probe_timeout, timer, "bastion_"
+                )
+            else:
+                pooled = self._acquire_tunneled(
+                    bastion, host, private_key, probe_timeout, timer
+                )
+        except BaseException:
+            semaphore.release()
+            raise
+        pooled.semaphore = semaphore
+        return pooled
+
+    def release(self, pooled: PooledClient, discard: bool = False) -> None:
+        """Returns a client leased via acquire. If discard is True, the client
+        is closed rather than kept for reuse, which should be done whenever
+        the connection may be in a bad state.
+        """
+        semaphore = pooled.semaphore
+        pooled.semaphore = None
+        try:
+            with self._lock:
+                self._release_locked(pooled)
+                if discard:
+                    self._close_locked(pooled)
+                self._evict_idle_locked()
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+
+    def close_all(self) -> None:
+        """Closes every client in the pool, regardless of whether or not it
+        is in use
+        """
+        with self._lock:
+            for pooled in list(self._clients.values()):
+                if pooled.parent is not None:
+                    self._close_locked(pooled)
+            for pooled in list(self._clients.values()):
+                self._close_locked(pooled)
+
+    def _get_semaphore(self, bastion: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            semaphore = self._semaphores.get(bastion)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.max_concurrent_per_bastion)
+                self._semaphores[bastion] = semaphore
+            return semaphore
+
+    def _acquire_direct(
+        self,
+        host: str,
+        private_key: str,
+        probe_timeout: float,
+        timer: Optional[PhaseTimer] = None,
+        phase_prefix: str = "",
+    ) -> PooledClient:
+        key: PooledClientKey = (None, host, private_key)
+        with self._lock:
+            self._evict_idle_locked()
+            existing = self._lease_existing_locked(key)
+        if existing is not None:
+            return existing
+
+        with timed(timer, f"{phase_prefix}tcp_connect"):
+            probe_tcp(*split_host_port(host), timeout=probe_timeout)
+        with timed(timer, f"{phase_prefix}ssh_auth"):
+            client = connect_client(host, self.get_private_key(private_key))
+        return self._store(PooledClient(key, client))
+
+    def _acquire_tunneled(
+        self,
+        bastion: str,
+        host: str,
+        private_key: str,
+        probe_timeout: float,
+        timer: Optional[PhaseTimer] = None,
+    ) -> PooledClient:
+        key: PooledClientKey = (bastion, host, private_key)
+        with self._lock:
+            self._evict_idle_locked()
+            existing = self._lease_existing_locked(key)
+        if existing is not None:
+            return existing
+
+        # the lease on the bastion is held for as long as the tunneled client
+        # is open, and is released when the tunneled client is closed
+        bastion_pooled = self._acquire_direct(
+            bastion, private_key, probe_timeout, timer, "bastion_"
+        )
+        try:
+            # the bastion only confirms the channel once its tcp connection to
+            # the host succeeds, so this doubles as the probe
+            with timed(timer, "bastion_hop"):
+                channel = bastion_pooled.client.get_transport().open_channel(
+                    "direct-tcpip",
+                    split_host_port(host),
+                    ("127.0.0.1", 0),
+                    timeout=probe_timeout,
+                )
+            with timed(timer, "ssh_auth"):
+                client = connect_client(
+                    host, self.get_private_key(private_key), channel
+                )
+        except BaseException:
+            with self._lock:
+                self._release_locked(bastion_pooled)
+                if not bastion_pooled.is_active():
+                    self._close_locked(bastion_pooled)
+            raise
+        return self._store(PooledClient(key, client, parent=bastion_pooled))
+
+    def _store(self, pooled: PooledClient) -> PooledClient:
+        """Stores the newly connected client and leases it, unless another
+        thread connected the same key in the meantime, in which case the
+        other client is leased and ours is closed
+        """
+        with self._lock:
+            existing = self._lease_existing_locked(pooled.key)
+            if existing is not None:
+                self._close_unstored_locked(pooled)
+                return existing
+
+            pooled.leases = 1
+            self._clients[pooled.key] = pooled
+            return pooled
+
+    def _lease_existing_locked(self, key: PooledClientKey) -> Optional[PooledClient]:
+        existing = self._clients.get(key)
+        if existing is None:
+            return None
+        if not existing.is_active():
+            self._close_locked(existing)
+            return None
+        existing.leases += 1
+        return existing
+
+    def _release_locked(self, pooled: PooledClient) -> None:
+        pooled.leases = max(pooled.leases - 1, 0)
+        pooled.last_used = time.monotonic()
+
+    def _close_locked(self, pooled: PooledClient) -> None:
+        if self._clients.get(pooled.key) is pooled:
+            del self._clients[pooled.key]
+        self._close_unstored_locked(pooled)
+
+    def _close_unstored_locked(self, pooled: PooledClient) -> None:
+        try:
+            pooled.client.close()
+        except Exception:
+            pass
+        if pooled.parent is not None:
+            self._release_locked(pooled.parent)
+            pooled.parent = None
+
+    def _evict_idle_locked(self) -> None:
+        now = time.monotonic()
+        # tunneled clients first, since they hold leases on their bastions
+        for pooled in sorted(self._clients.values(), key=lambda p: p.parent is None):
+            if pooled.leases <= 0 and now - pooled.last_used > self.idle_timeout:
+                self._close_locked(pooled)
+
+
+class RemoteConnectError(Exception):
+    """Raised when a host could not be connected to within the deadline of
+    the retry policy
+    """
+
+
+class ConnectRetryPolicy:
+    """Describes how to retry connecting to a host which may not be reachable
+    yet, such as a freshly launched instance: exponential backoff with
+    jitter, up to an overall deadline
+    """
+
+    def __init__(
+        self,
+        deadline: float = DEFAULT_CONNECT_DEADLINE,
+        initial_delay: float = 0.25,
+        max_delay: float = 5,
+        multiplier: float = 2,
+        probe_timeout: float = DEFAULT_PROBE_TIMEOUT,
+        max_auth_failures: int = DEFAULT_MAX_AUTH_FAILURES,
+    ) -> None:
+        """Creates a new retry policy.
+
+        Args:
+            deadline (float): how many seconds to keep trying before giving up
+            initial_delay (float): the delay in seconds after the first failure
+            max_delay (float): the maximum delay in seconds between attempts
+            multiplier (float): how much the delay grows after each failure
+            probe_timeout (float): how long to wait for the cheap tcp probe
+                of port 22 on each attempt
+            max_auth_failures (int): how many times authentication may fail,
+                within the deadline, before giving up
+        """
+        self.deadline: float = deadline
+        """How many seconds to keep trying before giving up"""
+
+        self.initial_delay: float = initial_delay
+        """The delay in seconds after the first failure"""
+
+        self.max_delay: float = max_delay
+        """The maximum delay in seconds between attempts"""
+
+        self.multiplier: float = multiplier
+        """How much the delay grows after each failure"""
+
+        self.probe_timeout: float = probe_timeout
+        """How long to wait for the cheap tcp probe of port 22 on each attempt"""
+
+        self.max_auth_failures: int = max_auth_failures
+        """How many times authentication may fail before giving up"""
+
+    def delays(self) -> Iterator[float]:
+        """Yields the delay before each retry, forever. Each delay is between
+        half and all of the current backoff, so that many executions waiting
+        on the same host or bastion spread out
+        """
+        backoff = self.initial_delay
+        while True:
+            yield backoff / 2 + random.uniform(0, backoff / 2)
+            backoff = min(backoff * self.multiplier, self.max_delay)
+
+    def run(self, attempt: Callable[[], T], description: str) -> T:
+        """Calls attempt until it succeeds, returning its result, or raises
+        RemoteConnectError once the deadline passes or authentication has
+        failed max_auth_failures times. Only errors which may be transient
+        (see is_transient_connect_error) are retried; any other error is
+        raised immediately. The description is used in the error, e.g.,
+        "ec2-user@10.0.1.5 via 54.1.2.3"
+        """
+        started_at = time.monotonic()
+        attempts = 0
+        auth_failures = 0
+        for delay in self.delays():
+            attempts += 1
+            try:
+                return attempt()
+            except Exception as e:
+                if not is_transient_connect_error(e):
+                    raise
+                if isinstance(e, paramiko.AuthenticationException):
+                    auth_failures += 1
+                    if auth_failures >= self.max_auth_failures:
+                        raise RemoteConnectError(
+                            f"could not authenticate to {description} "
+                            f"({auth_failures} attempts): {e!r}"
+                        ) from e
+                remaining = self.deadline - (time.monotonic() - started_at)
+                if remaining <= 0:
+                    raise RemoteConnectError(
+                        f"could not connect to {description} within "
+                        f"{self.deadline:g}s ({attempts} attempts): {e!r}"
+                    ) from e
+            time.sleep(min(delay, remaining))
+
+    def write_wait_commands(
+        self, condition: str, description: str, writer: io.StringIO
+    ) -> None:
+        """Writes the bash commands to retry the given condition command
+        according to this policy, exiting the script with status 1 once
+        the deadline passes. The multiplier is rounded to an integer, since
+        bash only supports integer arithmetic.
+        """
+        multiplier = max(round(self.multiplier), 1)
+        max_delay_ms = int(self.max_delay * 1000)
+        writer.write(f"connect_deadline=$((SECONDS + {int(self.deadline)}))\n")
+        writer.write(f"connect_backoff_ms={int(self.initial_delay * 1000)}\n")
+        writer.write(f"while ! ({condition})\n")
+        writer.write("do\n")
+        writer.write("    if [ $SECONDS -ge $connect_deadline ]\n")
+        writer.write("    then\n")
+        writer.write(
+            f'        echo "could not connect to {description} within {self.deadline:g}s" >&2\n'
+        )
+        writer.write("        exit 1\n")
+        writer.write("    fi\n")
+        writer.write(
+            "    connect_delay_ms=$((connect_backoff_ms / 2 + RANDOM % (connect_backoff_ms / 2 + 1)))\n"
+        )
+        writer.write(
+            "    sleep $((connect_delay_ms / 1000)).$(printf '%03d' $((connect_delay_ms % 1000)))\n"
+        )
+        writer.write(f"    connect_backoff_ms=$((connect_backoff_ms * {multiplier}))\n")
+        writer.write(
+            f"    connect_backoff_ms=$((connect_backoff_ms > {max_delay_ms} ? {max_delay_ms} : connect_backoff_ms))\n"
+        )
+        writer.write("done\n")
+
+
+def split_host_port(host: str, default_port: int = 22) -> Tuple[str, int]:
+    """Splits the given host into its hostname and port, where the host may
+    optionally end with ":port" (eg., for machines listening on a port other
+    than 22, such as local servers)
+    """
+    hostname, separator, port = host.rpartition(":")
+    if separator and hostname and port.isdigit() and ":" not in hostname:
+        return hostname, int(port)
+    return host, default_port
+
+
+def is_transient_connect_error(e: BaseException) -> bool:
+    """Determines if the given error from connecting to a host may go away by
+    itself, such as the host not accepting connections yet or, on a fresh
+    instance, not having its authorized key installed yet, as opposed to an
+    error which retrying can not fix, such as the private key being missing
+    or invalid
+    """
+    if isinstance(e, paramiko.SSHException):
+        return True
+    if isinstance(
+        e, (FileNotFoundError, IsADirectoryError, NotADirectoryError, PermissionError)
+    ):
+        # the private key file, rather than the network
+        return False
+    # includes socket.timeout, socket.gaierror and NoValidConnectionsError
+    return isinstance(e, (OSError, EOFError))
+
+
+def probe_tcp(
+    host: str, port: int = 22, timeout: float = DEFAULT_PROBE_TIMEOUT
+) -> None:
+    """Opens and immediately closes a tcp connection to the given host and
+    port, raising an OSError if that is not possible within the timeout
+    """
+    with socket.create_connection((host, port), timeout=timeout):
+        pass
+
+
+def load_private_key(private_key: str) -> paramiko.PKey:
+    """Parses the private key file at the given path, which may be any of
+    the key types supported by paramiko, raising a ValueError if it is none
+    of them
+    """
+    for key_class in (
+        paramiko.RSAKey,
+        paramiko.Ed25519Key,
+        paramiko.ECDSAKey,
+        paramiko.DSSKey,
+    ):
+        try:
+            return key_class.from_private_key_file(private_key)
+        except paramiko.SSHException:
+            continue
+    raise ValueError(f"unsupported private key type at {private_key=}")
+
+
+def connect_client(
+    hostname: str, pkey: paramiko.PKey, sock: Optional[paramiko.Channel] = None
+) -> paramiko.SSHClient:
+    """Connects to the given host (optionally ending with ":port") as ec2-user
+    using the given private key, optionally over an already open socket-like
+    channel
+    """
+    hostname, port = split_host_port(hostname)
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    try:
+        client.connect(
+            hostname=hostname,
+            port=port,
+            username="ec2-user",
+            pkey=pkey,
+            look_for_keys=False,
+            allow_agent=False,
+            auth_timeout=5,
+            banner_timeout=5,
+            sock=sock,
+        )
+    except BaseException:
+        client.close()
+        raise
+    return client
+
+
+SSH_POOL = SSHClientPool()
+"""The pool shared by every remote execution within this process"""
+
+atexit.register(SSH_POOL.close_all)
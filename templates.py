@@ -0,0 +1,262 @@
+"""Provides precompiled templates for the file substitutions of remote
+executions. Each file is parsed once into literal and placeholder segments,
+and parsed templates are cached by the hash of the files contents, so that
+rendering the same script folder for many hosts is just a join.
+
+Two forms of placeholder are supported. When a line consists of just
+whitespace followed by {{KEY}}, the line is replaced by the value with that
+whitespace prepended to each of its lines (and anything after the
+placeholder is dropped). Otherwise, every {{KEY}} is replaced by the value
+directly. Rendered files always use unix line endings.
+"""
+import os
+import re
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Union
+from script_hash import DIRECTORY_HASHER, list_files
+
+INDENTATION_PRESERVED_REGEX = re.compile(r"^(?P<indent>\s*)\{\{(?P<key>.+?)\}\}")
+"""Matches a line which starts with a placeholder whose value should be
+indented to match it"""
+
+SIMPLE_SUBSTITUTION_REGEX = re.compile(r"\{\{(?P<key>.+?)\}\}")
+"""Matches any placeholder"""
+
+
+class UndefinedSubstitutionError(ValueError):
+    """Raised when templates reference keys which have no substitution"""
+
+    def __init__(self, undefined: Dict[str, List[str]]) -> None:
+        """Creates a new error for the given undefined keys, keyed by the
+        path of the file which references them
+        """
+        super().__init__(
+            "undefined substitutions: "
+            + "; ".join(
+                f"{path}: {', '.join(keys)}" for path, keys in undefined.items()
+            )
+        )
+        self.undefined: Dict[str, List[str]] = undefined
+        """The undefined keys, keyed by the path of the file referencing them"""
+
+
+class Placeholder:
+    """A segment of a template which is replaced by a substitution"""
+
+    def __init__(
+        self, key: str, indent: Optional[str] = None, at_line_end: bool = False
+    ) -> None:
+        self.key: str = key
+        """The key of the substitution"""
+
+        self.indent: Optional[str] = indent
+        """If this placeholder makes up its entire line, the whitespace which
+        preceded it and is hence prepended to every line of the value.
+        None for placeholders which are substituted directly.
+        """
+
+        self.at_line_end: bool = at_line_end
+        """True if this placeholder is substituted directly and is the last
+        thing on its line, in which case trailing newlines are stripped from
+        the value
+        """
+
+    def render(self, value: str) -> str:
+        """Renders this placeholder with the given value"""
+        if self.indent is not None:
+            return "".join(
+                (self.indent + subline).rstrip("\r\n") + "\n"
+                for subline in value.split("\n")
+            )
+        if self.at_line_end:
+            return value.rstrip("\r\n")
+        return value
+
+
+class Template:
+    """A parsed file, ready to be rendered with substitutions"""
+
+    def __init__(self, segments: List[Union[str, Placeholder]]) -> None:
+        self.segments: List[Union[str, Placeholder]] = segments
+        """The literal and placeholder segments of the file, in order"""
+
+        self.keys: Set[str] = set(
+            segment.key for segment in segments if isinstance(segment, Placeholder)
+        )
+        """The keys referenced by this template"""
+
+    @classmethod
+    def parse(cls, text: str) -> "Template":
+        """Parses the given file contents into a template"""
+        segments: List[Union[str, Placeholder]] = []
+        literal: List[str] = []
+
+        def add_placeholder(placeholder: Placeholder) -> None:
+            if literal:
+                segments.append("".join(literal))
+                literal.clear()
+            segments.append(placeholder)
+
+        for line in text.splitlines(True):
+            if match := INDENTATION_PRESERVED_REGEX.match(line):
+                add_placeholder(
+                    Placeholder(match.group("key"), indent=match.group("indent"))
+                )
+                continue
+
+            line = line.rstrip("\r\n")
+            position = 0
+            for match in SIMPLE_SUBSTITUTION_REGEX.finditer(line):
+                literal.append(line[position : match.start()])
+                add_placeholder(
+                    Placeholder(
+                        match.group("key"), at_line_end=match.end() == len(line)
+                    )
+                )
+                position = match.end()
+            literal.append(line[position:] + "\n")
+
+        if literal:
+            segments.append("".join(literal))
+        return cls(segments)
+
+    def render(self, substitutions: Dict[str, str]) -> str:
+        """Renders this template with the given substitutions, which must
+        include every key referenced by the template
+        """
+        return "".join(
+            segment
+            if isinstance(segment, str)
+            else segment.render(substitutions[segment.key])
+            for segment in self.segments
+        )
+
+
+class TemplateCache:
+    """Caches parsed templates by the hash of the files contents"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._templates: Dict[str, Template] = dict()
+
+    def load(self, path: str) -> Template:
+        """Returns the parsed template for the file at the given path"""
+        digest = DIRECTORY_HASHER.hash_file(path)
+        with self._lock:
+            cached = self._templates.get(digest)
+        if cached is not None:
+            return cached
+
+        with open(path, "rb") as f:
+            template = Template.parse(f.read().decode("utf-8"))
+
+        with self._lock:
+            self._templates[digest] = template
+        return template
+
+
+TEMPLATES = TemplateCache()
+"""The template cache shared by everything within this process"""
+
+
+def load_template(path: str) -> Template:
+    """Returns the parsed template for the file at the given path, which is
+    parsed at most once per process for the same contents
+    """
+    return TEMPLATES.load(path)
+
+
+def find_undefined_substitutions(
+    dirpaths: Iterable[Optional[str]],
+    file_substitutions: Optional[Dict[str, Dict[str, str]]],
+) -> Dict[str, List[str]]:
+    """Finds the keys referenced by files within the given folders which have
+    substitutions, but which are not in those substitutions. Files are
+    matched to substitutions by their unix-style path relative to the folder
+    they are in, and files without substitutions are never rendered, so they
+    are skipped. None folders are ignored.
+
+    Returns the sorted undefined keys keyed by the path of the file which
+    references them, empty if there are none.
+    """
+    result: Dict[str, List[str]] = dict()
+    if not file_substitutions:
+        return result
+
+    for dirpath in dirpaths:
+        if dirpath is None:
+            continue
+        for relative_path in list_files(dirpath):
+            this_file_subs = file_substitutions.get(relative_path)
+            if not this_file_subs:
+                continue
+            path = os.path.join(dirpath, relative_path)
+            undefined = load_template(path).keys - set(this_file_subs)
+            if undefined:
+                result[path] = sorted(undefined)
+    return result
+
+
+def get_substitution_coverage(
+    dirpaths: Iterable[Optional[str]],
+    file_substitutions: Optional[Dict[str, Dict[str, str]]],
+) -> Dict[str, Dict[str, List[str]]]:
+    """Describes how well the given substitutions cover the files within the
+    given folders, matched as in find_undefined_substitutions. None folders
+    are ignored.
+
+    Returns, keyed by the path of every file which references keys or has
+    substitutions, the sorted "referenced" keys, the "substituted" keys
+    (referenced and given a value, empty if the file is not rendered), the
+    "undefined" keys (referenced without a value) and the "unused" keys
+    (given a value but not referenced). Substitutions for files which do not
+    exist in any folder are keyed by their relative path with only "unused".
+    """
+    file_substitutions = file_substitutions or dict()
+    result: Dict[str, Dict[str, List[str]]] = dict()
+    matched: Set[str] = set()
+    for dirpath in dirpaths:
+        if dirpath is None:
+            continue
+        for relative_path in list_files(dirpath):
+            path = os.path.join(dirpath, relative_path)
+            this_file_subs = file_substitutions.get(relative_path) or dict()
+            if this_file_subs:
+                matched.add(relative_path)
+            try:
+                referenced = load_template(path).keys
+            except UnicodeDecodeError:
+                # binary files are never rendered
+                referenced = set()
+            if not referenced and not this_file_subs:
+                continue
+            result[path] = {
+                "referenced": sorted(referenced),
+                "substituted": sorted(referenced & set(this_file_subs)),
+                "undefined": sorted(referenced - set(this_file_subs))
+                if this_file_subs
+                else [],
+                "unused": sorted(set(this_file_subs) - referenced),
+            }
+
+    for relative_path, this_file_subs in file_substitutions.items():
+        if this_file_subs and relative_path not in matched:
+            result[relative_path] = {
+                "referenced": [],
+                "substituted": [],
+                "undefined": [],
+                "unused": sorted(this_file_subs),
+            }
+    return result
+
+
+def validate_substitutions(
+    dirpaths: Iterable[Optional[str]],
+    file_substitutions: Optional[Dict[str, Dict[str, str]]],
+) -> None:
+    """Raises an UndefinedSubstitutionError listing every key referenced by a
+    file within the given folders which has no substitution, if any
+    """
+    undefined = find_undefined_substitutions(dirpaths, file_substitutions)
+    if undefined:
+        raise UndefinedSubstitutionError(undefined)
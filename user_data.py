@@ -0,0 +1,114 @@
+"""Renders script folders into ec2 user data, so that instances launched
+without us (eg., by an auto scaling group) provision themselves on boot by
+running the same script folder, with the same substitutions, that a
+RemoteExecution would have run over ssh.
+
+The folder is rendered via build_archive and embedded in a bash script,
+which cloud-init runs as root on first boot. The script is gzipped, which
+cloud-init detects, to stay within the user data limit.
+
+User data is readable by anyone who can describe the launch template or
+the instance, so files holding secrets are not embedded. Instead they are
+stored as SecureString parameters in the SSM parameter store, and the
+script fetches them, using the instance profile, before running the
+entrypoint.
+"""
+import base64
+import gzip
+import shlex
+from typing import Dict, List, Optional
+from remote_executor import build_archive
+
+USER_DATA_LIMIT = 16 * 1024
+"""The maximum size of user data accepted by ec2, before base64 encoding"""
+
+SECRET_FETCH_ATTEMPTS = 10
+"""How many times to try to fetch each secret file before giving up, since
+the instance profile may take a moment to become usable after boot"""
+
+
+class UserDataTooLargeError(Exception):
+    """Raised when a rendered script folder does not fit within the user data
+    limit
+    """
+
+
+def render_user_data(
+    script_name: str,
+    shared_script_name: Optional[str] = None,
+    file_substitutions: Optional[Dict[str, Dict[str, str]]] = None,
+    entrypoint: str = "main.sh",
+    shared_files: Optional[List[str]] = None,
+    secret_files: Optional[Dict[str, str]] = None,
+) -> bytes:
+    """Renders the given script folder, and optionally the shared script folder
+    under "shared", into gzipped user data which unpacks it into a fresh
+    subdirectory of /usr/local/src and runs the entrypoint there.
+
+    Only the files in shared_files are included from the shared script
+    folder, if specified. secret_files maps paths within the script folder
+    to the names of the SSM parameters holding their contents, which are
+    fetched at boot rather than embedded; the paths should not have file
+    substitutions.
+
+    Raises a UserDataTooLargeError if the result exceeds USER_DATA_LIMIT.
+    """
+    archive = build_archive(
+        script_name, shared_script_name, file_substitutions, shared_files=shared_files
+    )
+    encoded_archive = base64.b64encode(archive).decode("ascii")
+    fetch_secrets: List[str] = []
+    if secret_files:
+        fetch_secrets = [
+            'token="$(curl -s -X PUT http://169.254.169.254/latest/api/token'
+            ' -H "X-aws-ec2-metadata-token-ttl-seconds: 60")"',
+            'region="$(curl -s -H "X-aws-ec2-metadata-token: $token"'
+            ' http://169.254.169.254/latest/meta-data/placement/region)"',
+            "fetch_secret() {",
+            f"    for attempt in $(seq {SECRET_FETCH_ATTEMPTS})",
+            "    do",
+            '        aws ssm get-parameter --region "$region" --name "$2"'
+            ' --with-decryption --query Parameter.Value --output text > "$1"'
+            " && return 0",
+            "        sleep 6",
+            "    done",
+            '    echo "failed to fetch $1 from $2"',
+            "    return 1",
+            "}",
+            *(
+                f"fetch_secret {shlex.quote(path)} {shlex.quote(parameter)}"
+                ' || { cd / && rm -rf "$bootstrap_dir"; exit 1; }'
+                for path, parameter in sorted(secret_files.items())
+            ),
+        ]
+    script = "\n".join(
+        [
+            "#!/usr/bin/env bash",
+            "mkdir -p /usr/local/src",
+            'bootstrap_dir="$(mktemp -d -p /usr/local/src)"',
+            'cd "$bootstrap_dir"',
+            "base64 -d <<'EOF' | tar -xz",
+            encoded_archive,
+            "EOF",
+            *fetch_secrets,
+            f"bash {entrypoint}",
+            "status=$?",
+            'cd / && rm -rf "$bootstrap_dir"',
+            "exit $status",
+            "",
+        ]
+    )
+    # a fixed gzip timestamp keeps the user data, and hence the launch
+    # template, stable between runs
+    result = gzip.compress(script.encode("utf-8"), mtime=0)
+    if len(result) > USER_DATA_LIMIT:
+        raise UserDataTooLargeError(
+            f"user data for {script_name} is {len(result)} bytes, "
+            f"which exceeds the limit of {USER_DATA_LIMIT}"
+        )
+    return result
+
+
+def encode_user_data(user_data: bytes) -> str:
+    """Encodes the given user data as base64, as launch templates expect"""
+    return base64.b64encode(user_data).decode("ascii")
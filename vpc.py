@@ -3,6 +3,7 @@ from typing import List
 import pulumi
 import pulumi_aws as aws
 from key import Key
+from ami import ResolvedAmi, resolve_ami
 import json
 
 AVAILABILITY_ZONES = ["us-west-2b", "us-west-2c", "us-west-2d"]
@@ -99,15 +100,7 @@ class VirtualPrivateCloud:
         ]
         """The route table association for each public subnet"""
 
-        self.nat_ami = aws.ec2.get_ami(
-            most_recent=True,
-            filters=[
-                aws.ec2.GetAmiFilterArgs(name="name", values=["amzn-ami-vpc-nat-*"]),
-                aws.ec2.GetAmiFilterArgs(name="virtualization-type", values=["hvm"]),
-                aws.ec2.GetAmiFilterArgs(name="architecture", values=["x86_64"]),
-            ],
-            owners=["137112412989"],
-        )
+        self.nat_ami: ResolvedAmi = resolve_ami("amzn-ami-vpc-nat-*", "x86_64")
         """The Amazon Machine Id for the NAT gateways"""
 
         self.nat_security_group = aws.ec2.SecurityGroup(
@@ -173,36 +166,14 @@ class VirtualPrivateCloud:
         ]
         """The route table associations for the private subnets"""
 
-        self.amazon_linux_arm64 = aws.ec2.get_ami(
-            most_recent=True,
-            filters=[
-                aws.ec2.GetAmiFilterArgs(name="name", values=["amzn2-ami-*"]),
-                aws.ec2.GetAmiFilterArgs(name="virtualization-type", values=["hvm"]),
-                aws.ec2.GetAmiFilterArgs(name="architecture", values=["arm64"]),
-            ],
-            owners=["137112412989"],
-        )
+        self.amazon_linux_arm64: ResolvedAmi = resolve_ami("amzn2-ami-*", "arm64")
         """The preferred arm64 ami"""
 
-        self.amazon_linux_amd64 = aws.ec2.get_ami(
-            most_recent=True,
-            filters=[
-                aws.ec2.GetAmiFilterArgs(name="name", values=["amzn2-ami-*"]),
-                aws.ec2.GetAmiFilterArgs(name="virtualization-type", values=["hvm"]),
-                aws.ec2.GetAmiFilterArgs(name="architecture", values=["x86_64"]),
-            ],
-            owners=["137112412989"],
-        )
+        self.amazon_linux_amd64: ResolvedAmi = resolve_ami("amzn2-ami-*", "x86_64")
         """The preferred amd64 ami"""
 
-        self.amazon_linux_bleeding_arm64 = aws.ec2.get_ami(
-            most_recent=True,
-            filters=[
-                aws.ec2.GetAmiFilterArgs(name="name", values=["al2022-ami-20*"]),
-                aws.ec2.GetAmiFilterArgs(name="virtualization-type", values=["hvm"]),
-                aws.ec2.GetAmiFilterArgs(name="architecture", values=["arm64"]),
-            ],
-            owners=["137112412989"],
+        self.amazon_linux_bleeding_arm64: ResolvedAmi = resolve_ami(
+            "al2022-ami-20*", "arm64"
         )
         """The bleeding edge arm64 ami, for if the preferred one is too out of date"""
 
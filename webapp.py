@@ -2,14 +2,161 @@
 a github repository and then can install itself after invoking the
 scripts/auto/after_install.sh from the repository, and the application
 is run via the scripts/auto/start.sh
+
+A webapp either runs on a fixed grid of instances which are provisioned
+over ssh, or, in the auto scaling mode, on an auto scaling group behind an
+internal load balancer, whose instances provision themselves from user data
+rendered from the same scripts.
 """
-from typing import List, Optional
+import json
+import os
+from typing import Dict, List, Optional, Tuple, Union
 from pulumi import ResourceOptions
 import pulumi
 import pulumi_aws as aws
 from vpc import VirtualPrivateCloud
 from key import Key
+from ami import ResolvedAmi, resolve_ami
+from environment import WebappEnvironment
+from golden_image import GoldenImage, get_image_options
 from remote_executor import RemoteExecution, RemoteExecutionInputs
+from templates import load_template
+from user_data import encode_user_data, render_user_data
+
+DEFAULT_HEALTH_CHECK_TIMEOUT: int = 300
+"""The default number of seconds an instance has to pass its health check
+after being deployed to"""
+
+DEFAULT_HEALTH_CHECK_GRACE_PERIOD: int = 900
+"""The default number of seconds an auto scaled instance has to boot and
+install the application before it is health checked"""
+
+DEFAULT_TARGET_BACKLOG_PER_INSTANCE: float = 20
+"""The default number of queued jobs per instance which a queue scaled group
+is kept at"""
+
+SCALING_METRIC_NAMESPACE = "ezpbars"
+"""The cloudwatch namespace setup-scripts/webapp/worker_scaling.py publishes
+queue metrics under"""
+
+USER_DATA_SHARED_FILES: List[str] = ["wait_boot_finished.sh", "steps.sh", "agent.py"]
+"""The files of setup-scripts/shared which setup-scripts/webapp/main.sh uses,
+the only ones included in user data: wait_boot_finished.sh, the steps.sh it
+sources and the agent.py it installs"""
+
+SECRET_FILES: List[str] = ["config.sh", "repo.sh"]
+"""The files of setup-scripts/webapp holding secrets (the configuration and
+the github token), which auto scaled instances fetch from the SSM parameter
+store at boot rather than receiving in their user data"""
+
+DRAIN_HOOK_NAME = "drain"
+"""The name of the lifecycle hook which lets instances drain before they
+are terminated"""
+
+
+class WebappAutoscaling:
+    """How a webapp in the auto scaling mode is scaled"""
+
+    def __init__(
+        self,
+        min_size: int = 2,
+        max_size: int = 6,
+        target_cpu_utilization: Optional[float] = 50,
+        target_requests_per_instance: Optional[float] = None,
+        load_balanced: bool = True,
+        health_check_grace_period: int = DEFAULT_HEALTH_CHECK_GRACE_PERIOD,
+        queue_keys: Optional[List[str]] = None,
+        target_backlog_per_instance: float = DEFAULT_TARGET_BACKLOG_PER_INSTANCE,
+        spot_instance_types: Optional[List[str]] = None,
+        on_demand_base_capacity: int = 1,
+        drain_timeout: Optional[int] = None,
+    ) -> None:
+        """Describes how to scale a webapp.
+
+        Auto scaled instances receive setup-scripts/webapp in the launch
+        templates user data, which anyone allowed to describe launch templates
+        or instances can read. Hence the files holding secrets (SECRET_FILES,
+        ie., the configuration and the github token) are instead stored as
+        SecureString parameters in the SSM parameter store, which instances
+        fetch at boot with their instance profile.
+
+        Args:
+            min_size (int): the fewest instances to run
+            max_size (int): the most instances to run
+            target_cpu_utilization (float, None): the average cpu utilization, as
+                a percentage, which instances are added or removed to keep the
+                group at, or None not to scale on cpu
+            target_requests_per_instance (float, None): the number of requests per
+                instance per minute, as counted by the load balancer, which
+                instances are added or removed to keep the group at, or None not
+                to scale on requests. Requires load_balanced
+            load_balanced (bool): whether the instances are registered with an
+                internal load balancer which the reverse proxy can target. Should
+                be false for applications which do not serve http
+            health_check_grace_period (int): how many seconds a new instance has
+                to boot and install the application before it is health checked
+            queue_keys (list[str], None): the redis lists holding the jobs the
+                application works on, e.g., for job workers. If specified, every
+                instance publishes their total length, divided by the number of
+                instances in service, every minute (see
+                setup-scripts/webapp/worker_scaling.py), and instances are added
+                or removed to keep it at target_backlog_per_instance. Requires
+                REDIS_IPS in the configuration and a min_size of at least 1
+            target_backlog_per_instance (float): how many queued jobs per instance
+                the group is kept at, if scaling on queue_keys
+            spot_instance_types (list[str], None): if specified, capacity beyond
+                on_demand_base_capacity is launched as spot instances of the
+                webapps instance type or any of these, whichever is available
+            on_demand_base_capacity (int): how many instances are always on
+                demand, if using spot_instance_types
+            drain_timeout (int, None): if specified, instances which are about to
+                be terminated, by scaling in or a spot interruption, first run
+                the applications scripts/auto/stop.sh, which should finish the
+                work in progress, for up to this many seconds
+        """
+        if queue_keys is not None and min_size < 1:
+            raise ValueError("scaling on queues requires a min_size of at least 1")
+        if min_size < 0 or max_size < max(min_size, 1):
+            raise ValueError(f"invalid sizes {min_size=}, {max_size=}")
+        if target_requests_per_instance is not None and not load_balanced:
+            raise ValueError("scaling on requests requires a load balancer")
+
+        self.min_size: int = min_size
+        """The fewest instances to run"""
+
+        self.max_size: int = max_size
+        """The most instances to run"""
+
+        self.target_cpu_utilization: Optional[float] = target_cpu_utilization
+        """The average cpu utilization to keep the group at, if scaling on cpu"""
+
+        self.target_requests_per_instance: Optional[
+            float
+        ] = target_requests_per_instance
+        """The requests per instance per minute to keep the group at, if scaling
+        on requests"""
+
+        self.load_balanced: bool = load_balanced
+        """Whether the instances are registered with an internal load balancer"""
+
+        self.health_check_grace_period: int = health_check_grace_period
+        """How many seconds a new instance has before it is health checked"""
+
+        self.queue_keys: Optional[List[str]] = queue_keys
+        """The redis lists whose length the group scales on, if any"""
+
+        self.target_backlog_per_instance: float = target_backlog_per_instance
+        """How many queued jobs per instance the group is kept at"""
+
+        self.spot_instance_types: Optional[List[str]] = spot_instance_types
+        """The instance types spot capacity may use, besides the webapps own,
+        if using spot instances"""
+
+        self.on_demand_base_capacity: int = on_demand_base_capacity
+        """How many instances are always on demand, if using spot instances"""
+
+        self.drain_timeout: Optional[int] = drain_timeout
+        """How many seconds terminating instances have to drain, if they drain"""
 
 
 class Webapp:
@@ -17,7 +164,9 @@ class Webapp:
     calling scripts/auto/after_install.sh in the repository. The application should
     be startable via scripts/auto/start.sh and stoppable via scripts/auto/stop.sh.
     The update flow is scripts/auto/stop.sh, scripts/auto/before_install.sh,
-    git pull, scripts/auto/after_install.sh, scripts/auto/start.sh
+    git pull, scripts/auto/after_install.sh, scripts/auto/start.sh, which is
+    rolled out a batch of instances at a time, optionally waiting for each
+    instance to pass an http health check before moving on
     """
 
     def __init__(
@@ -33,6 +182,12 @@ class Webapp:
         instance_type: str = "t4g.nano",
         num_subnets: int = 2,
         num_instances_per_subnet: int = 1,
+        environment: Optional[List[str]] = None,
+        max_unavailable: Optional[int] = None,
+        health_check_path: Optional[str] = None,
+        health_check_timeout: int = DEFAULT_HEALTH_CHECK_TIMEOUT,
+        image: Optional[GoldenImage] = None,
+        autoscaling: Optional[WebappAutoscaling] = None,
     ):
         """Creates a new webapp in the first N private subnets of the
         given virtual private cloud.
@@ -58,6 +213,31 @@ class Webapp:
             num_subnets (int): how many subnets to install the application to
             num_instances_per_subnet (int): how many instances of the application to
                 install in each subnet
+            environment (list[str], None): the names of the environment variables
+                the application consumes when configured via a WebappEnvironment,
+                or None for every variable in the environment
+            max_unavailable (int, None): how many instances may be deployed to at
+                the same time. Instances are deployed to in batches of this size,
+                in subnet order, and each batch only starts once the previous one
+                succeeded. None for one subnet at a time, i.e.,
+                num_instances_per_subnet
+            health_check_path (str, None): the path which must answer http requests
+                on port 80 with a status below 500 before an instance counts as
+                deployed, e.g., "/", or None to skip the health check, e.g., for
+                applications which do not serve http
+            health_check_timeout (int): how many seconds an instance has to pass
+                its health check before its deploy fails, which stops the rollout
+            image (GoldenImage, None): if specified, the instances are launched
+                from this image, which must have the webapp role baked in, so
+                that provisioning skips the baked steps. Instances keep the
+                image they were launched from when it is rebaked, and only pick
+                up the new one when they are next replaced
+            autoscaling (WebappAutoscaling, None): if specified, the application
+                runs on an auto scaling group in the first num_subnets private
+                subnets instead of on a fixed grid of instances. Its instances
+                run setup-scripts/webapp from user data on boot, rather than
+                over ssh, and are replaced a batch at a time (see max_unavailable)
+                via an instance refresh whenever the configuration changes
 
         """
         self.resource_name: str = resource_name
@@ -93,16 +273,42 @@ class Webapp:
         self.num_instances_per_subnet = num_instances_per_subnet
         """How many instances of the application to install in each subnet"""
 
-        self.ami: aws.ec2.Ami = aws.ec2.get_ami(
-            most_recent=True,
-            filters=[
-                aws.ec2.GetAmiFilterArgs(name="name", values=["amzn2-ami-*"]),
-                aws.ec2.GetAmiFilterArgs(name="virtualization-type", values=["hvm"]),
-                aws.ec2.GetAmiFilterArgs(name="architecture", values=[architecture]),
-            ],
-            owners=["137112412989"],
+        self.environment: Optional[List[str]] = (
+            sorted(set(environment)) if environment is not None else None
         )
-        """The amazon machine id that the instances use"""
+        """The sorted names of the environment variables the application consumes,
+        or None for every variable"""
+
+        if max_unavailable is None:
+            max_unavailable = num_instances_per_subnet
+        if max_unavailable < 1:
+            raise ValueError(f"{max_unavailable=} must be at least 1")
+
+        self.max_unavailable: int = max_unavailable
+        """How many instances may be deployed to at the same time"""
+
+        self.health_check_path: Optional[str] = health_check_path
+        """The path which must answer http requests before an instance counts as
+        deployed, or None if the instances are not health checked"""
+
+        self.health_check_timeout: int = health_check_timeout
+        """How many seconds an instance has to pass its health check"""
+
+        if image is not None:
+            image.check_compatible("webapp", architecture)
+
+        self.image: Optional[GoldenImage] = image
+        """The golden image the instances are launched from, if any"""
+
+        if autoscaling is not None and autoscaling.load_balanced and num_subnets < 2:
+            raise ValueError("load balancers require at least 2 subnets")
+
+        self.autoscaling: Optional[WebappAutoscaling] = autoscaling
+        """How the application is scaled, if it runs on an auto scaling group"""
+
+        self.ami: ResolvedAmi = resolve_ami("amzn2-ami-*", architecture)
+        """The amazon machine id that the instances use, unless launched from
+        the golden image"""
 
         self.security_group: aws.ec2.SecurityGroup = aws.ec2.SecurityGroup(
             f"{resource_name}-security-group",
@@ -122,28 +328,120 @@ class Webapp:
         )
         """the security group used for instances"""
 
-        self.instances_by_subnet: List[List[aws.ec2.Instance]] = [
-            [
-                aws.ec2.Instance(
-                    f"{resource_name}-instance-{subnet_idx}-{instance_idx}",
-                    ami=self.ami.id,
-                    associate_public_ip_address=False,
-                    instance_type=instance_type,
-                    subnet_id=subnet.id,
-                    key_name=self.vpc.key.key_pair.key_name,
-                    vpc_security_group_ids=[self.security_group.id],
-                    iam_instance_profile=self.vpc.standard_instance_profile.name,
-                    tags={
-                        "Name": f"{resource_name} {vpc.availability_zones[subnet_idx]}-{instance_idx}"
-                    },
-                )
-                for instance_idx in range(num_instances_per_subnet)
+        self.instances_by_subnet: List[List[aws.ec2.Instance]] = (
+            [[] for _ in range(num_subnets)]
+            if autoscaling is not None
+            else [
+                [
+                    aws.ec2.Instance(
+                        f"{resource_name}-instance-{subnet_idx}-{instance_idx}",
+                        ami=image.ami_id if image is not None else self.ami.id,
+                        associate_public_ip_address=False,
+                        instance_type=instance_type,
+                        subnet_id=subnet.id,
+                        key_name=self.vpc.key.key_pair.key_name,
+                        vpc_security_group_ids=[self.security_group.id],
+                        iam_instance_profile=self.vpc.standard_instance_profile.name,
+                        tags={
+                            "Name": f"{resource_name} {vpc.availability_zones[subnet_idx]}-{instance_idx}"
+                        },
+                        opts=get_image_options(image),
+                    )
+                    for instance_idx in range(num_instances_per_subnet)
+                ]
+                for subnet_idx, subnet in enumerate(vpc.private_subnets[:num_subnets])
             ]
-            for subnet_idx, subnet in enumerate(vpc.private_subnets[:num_subnets])
-        ]
-        """The ec2 instances running the application, broken down by subnet"""
+        )
+        """The ec2 instances running the application, broken down by subnet. Empty
+        in the auto scaling mode, where the instances are managed by the auto
+        scaling group"""
+
+        self.load_balancer: Optional[aws.lb.LoadBalancer] = None
+        """In the auto scaling mode, if load balanced, the internal load balancer
+        in front of the instances"""
+
+        self.target_group: Optional[aws.lb.TargetGroup] = None
+        """In the auto scaling mode, if load balanced, the target group the
+        instances are registered with"""
+
+        self.listener: Optional[aws.lb.Listener] = None
+        """In the auto scaling mode, if load balanced, the listener which forwards
+        http requests to the target group"""
+
+        if autoscaling is not None and autoscaling.load_balanced:
+            self.load_balancer = aws.lb.LoadBalancer(
+                f"{resource_name}-lb",
+                name=make_load_balancer_name(resource_name, "lb"),
+                internal=True,
+                load_balancer_type="application",
+                security_groups=[self.security_group.id],
+                subnets=[subnet.id for subnet in vpc.private_subnets[:num_subnets]],
+                tags={"Name": f"{resource_name} load balancer"},
+            )
+            self.target_group = aws.lb.TargetGroup(
+                f"{resource_name}-target-group",
+                name=make_load_balancer_name(resource_name, "tg"),
+                port=80,
+                protocol="HTTP",
+                target_type="instance",
+                vpc_id=self.vpc.vpc.id,
+                deregistration_delay=30,
+                health_check=aws.lb.TargetGroupHealthCheckArgs(
+                    path=health_check_path or "/",
+                    matcher="200-499",
+                    interval=15,
+                    healthy_threshold=2,
+                    unhealthy_threshold=3,
+                ),
+                tags={"Name": f"{resource_name} target group"},
+            )
+            self.listener = aws.lb.Listener(
+                f"{resource_name}-listener",
+                load_balancer_arn=self.load_balancer.arn,
+                port=80,
+                protocol="HTTP",
+                default_actions=[
+                    aws.lb.ListenerDefaultActionArgs(
+                        type="forward", target_group_arn=self.target_group.arn
+                    )
+                ],
+            )
+
+        self.launch_template: Optional[aws.ec2.LaunchTemplate] = None
+        """In the auto scaling mode, the launch template of the instances, not
+        initialized until perform_remote_executions is called"""
+
+        self.autoscaling_group: Optional[aws.autoscaling.Group] = None
+        """In the auto scaling mode, the auto scaling group running the
+        application, not initialized until perform_remote_executions is called"""
+
+        self.scaling_policies: List[aws.autoscaling.Policy] = []
+        """In the auto scaling mode, the policies which scale the auto scaling
+        group, not initialized until perform_remote_executions is called"""
+
+        self.drain_hook: Optional[aws.autoscaling.LifecycleHook] = None
+        """In the auto scaling mode, if instances drain, the lifecycle hook which
+        holds terminating instances until they have drained, not initialized
+        until perform_remote_executions is called"""
+
+        self.secret_parameters: Dict[str, aws.ssm.Parameter] = dict()
+        """In the auto scaling mode, the SSM parameters holding each of the
+        SECRET_FILES, keyed by path, not initialized until
+        perform_remote_executions is called"""
+
+        self.scaling_role: Optional[aws.iam.Role] = None
+        """In the auto scaling mode, the iam role of the instances, not
+        initialized until perform_remote_executions is called"""
+
+        self.scaling_role_policy: Optional[aws.iam.RolePolicy] = None
+        """In the auto scaling mode, the permissions of the instances, not
+        initialized until perform_remote_executions is called"""
+
+        self.scaling_instance_profile: Optional[aws.iam.InstanceProfile] = None
+        """In the auto scaling mode, the instance profile of the instances, not
+        initialized until perform_remote_executions is called"""
 
-        self.configuration: Optional[str] = None
+        self.configuration: Optional[pulumi.Input[str]] = None
         """The configuration for the application as shell code, not initialized until
         perform_remote_executions is called"""
 
@@ -151,44 +449,400 @@ class Webapp:
         """The remote executions repsonsible for installing the applications on each instance,
         broken down by subnet, not initialized until perform_remote_executions is called"""
 
-    def perform_remote_executions(self, configuration: pulumi.Input[str]):
+    def perform_remote_executions(
+        self, configuration: Union[pulumi.Input[str], WebappEnvironment]
+    ):
         """
         actually installs the web application; the configuration often depends on
         the instances themselves, such as their ip, hence why this is a separate step.
 
         Args:
-            configuration (str): The shell code to install under "environment.sh"
-                for the webapp under the home directory, which is executed
+            configuration (str, WebappEnvironment): The shell code to install under
+                "config.sh" for the webapp under the home directory, which is executed
                 prior to installing/running the application. Typically this is
                 a series of export commands containing environment variables for
-                the application, such as the ip addresses of database servers
+                the application, such as the ip addresses of database servers. If
+                an environment is specified, only the variables this application
+                consumes are exported, so that changes to any others do not
+                redeploy it
+
+        In the auto scaling mode, this instead creates the auto scaling group,
+        whose instances install the application from user data as they boot.
         """
+        if isinstance(configuration, WebappEnvironment):
+            configuration = configuration.render(self.environment)
         self.configuration = configuration
 
-        self.remote_executions_by_subnet = [
-            [
-                RemoteExecution(
+        if self.autoscaling is not None:
+            self.remote_executions_by_subnet = [[] for _ in range(self.num_subnets)]
+            self.create_autoscaling_group(configuration)
+            return
+
+        remote_executions: List[List[Optional[RemoteExecution]]] = [
+            [None] * len(self.instances_by_subnet[subnet_idx])
+            for subnet_idx in range(self.num_subnets)
+        ]
+        previous_batch: List[RemoteExecution] = []
+        for batch in self.get_deploy_batches():
+            current_batch: List[RemoteExecution] = []
+            for subnet_idx, instance_idx in batch:
+                instance = self.instances_by_subnet[subnet_idx][instance_idx]
+                remote_execution = RemoteExecution(
                     f"{self.resource_name}-re-{subnet_idx}-{instance_idx}",
                     props=RemoteExecutionInputs(
                         script_name="setup-scripts/webapp",
-                        file_substitutions={
-                            "config.sh": {"CONFIGURATION": configuration},
-                            "repo.sh": {
-                                "GITHUB_REPOSITORY": self.github_repository,
-                                "GITHUB_USERNAME": self.github_username,
-                                "GITHUB_PAT": self.github_pat,
-                            },
-                        },
+                        file_substitutions=self.get_file_substitutions(configuration),
                         host=instance.private_ip,
                         private_key=self.key.private_key_path,
                         bastion=self.bastion,
                         shared_script_name="setup-scripts/shared",
                     ),
-                    opts=ResourceOptions(depends_on=self.vpc.private_rtas),
+                    opts=ResourceOptions(
+                        depends_on=[*self.vpc.private_rtas, *previous_batch]
+                    ),
+                )
+                remote_executions[subnet_idx][instance_idx] = remote_execution
+                current_batch.append(remote_execution)
+            previous_batch = current_batch
+
+        self.remote_executions_by_subnet = remote_executions
+
+    def get_file_substitutions(
+        self, configuration: pulumi.Input[str]
+    ) -> Dict[str, Dict[str, pulumi.Input[str]]]:
+        """Returns the file substitutions for setup-scripts/webapp with the
+        given configuration
+        """
+        autoscaling = self.autoscaling
+        return {
+            "config.sh": {"CONFIGURATION": configuration},
+            "repo.sh": {
+                "GITHUB_REPOSITORY": self.github_repository,
+                "GITHUB_USERNAME": self.github_username,
+                "GITHUB_PAT": self.github_pat,
+            },
+            "health_check.sh": {
+                "HEALTH_CHECK_PATH": self.health_check_path or "",
+                "HEALTH_CHECK_TIMEOUT": str(self.health_check_timeout),
+            },
+            "scaling.sh": {
+                "SCALING_QUEUE_KEYS": (
+                    " ".join(autoscaling.queue_keys)
+                    if autoscaling is not None and autoscaling.queue_keys
+                    else ""
+                ),
+                "SCALING_METRIC_NAMESPACE": SCALING_METRIC_NAMESPACE,
+                "SCALING_DRAIN_HOOK_NAME": (
+                    DRAIN_HOOK_NAME
+                    if autoscaling is not None and autoscaling.drain_timeout
+                    else ""
+                ),
+            },
+        }
+
+    def create_autoscaling_group(self, configuration: pulumi.Input[str]) -> None:
+        """Creates the launch template, auto scaling group and scaling policies
+        of the auto scaling mode, where instances provision themselves from
+        user data rendered from setup-scripts/webapp with the given configuration
+        """
+        autoscaling = self.autoscaling
+        file_substitutions = pulumi.Output.from_input(
+            self.get_file_substitutions(configuration)
+        )
+        self.secret_parameters = {
+            path: aws.ssm.Parameter(
+                f"{self.resource_name}-{os.path.splitext(path)[0]}-secret",
+                type="SecureString",
+                tier="Intelligent-Tiering",
+                value=file_substitutions.apply(
+                    lambda subs, path=path: load_template(
+                        os.path.join("setup-scripts/webapp", path)
+                    ).render(subs[path])
+                ),
+            )
+            for path in SECRET_FILES
+        }
+        # fetching a specific version changes the user data, and hence
+        # replaces the instances, whenever a secret file changes
+        secret_files = pulumi.Output.from_input(
+            {
+                path: pulumi.Output.concat(
+                    parameter.name, ":", parameter.version.apply(str)
+                )
+                for path, parameter in self.secret_parameters.items()
+            }
+        )
+        user_data = pulumi.Output.all(file_substitutions, secret_files).apply(
+            lambda args: encode_user_data(
+                render_user_data(
+                    "setup-scripts/webapp",
+                    "setup-scripts/shared",
+                    {
+                        path: subs
+                        for path, subs in args[0].items()
+                        if path not in args[1]
+                    },
+                    shared_files=USER_DATA_SHARED_FILES,
+                    secret_files=args[1],
+                )
+            )
+        )
+
+        self.create_scaling_instance_profile()
+
+        self.launch_template = aws.ec2.LaunchTemplate(
+            f"{self.resource_name}-launch-template",
+            image_id=(self.image.ami_id if self.image is not None else self.ami.id),
+            instance_type=self.instance_type,
+            key_name=self.vpc.key.key_pair.key_name,
+            vpc_security_group_ids=[self.security_group.id],
+            iam_instance_profile=aws.ec2.LaunchTemplateIamInstanceProfileArgs(
+                name=self.scaling_instance_profile.name
+            ),
+            user_data=user_data,
+            update_default_version=True,
+            tag_specifications=[
+                aws.ec2.LaunchTemplateTagSpecificationArgs(
+                    resource_type="instance",
+                    tags={"Name": f"{self.resource_name} autoscaled"},
+                )
+            ],
+            opts=ResourceOptions(depends_on=[self.scaling_role_policy]),
+        )
+
+        # replace at most max_unavailable instances at a time when the
+        # launch template changes
+        min_healthy_percentage = max(
+            0,
+            100
+            - (100 * self.max_unavailable + autoscaling.min_size - 1)
+            // max(autoscaling.min_size, 1),
+        )
+        launch_template = aws.autoscaling.GroupLaunchTemplateArgs(
+            id=self.launch_template.id,
+            version=self.launch_template.latest_version.apply(str),
+        )
+        self.autoscaling_group = aws.autoscaling.Group(
+            f"{self.resource_name}-group",
+            vpc_zone_identifiers=[
+                subnet.id for subnet in self.vpc.private_subnets[: self.num_subnets]
+            ],
+            min_size=autoscaling.min_size,
+            max_size=autoscaling.max_size,
+            launch_template=(
+                launch_template if autoscaling.spot_instance_types is None else None
+            ),
+            mixed_instances_policy=(
+                aws.autoscaling.GroupMixedInstancesPolicyArgs(
+                    instances_distribution=aws.autoscaling.GroupMixedInstancesPolicyInstancesDistributionArgs(
+                        on_demand_base_capacity=autoscaling.on_demand_base_capacity,
+                        on_demand_percentage_above_base_capacity=0,
+                        spot_allocation_strategy="capacity-optimized",
+                    ),
+                    launch_template=aws.autoscaling.GroupMixedInstancesPolicyLaunchTemplateArgs(
+                        launch_template_specification=aws.autoscaling.GroupMixedInstancesPolicyLaunchTemplateLaunchTemplateSpecificationArgs(
+                            launch_template_id=launch_template.id,
+                            version=launch_template.version,
+                        ),
+                        overrides=[
+                            aws.autoscaling.GroupMixedInstancesPolicyLaunchTemplateOverrideArgs(
+                                instance_type=instance_type
+                            )
+                            for instance_type in [
+                                self.instance_type,
+                                *autoscaling.spot_instance_types,
+                            ]
+                        ],
+                    ),
+                )
+                if autoscaling.spot_instance_types is not None
+                else None
+            ),
+            target_group_arns=(
+                [self.target_group.arn] if self.target_group is not None else None
+            ),
+            health_check_type="ELB" if self.target_group is not None else "EC2",
+            health_check_grace_period=autoscaling.health_check_grace_period,
+            instance_refresh=aws.autoscaling.GroupInstanceRefreshArgs(
+                strategy="Rolling",
+                preferences=aws.autoscaling.GroupInstanceRefreshPreferencesArgs(
+                    min_healthy_percentage=min_healthy_percentage,
+                    instance_warmup=str(autoscaling.health_check_grace_period),
+                ),
+            ),
+            tags=[
+                aws.autoscaling.GroupTagArgs(
+                    key="Name",
+                    value=f"{self.resource_name} autoscaled",
+                    propagate_at_launch=True,
+                )
+            ],
+            opts=ResourceOptions(depends_on=self.vpc.private_rtas),
+        )
+
+        self.scaling_policies = []
+        if autoscaling.target_cpu_utilization is not None:
+            self.scaling_policies.append(
+                aws.autoscaling.Policy(
+                    f"{self.resource_name}-cpu-policy",
+                    autoscaling_group_name=self.autoscaling_group.name,
+                    policy_type="TargetTrackingScaling",
+                    estimated_instance_warmup=autoscaling.health_check_grace_period,
+                    target_tracking_configuration=aws.autoscaling.PolicyTargetTrackingConfigurationArgs(
+                        predefined_metric_specification=aws.autoscaling.PolicyTargetTrackingConfigurationPredefinedMetricSpecificationArgs(
+                            predefined_metric_type="ASGAverageCPUUtilization"
+                        ),
+                        target_value=autoscaling.target_cpu_utilization,
+                    ),
+                )
+            )
+        if autoscaling.queue_keys:
+            self.scaling_policies.append(
+                aws.autoscaling.Policy(
+                    f"{self.resource_name}-queue-policy",
+                    autoscaling_group_name=self.autoscaling_group.name,
+                    policy_type="TargetTrackingScaling",
+                    estimated_instance_warmup=autoscaling.health_check_grace_period,
+                    target_tracking_configuration=aws.autoscaling.PolicyTargetTrackingConfigurationArgs(
+                        customized_metric_specification=aws.autoscaling.PolicyTargetTrackingConfigurationCustomizedMetricSpecificationArgs(
+                            metric_name="BacklogPerInstance",
+                            namespace=SCALING_METRIC_NAMESPACE,
+                            statistic="Average",
+                            metric_dimensions=[
+                                aws.autoscaling.PolicyTargetTrackingConfigurationCustomizedMetricSpecificationMetricDimensionArgs(
+                                    name="AutoScalingGroupName",
+                                    value=self.autoscaling_group.name,
+                                )
+                            ],
+                        ),
+                        target_value=autoscaling.target_backlog_per_instance,
+                    ),
                 )
-                for instance_idx, instance in enumerate(
-                    self.instances_by_subnet[subnet_idx]
+            )
+        if autoscaling.target_requests_per_instance is not None:
+            self.scaling_policies.append(
+                aws.autoscaling.Policy(
+                    f"{self.resource_name}-requests-policy",
+                    autoscaling_group_name=self.autoscaling_group.name,
+                    policy_type="TargetTrackingScaling",
+                    estimated_instance_warmup=autoscaling.health_check_grace_period,
+                    target_tracking_configuration=aws.autoscaling.PolicyTargetTrackingConfigurationArgs(
+                        predefined_metric_specification=aws.autoscaling.PolicyTargetTrackingConfigurationPredefinedMetricSpecificationArgs(
+                            predefined_metric_type="ALBRequestCountPerTarget",
+                            resource_label=pulumi.Output.concat(
+                                self.load_balancer.arn_suffix,
+                                "/",
+                                self.target_group.arn_suffix,
+                            ),
+                        ),
+                        target_value=autoscaling.target_requests_per_instance,
+                    ),
                 )
+            )
+
+        if autoscaling.drain_timeout:
+            self.drain_hook = aws.autoscaling.LifecycleHook(
+                f"{self.resource_name}-drain-hook",
+                name=DRAIN_HOOK_NAME,
+                autoscaling_group_name=self.autoscaling_group.name,
+                lifecycle_transition="autoscaling:EC2_INSTANCE_TERMINATING",
+                heartbeat_timeout=autoscaling.drain_timeout,
+                default_result="CONTINUE",
+            )
+
+    def create_scaling_instance_profile(self) -> None:
+        """Creates the instance profile of the auto scaling mode, which allows
+        instances to fetch their secret files and, if they publish queue
+        metrics or drain, to look up their group, publish metrics under
+        SCALING_METRIC_NAMESPACE and complete their lifecycle actions
+        """
+        autoscaling = self.autoscaling
+        self.scaling_role = aws.iam.Role(
+            f"{self.resource_name}-scaling-role",
+            assume_role_policy=json.dumps(
+                {
+                    "Version": "2012-10-17",
+                    "Statement": [
+                        {
+                            "Action": "sts:AssumeRole",
+                            "Effect": "Allow",
+                            "Sid": "",
+                            "Principal": {"Service": "ec2.amazonaws.com"},
+                        }
+                    ],
+                }
+            ),
+            tags={"Name": f"{self.resource_name}-scaling-role"},
+        )
+
+        def make_policy(secret_arns: List[str]) -> str:
+            statements = [
+                {
+                    "Effect": "Allow",
+                    "Action": "ssm:GetParameter",
+                    "Resource": secret_arns,
+                }
             ]
+            if autoscaling.queue_keys or autoscaling.drain_timeout:
+                statements.append(
+                    {
+                        "Effect": "Allow",
+                        "Action": [
+                            "autoscaling:DescribeAutoScalingInstances",
+                            "autoscaling:DescribeAutoScalingGroups",
+                            "autoscaling:CompleteLifecycleAction",
+                            "autoscaling:RecordLifecycleActionHeartbeat",
+                        ],
+                        "Resource": "*",
+                    }
+                )
+            if autoscaling.queue_keys:
+                statements.append(
+                    {
+                        "Effect": "Allow",
+                        "Action": "cloudwatch:PutMetricData",
+                        "Resource": "*",
+                        "Condition": {
+                            "StringEquals": {
+                                "cloudwatch:namespace": SCALING_METRIC_NAMESPACE
+                            }
+                        },
+                    }
+                )
+            return json.dumps({"Version": "2012-10-17", "Statement": statements})
+
+        self.scaling_role_policy = aws.iam.RolePolicy(
+            f"{self.resource_name}-scaling-role-policy",
+            role=self.scaling_role.id,
+            policy=pulumi.Output.all(
+                *[parameter.arn for parameter in self.secret_parameters.values()]
+            ).apply(make_policy),
+        )
+        self.scaling_instance_profile = aws.iam.InstanceProfile(
+            f"{self.resource_name}-scaling-instance-profile",
+            role=self.scaling_role.name,
+        )
+
+    def get_deploy_batches(self) -> List[List[Tuple[int, int]]]:
+        """Returns the (subnet index, instance index) of every instance, in the
+        batches they are deployed to. Batches are deployed one after another,
+        and every batch holds at most max_unavailable instances.
+        """
+        ordered = [
+            (subnet_idx, instance_idx)
             for subnet_idx in range(self.num_subnets)
+            for instance_idx in range(len(self.instances_by_subnet[subnet_idx]))
+        ]
+        return [
+            ordered[start : start + self.max_unavailable]
+            for start in range(0, len(ordered), self.max_unavailable)
         ]
+
+
+def make_load_balancer_name(resource_name: str, suffix: str) -> str:
+    """Returns a name for a load balancer or target group of the webapp with
+    the given resource name, which may only contain alphanumerics and hyphens
+    and must be at most 32 characters
+    """
+    prefix = "".join(c if c.isalnum() else "-" for c in resource_name)
+    return f"{prefix[: 31 - len(suffix)]}-{suffix}"